@@ -19,6 +19,8 @@ DATABASES = {
         'PASSWORD': 'root',
         'HOST': 'localhost',                      # Empty for localhost through domain sockets or '127.0.0.1' for localhost through TCP.
         'PORT': '8080',                      # Set to empty string for default.
+        # a file, not the in memory default, so the concurrency tests can give every thread its own connection
+        'TEST': {'NAME': 'test_database.db'},
     }
 }
 
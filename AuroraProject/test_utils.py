@@ -0,0 +1,61 @@
+import threading
+
+from django.db import connection, connections
+
+
+def run_concurrently(target, arguments, prepare=None):
+    """
+    Calls target(argument, prepared) for every argument in a thread of its own. prepare(argument) runs
+    first in the thread, e.g. to load the state the threads then race on, and a barrier starts all the
+    target calls at the same moment. Returns the results in the order of arguments.
+
+    Every thread uses its own database connection. An in memory sqlite database only exists on the
+    connection of the test, so there the threads share it and take turns.
+    """
+    shared_connection = connections['default'] if is_in_memory_sqlite() else None
+    if shared_connection:
+        shared_connection.allow_thread_sharing = True
+    lock = threading.Lock() if shared_connection else None
+    barrier = threading.Barrier(len(arguments))
+    results = [None] * len(arguments)
+    errors = []
+
+    def call(function, *args):
+        if lock is None:
+            return function(*args)
+        with lock:
+            return function(*args)
+
+    def run(index, argument):
+        if shared_connection:
+            connections[shared_connection.alias] = shared_connection
+        elif connection.vendor == 'sqlite':
+            # sqlite has a single writer, the others wait for it instead of failing after the default 5s
+            connection.cursor().execute('PRAGMA busy_timeout = 60000')
+        try:
+            prepared = call(prepare, argument) if prepare else None
+            barrier.wait()
+            results[index] = call(target, argument, prepared)
+        except Exception as error:
+            errors.append(error)
+            barrier.abort()
+        finally:
+            if not shared_connection:
+                connection.close()
+
+    threads = [threading.Thread(target=run, args=(index, argument)) for index, argument in enumerate(arguments)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if shared_connection:
+        shared_connection.allow_thread_sharing = False
+    errors = [error for error in errors if not isinstance(error, threading.BrokenBarrierError)] or errors
+    if errors:
+        raise errors[0]
+    return results
+
+
+def is_in_memory_sqlite():
+    name = connection.settings_dict['NAME']
+    return connection.vendor == 'sqlite' and (name == ':memory:' or 'mode=memory' in name)
@@ -1,7 +1,7 @@
 from django.shortcuts import render_to_response
 from django.template import RequestContext
 from django.shortcuts import redirect
-from django.http import HttpResponse
+from django.http import StreamingHttpResponse
 from django.contrib.auth.decorators import login_required
 from django.contrib.admin.views.decorators import staff_member_required
 from datetime import datetime
@@ -11,7 +11,6 @@ from Course.models import Course
 from AuroraUser.models import AuroraUser
 from Evaluation.models import Evaluation
 from Review.models import Review
-from ReviewAnswer.models import ReviewAnswer
 from Elaboration.models import Elaboration
 from Evaluation.views import get_points
 from Challenge.models import Challenge
@@ -52,26 +51,38 @@ def time_to_unix_string(time):
     return str(seconds)
 
 
+def tsv_line(*values):
+    return "\t".join(str(value) for value in values) + "\n"
+
+
+def stream_tsv(lines):
+    return StreamingHttpResponse(lines, content_type="text/plain; charset=utf-8")
+
+
 @login_required()
 @staff_member_required
 def result_users(request):
-    s = ""
-    for user in AuroraUser.objects.filter(is_staff=False):
-        s += "\t".join(["{}"] * 7).format(user.matriculation_number,
-                                          user.nickname,
-                                          user.first_name,
-                                          user.last_name,
-                                          user.study_code,
-                                          time_to_unix_string(user.last_activity),
-                                          user.statement)
-        s += "\n"
+    return stream_tsv(get_result_users())
 
-    return HttpResponse(s, mimetype="text/plain; charset=utf-8")
+
+def get_result_users():
+    for user in AuroraUser.objects.filter(is_staff=False).order_by('id').iterator():
+        yield tsv_line(user.matriculation_number,
+                       user.nickname,
+                       user.first_name,
+                       user.last_name,
+                       user.study_code,
+                       time_to_unix_string(user.last_activity),
+                       user.statement)
 
 
 @login_required()
 @staff_member_required
 def result_elabs_nonfinal(request):
+    return stream_tsv(get_result_elabs_nonfinal())
+
+
+def get_result_elabs_nonfinal():
     """
     username (mnr) TAB elabID TAB challenge-title TAB challenge-ID TAB creation time TAB submission time TAB
     reviewID 1 TAB review-verdict 1 TAB review-creation-date 1 TAB review-submission-date 1 TAB reviewID 2 TAB
@@ -79,44 +90,65 @@ def result_elabs_nonfinal(request):
     """
 
     final_challenge_ids = Challenge.get_final_challenge_ids()
-    elabs = Elaboration.objects.exclude(challenge__id__in=final_challenge_ids).prefetch_related()
-
-    s = ""
-    for elab in elabs:
-        s += "\t".join(["{}"] * 6).format(
-            str(elab.user.matriculation_number),
-            str(elab.id),
-            elab.challenge.title,
-            str(elab.challenge.id),
-            time_to_unix_string(elab.creation_time),
-            time_to_unix_string(elab.submission_time)
-        )
-
-        for review in Review.objects.filter(elaboration=elab):
-            s += "\t" + str(review.id)
-            s += "\t" + str(review.appraisal)
-            s += "\t" + time_to_unix_string(review.creation_time)
-            s += "\t" + time_to_unix_string(review.submission_time)
-
-        s += "\n"
-
-    return HttpResponse(s, mimetype="text/plain; charset=utf-8")
+    elabs = (
+        Elaboration.objects
+        .exclude(challenge__id__in=final_challenge_ids)
+        .order_by('id')
+        .values_list('id', 'user__matriculation_number', 'challenge__title', 'challenge_id', 'creation_time',
+                     'submission_time')
+        .iterator()
+    )
+    # both queries are sorted by elaboration, the reviews are merged into the elaboration rows while streaming
+    reviews = (
+        Review.objects
+        .exclude(elaboration__challenge__id__in=final_challenge_ids)
+        .order_by('elaboration_id', 'id')
+        .values_list('elaboration_id', 'id', 'appraisal', 'creation_time', 'submission_time')
+        .iterator()
+    )
+    review = next(reviews, None)
+    for elab_id, matriculation_number, challenge_title, challenge_id, creation_time, submission_time in elabs:
+        line = [
+            str(matriculation_number),
+            str(elab_id),
+            challenge_title,
+            str(challenge_id),
+            time_to_unix_string(creation_time),
+            time_to_unix_string(submission_time),
+        ]
+        while review is not None and review[0] <= elab_id:
+            if review[0] == elab_id:
+                line += [
+                    str(review[1]),
+                    str(review[2]),
+                    time_to_unix_string(review[3]),
+                    time_to_unix_string(review[4]),
+                ]
+            review = next(reviews, None)
+        yield tsv_line(*line)
 
 
 @login_required()
 @staff_member_required
 def result_elabs_final(request):
+    return stream_tsv(get_result_elabs_final())
+
+
+def get_result_elabs_final():
     """
     username(mnr) TAB elabID TAB challenge-title TAB challenge-ID TAB creation time TAB submission time TAB
     evaluationID TAB tutor TAB evaluation-creationdate TAB evaluation-submissiontime TAB evaluation-points
     """
 
-    evals = Evaluation.objects.all().prefetch_related()
-
-    s = ""
+    evals = (
+        Evaluation.objects
+        .select_related('submission__user', 'submission__challenge', 'tutor')
+        .order_by('id')
+        .iterator()
+    )
     for evaluation in evals:
         elab = evaluation.submission
-        s += "\t".join(["{}"] * 11).format(
+        yield tsv_line(
             str(elab.user.matriculation_number),
             str(elab.id),
             elab.challenge.title,
@@ -130,15 +162,10 @@ def result_elabs_final(request):
             str(evaluation.evaluation_points)
         )
 
-        s += "\n"
-
-    return HttpResponse(s, mimetype="text/plain; charset=utf-8")
-
 
 def get_result_reviews():
     """
-    Since this is so slow (and can be too slow for a application server response, this is also being used
-    as a command in Review.
+    Yields one line per review, also used by the result_reviews command in Review.
 
     review-autor (MNr) TAB
     reviewed-elab-autor (MNr) TAB
@@ -147,32 +174,26 @@ def get_result_reviews():
     review-submission-date TAB
     länge des reviews (number of chars of all fields summiert)
     """
-    reviews = Review.objects.all().prefetch_related()
-    result = ""
-    for review in reviews:
-        answers = ReviewAnswer.objects.filter(review=review.id)
-        answer_string = ""
-        for answer in answers:
-            answer_string += answer.text
-        length = len(answer_string)
-
-        result += "\t".join(["{}"] * 6).format(
-            review.reviewer.username,
-            review.elaboration.user.username,
-            review.elaboration.challenge_id,
-            time_to_unix_string(review.creation_time),
-            time_to_unix_string(review.submission_time),
-            str(length)
+    reviews = (
+        Review.objects
+        .with_answer_length()
+        .order_by('id')
+        .values_list('reviewer__username', 'elaboration__user__username', 'elaboration__challenge_id',
+                     'creation_time', 'submission_time', 'answer_length')
+        .iterator()
+    )
+    for reviewer, author, challenge_id, creation_time, submission_time, answer_length in reviews:
+        yield tsv_line(
+            reviewer,
+            author,
+            challenge_id,
+            time_to_unix_string(creation_time),
+            time_to_unix_string(submission_time),
+            str(answer_length)
         )
 
-        result += "\n"
-
-    return result
-
 
 @login_required()
 @staff_member_required
 def result_reviews(request):
-    result = get_result_reviews()
-
-    return HttpResponse(result, mimetype="text/plain; charset=utf-8")
+    return stream_tsv(get_result_reviews())
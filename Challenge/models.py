@@ -1,14 +1,19 @@
+from copy import copy, deepcopy
 from datetime import datetime, timedelta
 import os
 
 from django.db import models
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
 from django.contrib.contenttypes.fields import GenericRelation
 
 from Comments.models import Comment
-from Stack.models import StackChallengeRelation
+from Stack.models import Stack, StackChallengeRelation
 from Review.models import Review
 from Elaboration.models import Elaboration
-from Course.models import Course
+from Course.models import Course, CourseUserRelation
+from Evaluation.models import Evaluation
+from FileUpload.models import UploadFile
 
 
 def challenge_image_path(instance, filename):
@@ -73,12 +78,11 @@ class Challenge(models.Model):
     def get_course(self):
         return self.course
 
+    def get_chain_index(self):
+        return ChallengeChainIndex.for_challenge(self)
+
     def get_next(self):
-        next_challenges = Challenge.objects.filter(prerequisite=self)
-        if next_challenges:
-            return next_challenges[0]
-        else:
-            return None
+        return self.get_chain_index().get_next(self)
 
     def get_elaboration(self, user):
         try:
@@ -102,48 +106,39 @@ class Challenge(models.Model):
     def is_first_challenge(self):
         return not self.prerequisite  # challenge without prerequisite is the first challenge
 
+    final_challenge_ids_cache = {}
+
     @staticmethod
     def get_final_challenge_ids():
-        peer_review_challenges = (
-            Challenge.objects
-            .filter(prerequisite__isnull=False).values_list('prerequisite', flat=True)
-        )
-        final_challenge_ids = (
-            Challenge.objects
-            .exclude(id__in=list(peer_review_challenges))
-            .values_list('id', flat=True)
-        )
-        return final_challenge_ids
+        return Challenge.get_cached_final_challenge_ids(None)
 
     @staticmethod
     def get_course_final_challenge_ids(course):
-        peer_review_challenges = (
-            Challenge.objects
-            .filter(prerequisite__isnull=False).values_list('prerequisite', flat=True)
-        )
-        non_course_challenges = [challenge.id for challenge in Challenge.objects.exclude(course=course)]
-        knockout_list = non_course_challenges + list(peer_review_challenges)
-        final_challenge_ids = (
-            Challenge.objects
-            .exclude(id__in=knockout_list)
-            .values_list('id', flat=True)
-        )
-        return final_challenge_ids
+        return Challenge.get_cached_final_challenge_ids(course.id)
+
+    @staticmethod
+    def get_cached_final_challenge_ids(course_id):
+        # memoized per course (None for all courses), dropped together with the ChallengeChainIndex
+        cached = Challenge.final_challenge_ids_cache.get(course_id)
+        if cached is None or cached[0] + ChallengeChainIndex.max_age < datetime.now():
+            final_challenges = Challenge.objects.filter(challenge__isnull=True)
+            if course_id is not None:
+                final_challenges = final_challenges.filter(course_id=course_id)
+            cached = (datetime.now(), tuple(final_challenges.order_by('id').values_list('id', flat=True)))
+            Challenge.final_challenge_ids_cache[course_id] = cached
+        return cached[1]
 
     def is_final_challenge(self):
-        return False if self.get_next() else True
+        return self.get_chain_index().is_final_challenge(self)
 
     def get_first_challenge(self):
-        first_challenge = self
-        while first_challenge.prerequisite is not None:
-            first_challenge = first_challenge.prerequisite
-        return first_challenge
+        return self.get_chain_index().get_first_challenge(self)
 
     def get_final_challenge(self):
-        next_challenge = self
-        while not next_challenge.is_final_challenge():
-            next_challenge = next_challenge.get_next()
-        return next_challenge
+        return self.get_chain_index().get_final_challenge(self)
+
+    def get_chain_position(self):
+        return self.get_chain_index().get_position(self)
 
     def has_enough_user_reviews(self, user):
         return len(self.get_reviews_written_by_user(user)) >= 3
@@ -287,3 +282,564 @@ class Challenge(models.Model):
             else:
                 return (last_submit.submission_time + timedelta(days=PERIOD))
         return False
+
+
+class ChallengeChainIndex(object):
+    """
+    Position, next, first and final challenge of every challenge of a course.
+
+    The index is built with two queries the first time a course is used and kept
+    in process until a Challenge or StackChallengeRelation is saved or deleted.
+    Indexes older than max_age are rebuilt so changes made by other processes
+    are picked up as well.
+    """
+
+    max_age = timedelta(minutes=5)
+    indexes = {}
+
+    def __init__(self, course_id):
+        self.course_id = course_id
+        self.creation_time = datetime.now()
+
+        self.challenges = {}
+        self.next_ids = {}
+        for challenge in Challenge.objects.filter(course_id=course_id).order_by('id'):
+            self.challenges[challenge.id] = challenge
+            if challenge.prerequisite_id is not None and challenge.prerequisite_id not in self.next_ids:
+                self.next_ids[challenge.prerequisite_id] = challenge.id
+
+        self.first_ids = {}
+        self.positions = {}
+        for challenge_id in self.challenges:
+            chain = self.walk(challenge_id, lambda walked_id: self.challenges[walked_id].prerequisite_id)
+            self.first_ids[challenge_id] = chain[-1]
+            self.positions[challenge_id] = len(chain) - 1
+
+        self.final_ids = {}
+        for challenge_id in self.challenges:
+            self.final_ids[challenge_id] = self.walk(challenge_id, self.next_ids.get)[-1]
+
+        self.stack_challenge_ids = {}
+        relations = (
+            StackChallengeRelation.objects
+            .filter(stack__course_id=course_id)
+            .order_by('id')
+            .values_list('stack_id', 'challenge_id')
+        )
+        for stack_id, challenge_id in relations:
+            self.stack_challenge_ids.setdefault(stack_id, []).append(challenge_id)
+
+    def walk(self, challenge_id, step):
+        # follows the chain until it leaves the course, stops on cyclic prerequisites
+        chain = [challenge_id]
+        next_id = step(challenge_id)
+        while next_id in self.challenges and next_id not in chain:
+            chain.append(next_id)
+            next_id = step(next_id)
+        return chain
+
+    @staticmethod
+    def for_course(course_id):
+        index = ChallengeChainIndex.indexes.get(course_id)
+        if index is None or index.creation_time + ChallengeChainIndex.max_age < datetime.now():
+            index = ChallengeChainIndex(course_id)
+            ChallengeChainIndex.indexes[course_id] = index
+        return index
+
+    @staticmethod
+    def for_challenge(challenge):
+        index = ChallengeChainIndex.for_course(challenge.course_id)
+        if challenge.id not in index.challenges:
+            ChallengeChainIndex.invalidate()
+            index = ChallengeChainIndex.for_course(challenge.course_id)
+        return index
+
+    @staticmethod
+    def invalidate():
+        ChallengeChainIndex.indexes.clear()
+        Challenge.final_challenge_ids_cache.clear()
+
+    def get_challenge(self, challenge_id):
+        # hand out copies, the indexed instances are shared between requests
+        if challenge_id not in self.challenges:
+            return None
+        return copy(self.challenges[challenge_id])
+
+    def get_next(self, challenge):
+        return self.get_challenge(self.next_ids.get(challenge.id))
+
+    def is_final_challenge(self, challenge):
+        return challenge.id not in self.next_ids
+
+    def get_first_challenge(self, challenge):
+        return self.get_challenge(self.first_ids[challenge.id])
+
+    def get_final_challenge(self, challenge):
+        return self.get_challenge(self.final_ids[challenge.id])
+
+    def get_position(self, challenge):
+        return self.positions[challenge.id]
+
+    def get_stack_first_challenge(self, stack):
+        for challenge_id in self.stack_challenge_ids.get(stack.id, []):
+            return self.get_challenge(self.first_ids[challenge_id])
+        return None
+
+    def get_stack_final_challenge(self, stack):
+        for challenge_id in self.stack_challenge_ids.get(stack.id, []):
+            return self.get_challenge(self.final_ids[challenge_id])
+        return None
+
+
+@receiver(post_save, sender=Challenge)
+@receiver(post_delete, sender=Challenge)
+@receiver(post_save, sender=StackChallengeRelation)
+@receiver(post_delete, sender=StackChallengeRelation)
+def challenge_chain_change_handler(sender, **kwargs):
+    ChallengeChainIndex.invalidate()
+    Gradebook.invalidate()
+
+
+class CourseProgress(object):
+    """
+    Snapshot of the progress of one user in one course.
+
+    All elaborations, written reviews, received reviews and evaluations of the user
+    are loaded once in a fixed number of queries, the challenge and stack states
+    are then resolved in memory following the same rules as Challenge.get_status.
+    for_users builds the snapshots of many users from the same number of queries.
+    """
+
+    def __init__(self, course, user, course_data=None):
+        self.course = course
+        self.user = user
+        if course_data is None:
+            course_data = CourseProgress.load(course, user)
+
+        self.is_enlisted = user.id in course_data['enlisted_user_ids']
+        self.challenges = course_data['challenges']
+        self.next_challenges = course_data['next_challenges']
+        self.stack_challenges = course_data['stack_challenges']
+        self.challenge_stacks = course_data['challenge_stacks']
+        self.elaborations = course_data['elaborations'].get(user.id, {})
+        self.elaborations_with_uploads = course_data['elaborations_with_uploads']
+        self.written_reviews = course_data['written_reviews'].get(user.id, {})
+        self.received_appraisals = course_data['received_appraisals']
+        self.evaluations = course_data['evaluations']
+
+    @staticmethod
+    def for_users(course, users):
+        # the same queries as for a single user, only without the user filter
+        course_data = CourseProgress.load(course)
+        return dict((user.id, CourseProgress(course, user, course_data)) for user in users)
+
+    @staticmethod
+    def load(course, user=None):
+        def for_user(queryset, user_field):
+            if user is None:
+                return queryset
+            return queryset.filter(**{user_field: user})
+
+        enlisted_user_ids = set(
+            for_user(CourseUserRelation.objects.filter(course=course), 'user')
+            .values_list('user_id', flat=True)
+        )
+
+        challenges = {}
+        next_challenges = {}
+        for challenge in Challenge.objects.filter(course=course).order_by('id'):
+            challenges[challenge.id] = challenge
+            if challenge.prerequisite_id is not None and challenge.prerequisite_id not in next_challenges:
+                next_challenges[challenge.prerequisite_id] = challenge
+
+        stack_challenges = {}
+        challenge_stacks = {}
+        relations = (
+            StackChallengeRelation.objects
+            .filter(challenge__course=course)
+            .select_related('stack')
+            .order_by('id')
+        )
+        for relation in relations:
+            challenge = challenges[relation.challenge_id]
+            stack_challenges.setdefault(relation.stack_id, []).append(challenge)
+            if relation.challenge_id not in challenge_stacks:
+                challenge_stacks[relation.challenge_id] = relation.stack
+
+        elaborations = {}
+        user_elaborations = for_user(Elaboration.objects.filter(challenge__course=course), 'user').order_by('id')
+        for elaboration in user_elaborations:
+            by_challenge = elaborations.setdefault(elaboration.user_id, {})
+            if elaboration.challenge_id not in by_challenge:
+                by_challenge[elaboration.challenge_id] = elaboration
+
+        elaborations_with_uploads = set(
+            for_user(UploadFile.objects.filter(elaboration__challenge__course=course), 'elaboration__user')
+            .values_list('elaboration_id', flat=True)
+        )
+
+        written_reviews = {}
+        reviews = (
+            for_user(Review.objects.filter(elaboration__challenge__course=course, submission_time__isnull=False),
+                     'reviewer')
+            .select_related('elaboration')
+            .order_by('id')
+        )
+        for review in reviews:
+            by_challenge = written_reviews.setdefault(review.reviewer_id, {})
+            by_challenge.setdefault(review.elaboration.challenge_id, []).append(review)
+
+        received_appraisals = {}
+        received_reviews = (
+            for_user(Review.objects.filter(elaboration__challenge__course=course, submission_time__isnull=False),
+                     'elaboration__user')
+            .values_list('elaboration_id', 'appraisal')
+        )
+        for elaboration_id, appraisal in received_reviews:
+            received_appraisals.setdefault(elaboration_id, []).append(appraisal)
+
+        evaluations = {}
+        submission_evaluations = (
+            for_user(Evaluation.objects.filter(submission__challenge__course=course), 'submission__user')
+            .order_by('id')
+        )
+        for evaluation in submission_evaluations:
+            if evaluation.submission_id not in evaluations:
+                evaluations[evaluation.submission_id] = evaluation
+
+        return {
+            'enlisted_user_ids': enlisted_user_ids,
+            'challenges': challenges,
+            'next_challenges': next_challenges,
+            'stack_challenges': stack_challenges,
+            'challenge_stacks': challenge_stacks,
+            'elaborations': elaborations,
+            'elaborations_with_uploads': elaborations_with_uploads,
+            'written_reviews': written_reviews,
+            'received_appraisals': received_appraisals,
+            'evaluations': evaluations,
+        }
+
+    # challenge chain
+
+    def get_prerequisite(self, challenge):
+        return self.challenges.get(challenge.prerequisite_id)
+
+    def get_next(self, challenge):
+        return self.next_challenges.get(challenge.id)
+
+    def is_final_challenge(self, challenge):
+        return challenge.id not in self.next_challenges
+
+    def get_first_challenge(self, challenge):
+        first_challenge = challenge
+        while first_challenge.prerequisite_id is not None:
+            first_challenge = self.challenges[first_challenge.prerequisite_id]
+        return first_challenge
+
+    def get_final_challenge(self, challenge):
+        final_challenge = challenge
+        while not self.is_final_challenge(final_challenge):
+            final_challenge = self.get_next(final_challenge)
+        return final_challenge
+
+    def get_stack(self, challenge):
+        return self.challenge_stacks.get(challenge.id)
+
+    # elaborations and reviews
+
+    def get_elaboration(self, challenge):
+        return self.elaborations.get(challenge.id)
+
+    def is_started(self, challenge):
+        elaboration = self.get_elaboration(challenge)
+        if elaboration is None:
+            return False
+        if elaboration.elaboration_text:
+            return True
+        return elaboration.id in self.elaborations_with_uploads
+
+    def submitted_by_user(self, challenge):
+        elaboration = self.get_elaboration(challenge)
+        if elaboration is None:
+            return False
+        return elaboration.is_submitted()
+
+    def get_reviews_written_by_user(self, challenge):
+        return self.written_reviews.get(challenge.id, [])
+
+    def has_enough_user_reviews(self, challenge):
+        return len(self.get_reviews_written_by_user(challenge)) >= Challenge.reviews_per_challenge
+
+    def get_received_appraisals(self, challenge):
+        elaboration = self.get_elaboration(challenge)
+        if elaboration is None:
+            return []
+        return self.received_appraisals.get(elaboration.id, [])
+
+    def count_received_reviews(self, challenge, appraisal):
+        return self.get_received_appraisals(challenge).count(appraisal)
+
+    def is_passing_peer_review(self, challenge):
+        return Review.NOTHING not in self.get_received_appraisals(challenge)
+
+    def is_reviewed_2times(self, challenge):
+        return len(self.get_received_appraisals(challenge)) >= 2
+
+    def get_evaluation(self, challenge):
+        elaboration = self.get_elaboration(challenge)
+        if elaboration is None:
+            return None
+        return self.evaluations.get(elaboration.id)
+
+    def is_evaluated(self, challenge):
+        evaluation = self.get_evaluation(challenge)
+        if evaluation is None:
+            return False
+        return evaluation.submission_time is not None
+
+    # stacks
+
+    def get_challenges(self, stack):
+        return self.stack_challenges.get(stack.id, [])
+
+    def get_stack_first_challenge(self, stack):
+        for challenge in self.get_challenges(stack):
+            return self.get_first_challenge(challenge)
+        return None
+
+    def get_stack_final_challenge(self, stack):
+        for challenge in self.get_challenges(stack):
+            return self.get_final_challenge(challenge)
+        return None
+
+    def is_blocked(self, stack):
+        for challenge in self.get_challenges(stack):
+            if not self.is_final_challenge(challenge):
+                if self.get_elaboration(challenge) and not self.is_passing_peer_review(challenge):
+                    return True
+        return False
+
+    def has_enough_peer_reviews(self, stack):
+        for challenge in self.get_challenges(stack):
+            if not self.is_final_challenge(challenge):
+                if not self.get_elaboration(challenge):
+                    return False
+                if not self.is_reviewed_2times(challenge):
+                    return False
+        return True
+
+    def get_points_available(self, stack):
+        points = 0
+        for challenge in self.get_challenges(stack):
+            points += challenge.points
+        return points
+
+    def get_points_earned(self, stack):
+        evaluation = self.get_evaluation(self.get_stack_final_challenge(stack))
+        if not evaluation:
+            return 0
+        return evaluation.evaluation_points
+
+    def get_last_available_challenge(self, stack):
+        available_challenge = None
+        for challenge in self.get_challenges(stack):
+            if self.is_enabled_for_user(challenge):
+                available_challenge = challenge
+        return available_challenge
+
+    def get_stack_status_text(self, stack):
+        return self.get_status_text(self.get_last_available_challenge(stack))
+
+    # status
+
+    def is_enabled_for_user(self, challenge):
+        if not self.is_enlisted:
+            return False
+
+        if challenge.prerequisite_id is None:
+            return True
+
+        if self.submitted_by_user(challenge):
+            return True
+
+        if not self.has_enough_user_reviews(self.get_prerequisite(challenge)):
+            return False
+
+        if not self.is_final_challenge(challenge):
+            return True
+
+        stack = self.get_stack(challenge)
+        if self.is_blocked(stack):
+            return False
+        return self.has_enough_peer_reviews(stack)
+
+    def get_status(self, challenge):
+        if not self.is_enabled_for_user(challenge):
+            return Challenge.NOT_ENABLED
+
+        if not self.is_started(challenge):
+            return Challenge.NOT_STARTED
+
+        if not self.submitted_by_user(challenge):
+            return Challenge.NOT_SUBMITTED
+
+        if not self.is_final_challenge(challenge):
+            if not self.is_passing_peer_review(challenge):
+                return Challenge.BLOCKED_BAD_REVIEW
+            if not self.has_enough_user_reviews(challenge):
+                return Challenge.USER_REVIEW_MISSING
+            if not self.has_enough_peer_reviews(self.get_stack(challenge)):
+                return Challenge.DONE_MISSING_PEER_REVIEW
+            return Challenge.DONE_PEER_REVIEWED
+
+        if not self.is_evaluated(challenge):
+            return Challenge.WAITING_FOR_EVALUATION
+        return Challenge.EVALUATED
+
+    def get_status_text(self, challenge):
+        status = self.get_status(challenge)
+        return {
+            'status': Challenge.status_dict[status],
+            'next': Challenge.next_dict[status]
+        }
+
+
+class Gradebook(object):
+    """
+    Points per stack and point totals of the users of a course, as shown on the home page.
+
+    The points are computed from CourseProgress snapshots, for one user or for all users
+    of a course at once, and kept in process per user until one of the user's elaborations,
+    reviews or evaluations changes. Entries older than max_age are recomputed so changes
+    made by other processes are picked up as well. Callers get copies of the cached points,
+    so changing them does not reach other requests.
+    """
+
+    max_age = timedelta(minutes=5)
+    entries = {}
+
+    @staticmethod
+    def get_user_points(course, user):
+        points = Gradebook.get_cached_points(course.id, user.id)
+        if points is None:
+            stacks = Stack.objects.filter(course=course)
+            points = Gradebook.store_points(course.id, user.id, CourseProgress(course, user), stacks)
+        return points
+
+    @staticmethod
+    def get_course_points(course):
+        relations = CourseUserRelation.objects.filter(course=course).select_related('user')
+        users = [relation.user for relation in relations]
+        points = {}
+        missing_users = []
+        for user in users:
+            points[user.id] = Gradebook.get_cached_points(course.id, user.id)
+            if points[user.id] is None:
+                missing_users.append(user)
+        if missing_users:
+            stacks = list(Stack.objects.filter(course=course))
+            for user_id, progress in CourseProgress.for_users(course, missing_users).items():
+                points[user_id] = Gradebook.store_points(course.id, user_id, progress, stacks)
+        return points
+
+    @staticmethod
+    def get_cached_points(course_id, user_id):
+        entry = Gradebook.entries.get(user_id, {}).get(course_id)
+        if entry is None or entry[0] < datetime.now() - Gradebook.max_age:
+            return None
+        return deepcopy(entry[1])
+
+    @staticmethod
+    def store_points(course_id, user_id, progress, stacks):
+        points = Gradebook.compute_points(progress, stacks)
+        Gradebook.entries.setdefault(user_id, {})[course_id] = (datetime.now(), deepcopy(points))
+        return points
+
+    @staticmethod
+    def compute_points(progress, stacks):
+        points = {
+            'course_stacks': [],
+            'evaluated_points_earned_total': 0,
+            'evaluated_points_available_total': 0,
+            'submitted_points_available_total': 0,
+            'started_points_available_total': 0,
+        }
+        for stack in stacks:
+            is_submitted = progress.submitted_by_user(progress.get_stack_final_challenge(stack))
+            is_evaluated = progress.is_evaluated(progress.get_stack_final_challenge(stack))
+            is_started = progress.is_started(progress.get_stack_first_challenge(stack))
+            is_blocked = progress.is_blocked(stack)
+            points_available = progress.get_points_available(stack)
+            points_earned = progress.get_points_earned(stack)
+            points['course_stacks'].append({
+                'stack': stack,
+                'is_started': is_started,
+                'is_submitted': is_submitted,
+                'is_evaluated': is_evaluated,
+                'is_blocked': is_blocked,
+                'points_earned': points_earned,
+                'points_available': points_available,
+                'status': progress.get_stack_status_text(stack),
+            })
+            if is_evaluated:
+                # skip adding available points to totals for evaluations with 0 points
+                if points_earned == 0:
+                    continue
+                points['evaluated_points_earned_total'] += points_earned
+                points['evaluated_points_available_total'] += points_available
+                continue
+            if is_submitted:
+                points['submitted_points_available_total'] += points_available
+                continue
+            if is_started and not is_blocked:
+                points['started_points_available_total'] += points_available
+        return points
+
+    @staticmethod
+    def invalidate_user(user_id):
+        Gradebook.entries.pop(user_id, None)
+
+    @staticmethod
+    def invalidate_elaboration_user(elaboration_id):
+        if not Gradebook.entries:
+            return
+        user_id = Elaboration.objects.filter(id=elaboration_id).values_list('user_id', flat=True).first()
+        Gradebook.invalidate_user(user_id)
+
+    @staticmethod
+    def invalidate():
+        Gradebook.entries.clear()
+
+
+@receiver(post_save, sender=Elaboration)
+@receiver(post_delete, sender=Elaboration)
+@receiver(post_save, sender=CourseUserRelation)
+@receiver(post_delete, sender=CourseUserRelation)
+def gradebook_user_change_handler(sender, instance, **kwargs):
+    Gradebook.invalidate_user(instance.user_id)
+
+
+@receiver(post_save, sender=Review)
+@receiver(post_delete, sender=Review)
+def gradebook_review_change_handler(sender, instance, **kwargs):
+    Gradebook.invalidate_user(instance.reviewer_id)
+    Gradebook.invalidate_elaboration_user(instance.elaboration_id)
+
+
+@receiver(post_save, sender=Evaluation)
+@receiver(post_delete, sender=Evaluation)
+def gradebook_evaluation_change_handler(sender, instance, **kwargs):
+    Gradebook.invalidate_elaboration_user(instance.submission_id)
+
+
+@receiver(post_save, sender=UploadFile)
+@receiver(post_delete, sender=UploadFile)
+def gradebook_upload_change_handler(sender, instance, **kwargs):
+    Gradebook.invalidate_elaboration_user(instance.elaboration_id)
+
+
+@receiver(post_save, sender=Stack)
+@receiver(post_delete, sender=Stack)
+def gradebook_stack_change_handler(sender, **kwargs):
+    Gradebook.invalidate()
@@ -9,7 +9,7 @@ from django.test import TestCase
 from AuroraUser.models import AuroraUser
 from Stack.models import Stack, StackChallengeRelation
 from Course.models import Course, CourseUserRelation
-from Challenge.models import Challenge
+from Challenge.models import Challenge, CourseProgress, ChallengeChainIndex, Gradebook
 from ReviewQuestion.models import ReviewQuestion
 from Elaboration.models import Elaboration
 from Evaluation.models import Evaluation
@@ -735,4 +735,144 @@ class ChallengeTest(TestCase):
                    submission_time=datetime.now()).save()
         assert challenge2.get_status(user1) == Challenge.EVALUATED
 
+    def test_course_progress(self):
+        challenge1 = self.challenge
+        self.create_challenge()
+        challenge2 = self.challenge
+        challenge2.prerequisite = challenge1
+        challenge2.save()
+        user1 = self.users[0]
+        user2 = self.users[1]
+        user3 = self.users[2]
+        user4 = self.users[3]
+        assert CourseProgress(self.course, user1).get_status(challenge1) == Challenge.NOT_STARTED
+        elaboration1 = Elaboration(challenge=challenge1, user=user1, elaboration_text="test")
+        elaboration1.save()
+        assert CourseProgress(self.course, user1).get_status(challenge1) == Challenge.NOT_SUBMITTED
+        elaboration1.submission_time = datetime.now()
+        elaboration1.save()
+        for user in [user2, user3, user4]:
+            elaboration = Elaboration(challenge=challenge1, user=user, elaboration_text="test",
+                                      submission_time=datetime.now())
+            elaboration.save()
+            Review(elaboration=elaboration, submission_time=datetime.now(), reviewer=user1,
+                   appraisal=Review.SUCCESS).save()
+        Review(elaboration=elaboration1, submission_time=datetime.now(), reviewer=user2,
+               appraisal=Review.SUCCESS).save()
+        progress = CourseProgress(self.course, user1)
+        assert progress.get_status(challenge1) == Challenge.DONE_MISSING_PEER_REVIEW
+        assert progress.get_status(challenge2) == Challenge.NOT_ENABLED
+        Review(elaboration=elaboration1, submission_time=datetime.now(), reviewer=user3,
+               appraisal=Review.NOTHING).save()
+        progress = CourseProgress(self.course, user1)
+        assert progress.get_status(challenge1) == Challenge.BLOCKED_BAD_REVIEW
+        assert progress.is_blocked(self.stack)
+        assert progress.count_received_reviews(challenge1, Review.NOTHING) == 1
+        for challenge in [challenge1, challenge2]:
+            assert progress.get_status(challenge) == challenge.get_status(user1)
+            assert progress.is_enabled_for_user(challenge) == challenge.is_enabled_for_user(user1)
+
+    def test_course_progress_query_count(self):
+        challenge1 = self.challenge
+        self.create_challenge()
+        challenge2 = self.challenge
+        challenge2.prerequisite = challenge1
+        challenge2.save()
+        user1 = self.users[0]
+        Elaboration(challenge=challenge1, user=user1, elaboration_text="test", submission_time=datetime.now()).save()
+        with self.assertNumQueries(8):
+            progress = CourseProgress(self.course, user1)
+        with self.assertNumQueries(0):
+            for challenge in [challenge1, challenge2]:
+                progress.get_status(challenge)
+            progress.get_stack_status_text(self.stack)
+
+    def test_gradebook(self):
+        challenge1 = self.challenge
+        challenge1.points = 5
+        challenge1.save()
+        self.create_challenge()
+        challenge2 = self.challenge
+        challenge2.prerequisite = challenge1
+        challenge2.points = 10
+        challenge2.save()
+        user1 = self.users[0]
+        user2 = self.users[1]
+        final_elaboration = Elaboration(challenge=challenge2, user=user1, elaboration_text="test",
+                                        submission_time=datetime.now())
+        final_elaboration.save()
+        Elaboration(challenge=challenge1, user=user2, elaboration_text="test").save()
+
+        with self.assertNumQueries(10):
+            course_points = Gradebook.get_course_points(self.course)
+        assert set(course_points) == set(user.id for user in self.users)
+        with self.assertNumQueries(0):
+            points = Gradebook.get_user_points(self.course, user1)
+        assert points == course_points[user1.id]
+        assert points['submitted_points_available_total'] == 15
+        assert course_points[user2.id]['started_points_available_total'] == 15
+        assert course_points[user2.id]['course_stacks'][0]['is_started']
+
+        Evaluation(submission=final_elaboration, tutor=self.users[3], evaluation_points=12,
+                   submission_time=datetime.now()).save()
+        points = Gradebook.get_user_points(self.course, user1)
+        assert points['evaluated_points_earned_total'] == 12
+        assert points['evaluated_points_available_total'] == 15
+        assert points['submitted_points_available_total'] == 0
+        assert points['course_stacks'][0]['is_evaluated']
+        assert points['course_stacks'][0]['points_earned'] == self.stack.get_points_earned(user1)
+        with self.assertNumQueries(0):
+            Gradebook.get_user_points(self.course, user2)
+
+        # changes to the returned points stay with the caller
+        points['course_stacks'][0]['stack'].title = 'changed'
+        points['course_stacks'].pop()
+        points['evaluated_points_earned_total'] = 0
+        points = Gradebook.get_user_points(self.course, user1)
+        assert points['course_stacks'][0]['stack'].title == self.stack.title
+        assert len(points['course_stacks']) == 1 and points['evaluated_points_earned_total'] == 12
+
+    def test_chain_index(self):
+        challenge1 = self.challenge
+        self.create_challenge()
+        challenge2 = self.challenge
+        challenge2.prerequisite = challenge1
+        challenge2.save()
+        self.create_challenge()
+        challenge3 = self.challenge
+        challenge3.prerequisite = challenge2
+        challenge3.save()
+        ChallengeChainIndex.for_course(self.course.id)
+        with self.assertNumQueries(0):
+            assert challenge2.get_chain_position() == 1
+            assert challenge3.get_first_challenge() == challenge1
+            assert challenge1.get_final_challenge() == challenge3
+            assert not challenge2.is_final_challenge()
+            assert self.stack.get_first_challenge() == challenge1
+            assert self.stack.get_final_challenge() == challenge3
+        challenge3.prerequisite = None
+        challenge3.save()
+        assert challenge2.is_final_challenge()
+        assert challenge3.get_chain_position() == 0
+        assert self.stack.get_final_challenge() == challenge2
 
+    def test_course_final_challenge_ids(self):
+        challenge1 = self.challenge
+        self.create_challenge()
+        challenge2 = self.challenge
+        challenge2.prerequisite = challenge1
+        challenge2.save()
+        other_course = Course(title='other', short_title='other', description='other', course_number='other')
+        other_course.save()
+        other_challenge = Challenge(title='other', subtitle='other', description='other', course=other_course)
+        other_challenge.save()
+        with self.assertNumQueries(1):
+            assert Challenge.get_course_final_challenge_ids(self.course) == (challenge2.id,)
+        with self.assertNumQueries(0):
+            assert Challenge.get_course_final_challenge_ids(self.course) == (challenge2.id,)
+        assert set(Challenge.get_final_challenge_ids()) == {challenge2.id, other_challenge.id}
+        self.create_challenge()
+        challenge3 = self.challenge
+        challenge3.prerequisite = challenge2
+        challenge3.save()
+        assert Challenge.get_course_final_challenge_ids(self.course) == (challenge3.id,)
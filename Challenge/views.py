@@ -9,7 +9,7 @@ from Stack.models import Stack, StackChallengeRelation
 from Evaluation.models import Evaluation
 from Review.models import Review, ReviewEvaluation
 from Elaboration.models import Elaboration
-from Challenge.models import Challenge
+from Challenge.models import Challenge, CourseProgress
 from ReviewQuestion.models import ReviewQuestion
 from ReviewAnswer.models import ReviewAnswer
 
@@ -27,49 +27,46 @@ def create_context_stack(request, course_short_title):
         return data
 
     user = RequestContext(request)['user']
-    context_stack = Stack.objects.get(pk=request.GET.get('id'))
+    context_stack = Stack.objects.select_related('course').get(pk=request.GET.get('id'))
+    progress = CourseProgress(context_stack.course, user)
     data['stack'] = context_stack
-    data['stack_blocked'] = context_stack.is_blocked(user)
-    stack_challenges = StackChallengeRelation.objects.all().filter(stack=context_stack)
+    data['stack_blocked'] = progress.is_blocked(context_stack)
     challenges_active = []
     challenges_inactive = []
-    for stack_challenge in stack_challenges:
-        challenge = stack_challenge.challenge
+    for challenge in progress.get_challenges(context_stack):
         # challenges are not enabled for the user should be inactive
-        if not challenge.is_enabled_for_user(user):
+        if not progress.is_enabled_for_user(challenge):
             # except final challenges where the previous challenge has enough user reviews
-            if not (challenge.is_final_challenge() and
-                    challenge.prerequisite.has_enough_user_reviews(user)):
+            if not (progress.is_final_challenge(challenge) and
+                    progress.has_enough_user_reviews(progress.get_prerequisite(challenge))):
                 challenges_inactive.append(challenge)
                 continue
 
         reviews = []
-        for review in challenge.get_reviews_written_by_user(user):
+        for review in progress.get_reviews_written_by_user(challenge):
             reviews.append({
                 'review': review,
                 'submitted': review.submission_time is not None
             })
         for i in range(Challenge.reviews_per_challenge - len(reviews)):
             reviews.append({})
-        submitted = challenge.submitted_by_user(user)
+        submitted = progress.submitted_by_user(challenge)
         submission_time = None
         if submitted:
-            submission_time = challenge.get_elaboration(user).submission_time
+            submission_time = progress.get_elaboration(challenge).submission_time
         challenge_active = {
             'challenge': challenge,
             'submitted': submitted,
             'submission_time': submission_time,
             'reviews': reviews,
-            'status': challenge.get_status_text(user)
+            'status': progress.get_status_text(challenge)
         }
-        elaboration = Elaboration.objects.filter(challenge=challenge, user=user)
-        if elaboration:
-            elaboration = elaboration[0]
-            challenge_active['success'] = len(elaboration.get_success_reviews())
-            challenge_active['nothing'] = len(elaboration.get_nothing_reviews())
-            challenge_active['fail'] = len(elaboration.get_fail_reviews())
-            challenge_active['awesome'] = len(elaboration.get_awesome_reviews())
-            evaluation = elaboration.get_evaluation()
+        if progress.get_elaboration(challenge):
+            challenge_active['success'] = progress.count_received_reviews(challenge, Review.SUCCESS)
+            challenge_active['nothing'] = progress.count_received_reviews(challenge, Review.NOTHING)
+            challenge_active['fail'] = progress.count_received_reviews(challenge, Review.FAIL)
+            challenge_active['awesome'] = progress.count_received_reviews(challenge, Review.AWESOME)
+            evaluation = progress.get_evaluation(challenge)
             if evaluation:
                 challenge_active['points'] = evaluation.evaluation_points
         challenges_active.append(challenge_active)
@@ -89,19 +86,20 @@ def challenges(request, course_short_title=None):
 
     user = RequestContext(request)['user']
     course_stacks = Stack.objects.all().filter(course=course)
+    progress = CourseProgress(course, user)
     data['course_stacks'] = []
     for stack in course_stacks:
-        submitted = stack.get_final_challenge().submitted_by_user(user)
+        final_challenge = progress.get_stack_final_challenge(stack)
+        submitted = progress.submitted_by_user(final_challenge)
         submission_time = None
         if submitted:
-            print(submitted)
-            submission_time = stack.get_final_challenge().get_elaboration(user).submission_time
+            submission_time = progress.get_elaboration(final_challenge).submission_time
         data['course_stacks'].append({
             'stack': stack,
             'submitted': submitted,
             'submission_time': submission_time,
-            'status': stack.get_status_text(user),
-            'points': stack.get_points_earned(user)
+            'status': progress.get_stack_status_text(stack),
+            'points': progress.get_points_earned(stack)
         })
     return render_to_response('challenges.html', data, context_instance=RequestContext(request))
 
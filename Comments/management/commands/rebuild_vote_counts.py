@@ -0,0 +1,59 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.db.models import Count
+
+from Comments.models import Comment, Vote
+
+
+class Command(BaseCommand):
+    help = 'Rebuilds the vote counters and scores of all comments from the votes'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--verify',
+                    action='store_true',
+                    dest='verify',
+                    default=False,
+                    help='Only report comments with wrong counters, do not change anything'),
+    )
+
+    def handle(self, *args, **options):
+        with transaction.atomic():
+            mismatches = rebuild_vote_counts(fix=not options['verify'])
+
+        for comment_id, stored, expected in mismatches:
+            self.stdout.write("comment %s: stored %s, expected %s" % (comment_id, stored, expected))
+
+        if options['verify']:
+            if mismatches:
+                raise CommandError("%s comments have wrong vote counters" % len(mismatches))
+            self.stdout.write("all vote counters are correct")
+        else:
+            self.stdout.write("fixed vote counters of %s comments" % len(mismatches))
+
+
+def rebuild_vote_counts(fix=True):
+    expected_counts = {}
+    votes = Vote.objects.values('comment_id', 'direction').annotate(count=Count('id'))
+    for row in votes:
+        field = 'up_votes' if row['direction'] == Vote.UP else 'down_votes'
+        expected_counts.setdefault(row['comment_id'], {})[field] = row['count']
+
+    mismatches = []
+    counter_fields = Comment.counter_fields
+    stored_counts = Comment.objects.values_list('id', *counter_fields).iterator()
+    for row in stored_counts:
+        comment_id = row[0]
+        stored = dict(zip(counter_fields, row[1:]))
+        counts = expected_counts.get(comment_id, {})
+        expected = {
+            'up_votes': counts.get('up_votes', 0),
+            'down_votes': counts.get('down_votes', 0),
+            'score': counts.get('up_votes', 0) - counts.get('down_votes', 0),
+        }
+        if stored != expected:
+            mismatches.append((comment_id, stored, expected))
+            if fix:
+                Comment.objects.filter(id=comment_id).update(**expected)
+    return mismatches
@@ -1,8 +1,12 @@
-from django.db import models as models
+from django.db import models as models, transaction, IntegrityError
 from django.contrib.contenttypes.models import ContentType
 from django.contrib.contenttypes import generic
-from django.db.models import Q, Count, Max
+from django.db.models import Q, Count, Max, F
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+from datetime import datetime, timedelta
 import re
+import threading
 from taggit.managers import TaggableManager
 
 
@@ -31,7 +35,7 @@ class CommentList(models.Model):
                 content_type__pk=ref_type.id,
                 object_id=ref_object.id)
         except CommentList.DoesNotExist:
-            revision = CommentList.objects.create(content_object=ref_object)
+            revision = CommentList.create_or_get(ref_object)
 
         return revision
 
@@ -43,17 +47,169 @@ class CommentList(models.Model):
                 object_id=ref_id)
         except CommentList.DoesNotExist:
             ref_obj = Comment.ref_id_type_to_obj(ref_id, ref_type)
-            comment_list = CommentList.objects.create(content_object=ref_obj)
+            comment_list = CommentList.create_or_get(ref_obj)
 
         return comment_list
 
+    @staticmethod
+    def create_or_get(ref_object):
+        # concurrent requests may create the list at the same time, the unique constraint lets one of them win
+        try:
+            with transaction.atomic():
+                return CommentList.objects.create(content_object=ref_object)
+        except IntegrityError:
+            ref_type = ContentType.objects.get_for_model(ref_object)
+            return CommentList.objects.get(content_type__pk=ref_type.id, object_id=ref_object.id)
+
     @staticmethod
     def get_by_comment(comment):
-        return CommentList.get_by_ref_numbers(comment.object_id, comment.content_type.id)
+        return CommentList.get_by_ref_numbers(comment.object_id, comment.content_type_id)
+
+    @staticmethod
+    def get_revisions(ref_numbers):
+        """
+        Maps (ref_id, ref_type) pairs to the revision of their comment list with one query,
+        lists that do not exist yet have revision 0.
+        """
+        if not ref_numbers:
+            return {}
+        query = Q()
+        for ref_id, ref_type in ref_numbers:
+            query |= Q(object_id=ref_id, content_type_id=ref_type)
+        revisions = dict(((ref_id, ref_type), 0) for ref_id, ref_type in ref_numbers)
+        comment_lists = CommentList.objects.filter(query).values_list('object_id', 'content_type', 'revision')
+        for ref_id, ref_type, revision in comment_lists:
+            revisions[(ref_id, ref_type)] = revision
+        return revisions
+
+    @staticmethod
+    def get_uris(ref_numbers):
+        """
+        Maps (ref_id, ref_type) pairs to the uri of their comment list, lists that do not exist yet are created.
+        """
+        if not ref_numbers:
+            return {}
+        query = Q()
+        for ref_id, ref_type in ref_numbers:
+            query |= Q(object_id=ref_id, content_type_id=ref_type)
+        comment_lists = CommentList.objects.filter(query).values_list('object_id', 'content_type', 'uri')
+        uris = dict(((ref_id, ref_type), uri) for ref_id, ref_type, uri in comment_lists)
+        for ref_id, ref_type in ref_numbers:
+            if (ref_id, ref_type) not in uris:
+                uris[(ref_id, ref_type)] = CommentList.get_by_ref_numbers(ref_id, ref_type).uri
+        return uris
+
+    @staticmethod
+    def increment_all(ref_numbers):
+        """
+        Increments the revisions of the comment lists of the (ref_id, ref_type) pairs with one update.
+        """
+        if not ref_numbers:
+            return
+        query = Q()
+        for ref_id, ref_type in ref_numbers:
+            query |= Q(object_id=ref_id, content_type_id=ref_type)
+        CommentList.objects.filter(query).update(revision=F('revision') + 1)
+        CommentListNotifier.notify()
 
     def increment(self):
-        self.revision += 1
-        self.save()
+        # a read-modify-write would lose the increments of concurrent requests; the updated row stays
+        # locked until the commit, so the revision read back is the one of this increment
+        with transaction.atomic():
+            CommentList.objects.filter(id=self.id).update(revision=F('revision') + 1)
+            self.revision = CommentList.objects.values_list('revision', flat=True).get(id=self.id)
+        CommentListNotifier.notify()
+
+
+class CommentListNotifier:
+    """
+    Wakes the long polling requests waiting in this process whenever a comment list revision
+    is incremented.
+
+    Waiters only learn that some list changed and read their revisions from the database again.
+    Changes made by other processes, or not committed yet when the notification was sent, are
+    seen at the next recheck of the waiter.
+    """
+
+    condition = threading.Condition()
+    generation = 0
+
+    @staticmethod
+    def notify():
+        with CommentListNotifier.condition:
+            CommentListNotifier.generation += 1
+            CommentListNotifier.condition.notify_all()
+
+    @staticmethod
+    def wait(generation, timeout):
+        """
+        Blocks until a list is incremented after generation was read or timeout seconds passed,
+        returns the current generation.
+        """
+        with CommentListNotifier.condition:
+            CommentListNotifier.condition.wait_for(lambda: CommentListNotifier.generation != generation, timeout)
+            return CommentListNotifier.generation
+
+
+class CommentListFragments:
+    """
+    Rendered comment lists, kept in process for one revision of each list.
+
+    All staff members see the same list, and so do all students who did not write a comment in it,
+    so every revision is rendered once per viewer class; authors get renders of their own. The votes of
+    the requester are not part of the cached html. Entries expire after max_age, so relative post dates
+    and changed profiles are picked up although they do not change the revision. Beyond max_entries the
+    oldest entries are dropped.
+    """
+
+    max_age = timedelta(minutes=1)
+    max_entries = 1000
+    entries = {}
+
+    @staticmethod
+    def get_entry(ref_id, ref_type, revision):
+        key = (int(ref_id), int(ref_type))
+        entry = CommentListFragments.entries.get(key)
+        if entry is not None and entry['revision'] == revision and \
+                entry['time'] > datetime.now() - CommentListFragments.max_age:
+            return entry
+
+        authors = set(Comment.objects.filter(object_id=ref_id, content_type_id=ref_type)
+                      .values_list('author_id', flat=True))
+        entry = {'revision': revision, 'time': datetime.now(), 'authors': authors, 'fragments': {}}
+        if len(CommentListFragments.entries) >= CommentListFragments.max_entries:
+            CommentListFragments.remove_expired()
+        if len(CommentListFragments.entries) >= CommentListFragments.max_entries:
+            # nothing expired yet, the lists not rendered for the longest time make room for a tenth of the cache
+            CommentListFragments.remove_oldest(CommentListFragments.max_entries // 10 + 1)
+        current = CommentListFragments.entries.get(key)
+        # a slow request must not replace the renders of a newer revision
+        if current is None or current['revision'] <= revision:
+            CommentListFragments.entries[key] = entry
+        return entry
+
+    @staticmethod
+    def get_viewer_class(entry, user):
+        if user.id in entry['authors']:
+            return 'author_%s' % user.id
+        return 'staff' if user.is_staff else 'student'
+
+    @staticmethod
+    def remove_expired():
+        expired = datetime.now() - CommentListFragments.max_age
+        for key, entry in list(CommentListFragments.entries.items()):
+            if entry['time'] < expired:
+                CommentListFragments.entries.pop(key, None)
+
+    @staticmethod
+    def remove_oldest(count):
+        entries = sorted(list(CommentListFragments.entries.items()), key=lambda item: item[1]['time'])
+        for key, entry in entries[:count]:
+            CommentListFragments.entries.pop(key, None)
+
+    @staticmethod
+    def invalidate():
+        CommentListFragments.entries.clear()
 
 
 class Vote(models.Model):
@@ -68,6 +224,25 @@ class Vote(models.Model):
     class Meta:
         unique_together = ('voter', 'comment')
 
+    def __init__(self, *args, **kwargs):
+        super(Vote, self).__init__(*args, **kwargs)
+        # votes loaded from the database are already counted on their comment
+        self.counted_direction = None if self.pk is None else self.direction
+
+    def save(self, *args, **kwargs):
+        with transaction.atomic():
+            super(Vote, self).save(*args, **kwargs)
+            if self.direction != self.counted_direction:
+                Comment.update_vote_count(self.comment_id, self.counted_direction, -1)
+                Comment.update_vote_count(self.comment_id, self.direction, 1)
+        self.counted_direction = self.direction
+
+
+@receiver(post_delete, sender=Vote)
+def vote_post_delete_handler(sender, **kwargs):
+    vote = kwargs['instance']
+    Comment.update_vote_count(vote.comment_id, vote.counted_direction, -1)
+
 
 class Comment(models.Model):
     text = models.TextField()
@@ -101,21 +276,67 @@ class Comment(models.Model):
 
     bookmarked_by = models.ManyToManyField('AuroraUser.AuroraUser', related_name='bookmarked_comments_set')
 
+    # number of votes and up_votes - down_votes, maintained by Vote.save and the Vote post_delete handler
+    up_votes = models.IntegerField(default=0)
+    down_votes = models.IntegerField(default=0)
+    score = models.IntegerField(default=0, db_index=True)
+
+    counter_fields = ['up_votes', 'down_votes', 'score']
+    # flags that update_state changes for many comments at once
+    state_fields = ['seen', 'promoted']
+
+    def __init__(self, *args, **kwargs):
+        super(Comment, self).__init__(*args, **kwargs)
+        # tags are only extracted again when the text changed since it was loaded, a deferred text counts as changed
+        self.tagged_text = None if self.pk is None else self.__dict__.get('text')
+
     def save(self, *args, **kwargs):
+        # the vote counters are only written with update() calls,
+        # saving a stale in-memory copy of an existing comment must not overwrite them
+        if not self._state.adding and kwargs.get('update_fields') is None and not kwargs.get('force_insert'):
+            kwargs['update_fields'] = [
+                field.name for field in self._meta.concrete_fields
+                if not field.primary_key and field.name not in Comment.counter_fields
+            ]
         super(Comment, self).save(*args, **kwargs)
-        self.set_tags_from_text()
+        if self.text != self.tagged_text:
+            self.set_tags_from_text()
+            self.tagged_text = self.text
+
+    @staticmethod
+    def update_state(comment_ids, **state):
+        """
+        Sets state fields like seen=True of all given comments with one update and increments the
+        revision of every comment list with a changed comment once. Returns the number of changed comments.
+        """
+        unknown = set(state) - set(Comment.state_fields)
+        if unknown:
+            raise ValueError("not a state field: %s" % ', '.join(sorted(unknown)))
+
+        # comments already in that state neither count as changed nor bump their list
+        changed = Comment.objects.filter(id__in=comment_ids).exclude(**state)
+        with transaction.atomic():
+            ref_numbers = set(changed.values_list('object_id', 'content_type_id'))
+            updated = changed.update(**state)
+            CommentList.increment_all(ref_numbers)
+        return updated
 
-    @property
-    def score(self):
-        up_votes = self.votes.filter(direction=Vote.UP).count()
-        down_votes = self.votes.filter(direction=Vote.DOWN).count()
-        return up_votes - down_votes
+    @staticmethod
+    def update_vote_count(comment_id, direction, delta):
+        if direction is None:
+            return
+        field = 'up_votes' if direction == Vote.UP else 'down_votes'
+        score_delta = delta if direction == Vote.UP else -delta
+        Comment.objects.filter(id=comment_id).update(**{field: F(field) + delta, 'score': F('score') + score_delta})
 
     def responses(self):
-        responses = self.children.order_by('post_date')
-        responses = Comment.filter_visible(responses, self.requester)
-        Comment.set_flags(responses, self.requester)
-        return responses
+        # templates call this several times per comment, the flagged responses are loaded once
+        if getattr(self, 'flagged_responses', None) is None:
+            responses = self.children.order_by('post_date')
+            responses = Comment.filter_visible(responses, self.requester)
+            Comment.set_flags(responses, self.requester)
+            self.flagged_responses = responses
+        return self.flagged_responses
 
     def __str__(self):
         return str(self.id) + ": " + self.text[:30]
@@ -146,7 +367,7 @@ class Comment(models.Model):
         return Comment.objects.filter(author=user, promoted=True).count()
 
     @staticmethod
-    def query_top_level_sorted(ref_object_id, ref_type_id, requester, newest_last=False):
+    def query_top_level_sorted(ref_object_id, ref_type_id, requester, newest_last=False, by_score=False):
         queryset_all = Comment.objects.filter(
             parent=None,
             content_type__pk=ref_type_id,
@@ -154,7 +375,9 @@ class Comment(models.Model):
 
         visible = Comment.filter_visible(queryset_all, requester)
         visible = Comment.filter_deleted_trees(visible)
-        if newest_last:
+        if by_score:
+            visible = visible.order_by('-score', '-post_date')
+        elif newest_last:
             visible = visible.order_by('post_date')
         else:
             visible = visible.order_by('-post_date')
@@ -168,6 +391,46 @@ class Comment(models.Model):
         Comment.set_flags(visible, requester)
         return visible
 
+    @staticmethod
+    def query_tree(ref_object_id, ref_type_id, requester, newest_last=False, by_score=False):
+        """
+        Returns the top level comments of query_top_level_sorted with their flagged responses attached.
+
+        All comments of the reference object visible to the requester are loaded in one query
+        (plus the three of set_flags), the threads are assembled and pruned in memory.
+        """
+        queryset = Comment.objects.filter(
+            content_type__pk=ref_type_id,
+            object_id=ref_object_id)
+        comments = list(
+            Comment.filter_visible(queryset, requester)
+            .select_related('author', 'deleter')
+            .order_by('post_date')
+        )
+        Comment.set_flags(comments, requester)
+
+        responses = {}
+        for comment in comments:
+            if comment.parent_id is not None:
+                responses.setdefault(comment.parent_id, []).append(comment)
+
+        top_level = []
+        for comment in comments:
+            if comment.parent_id is not None:
+                continue
+            comment.flagged_responses = responses.get(comment.id, [])
+            # deleted threads are only shown while they have responses left
+            if comment.deleter_id is not None and all(response.deleter_id is not None
+                                                      for response in comment.flagged_responses):
+                continue
+            top_level.append(comment)
+
+        if by_score:
+            top_level.sort(key=lambda comment: (comment.score, comment.post_date), reverse=True)
+        elif not newest_last:
+            top_level.reverse()
+        return top_level
+
     @staticmethod
     def query_all(ref_object_id, ref_type_id, requester):
         queryset = Comment.objects.filter(
@@ -198,18 +461,26 @@ class Comment(models.Model):
 
     @staticmethod
     def set_flags(comment_set, requester):
-        for comment in comment_set:
-            comment.requester = requester
-            # comment.set_visibility_flag(requester)
-            comment.bookmarked = True if comment.bookmarked_by.filter(pk=requester.id).exists() else False
+        # evaluates comment_set once, the flags live on its cached instances
+        comments = list(comment_set)
+        if not comments:
+            return
+        comment_ids = [comment.id for comment in comments]
 
-            comment.uri = CommentList.get_by_comment(comment).uri
+        bookmarked_ids = set(
+            requester.bookmarked_comments_set.filter(id__in=comment_ids).values_list('id', flat=True)
+        )
+        votes = dict(Vote.objects.filter(comment__in=comment_ids, voter=requester).values_list('comment', 'direction'))
+        uris = CommentList.get_uris(set((comment.object_id, comment.content_type_id) for comment in comments))
 
-            try:
-                vote = Vote.objects.get(comment=comment, voter=requester)
-                comment.voted = 'upvoted' if vote.direction == vote.UP else 'downvoted'
-            except Vote.DoesNotExist:
+        for comment in comments:
+            comment.requester = requester
+            comment.bookmarked = comment.id in bookmarked_ids
+            comment.uri = uris[(comment.object_id, comment.content_type_id)]
+            if comment.id not in votes:
                 comment.voted = ''
+            else:
+                comment.voted = 'upvoted' if votes[comment.id] == Vote.UP else 'downvoted'
 
     def set_visibility_flag(self, requester):
         self.visible = False
@@ -243,14 +514,9 @@ class Comment(models.Model):
 
     @staticmethod
     def filter_deleted_trees(comment_set):
-        # for every deleted parent
-        for comment in comment_set.exclude(deleter=None):
-            # if not deleted responses <= 0
-            if comment.children.filter(deleter=None).count() <= 0:
-                # remove parent from queryset
-                comment_set = comment_set.exclude(id=comment.id)
-
-        return comment_set
+        # deleted parents stay as long as they have responses that are not deleted
+        parents_with_responses = Comment.objects.filter(parent__isnull=False, deleter=None).values('parent')
+        return comment_set.filter(Q(deleter=None) | Q(id__in=parents_with_responses))
 
     @staticmethod
     def filter_visible(queryset, requester):
@@ -285,12 +551,37 @@ class CommentsConfig(models.Model):
         CommentsConfig.objects.create(key='polling_idle',
                                       value='60')
 
+    # polled by every open page, so the values are kept in process for max_age
+    max_age = timedelta(minutes=1)
+    values_cache = {}
+
+    @staticmethod
+    def get_values():
+        cached = CommentsConfig.values_cache.get('values')
+        if cached is not None and cached[0] > datetime.now() - CommentsConfig.max_age:
+            return cached[1]
+
+        values = dict(CommentsConfig.objects.values_list('key', 'value'))
+        CommentsConfig.values_cache['values'] = (datetime.now(), values)
+        return values
+
     @staticmethod
     def get_polling_interval():
-        active = CommentsConfig.objects.get(key='polling_active')
-        idle = CommentsConfig.objects.get(key='polling_idle')
+        values = CommentsConfig.get_values()
+        return (int(values['polling_active']) * CommentsConfig.factor,
+                int(values['polling_idle']) * CommentsConfig.factor)
+
+    @staticmethod
+    def get_long_polling_timeout():
+        """
+        Seconds a long polling request waits for changes, 0 (the default) disables long polling.
+        Every waiting request keeps a worker thread busy, so only enable it on threaded servers.
+        """
+        return int(CommentsConfig.get_values().get('long_polling_timeout', 0))
 
-        return int(active.value) * CommentsConfig.factor, int(idle.value) * CommentsConfig.factor
+    @staticmethod
+    def invalidate():
+        CommentsConfig.values_cache.clear()
 
     def __unicode__(self):
         return self.key
@@ -299,6 +590,12 @@ class CommentsConfig(models.Model):
         return self.key
 
 
+@receiver(post_save, sender=CommentsConfig)
+@receiver(post_delete, sender=CommentsConfig)
+def comments_config_change_handler(sender, **kwargs):
+    CommentsConfig.invalidate()
+
+
 class CommentReferenceObject(models.Model):
     """
     If there is no other Object available this Model can be used to create
@@ -86,6 +86,13 @@ var COMMENTS = (function (my, $, purgsLoadFilter) {
     };
 
     my.registerVoteForCommentList = function ($comment_list) {
+        // the list html is shared by many users, their own votes are sent along in comment_votes
+        $comment_list.find('.comment_votes').each(function () {
+            $.each($(this).data('votes'), function (comment_id, voted) {
+                $comment_list.find('[data-comment_number=' + comment_id + ']').parent('.comment_score').addClass(voted);
+            });
+        }).remove();
+
         $comment_list.find('.vote_up_on').click(function (event) {
             event.preventDefault();
 
@@ -536,9 +543,17 @@ var COMMENTS = (function (my, $, purgsLoadFilter) {
         firstRefId: null,
         lastRefId: null,
 
+        // set by the server, the plain polling stays the fallback when a long polling request fails
+        long_polling: false,
+        current_wait: null,
+
         resetTimer: function () {
             if (!my.POLLING.stopped) {
                 clearTimeout(my.POLLING.current_timeout);
+                if (my.POLLING.long_polling) {
+                    my.waitForCommentLists();
+                    return;
+                }
                 my.POLLING.current_timeout = setTimeout(function () {
                     my.updateCommentLists(true);
                 }, my.POLLING.current_interval);
@@ -546,6 +561,21 @@ var COMMENTS = (function (my, $, purgsLoadFilter) {
         }
     };
 
+    my.handleUpdateResponse = function (json) {
+        var comment_list_updates = json.comment_list_updates;
+        if (comment_list_updates.length > 0) {
+            my.handleCommentListUpdates(comment_list_updates);
+            purgsLoadFilter();
+        }
+        if (json.polling_active_interval) {
+            my.POLLING.active_interval = json.polling_active_interval;
+        }
+        if (json.polling_idle_interval) {
+            my.POLLING.idle_interval = json.polling_idle_interval;
+        }
+        my.POLLING.long_polling = json.long_polling === true;
+    };
+
     my.updateCommentLists = function (keepPolling) {
         var data = {revisions: my.getRevisions()};
 		$('#lindicator').fadeIn(50);
@@ -554,19 +584,7 @@ var COMMENTS = (function (my, $, purgsLoadFilter) {
             data: data,
             type: 'POST',
             dataType: 'json',
-            success: function (json) {
-                var comment_list_updates = json.comment_list_updates;
-                if (comment_list_updates.length > 0) {
-                    my.handleCommentListUpdates(comment_list_updates);
-                    purgsLoadFilter();
-                }
-                if (json.polling_active_interval) {
-                    my.POLLING.active_interval = json.polling_active_interval;
-                }
-                if (json.polling_idle_interval) {
-                    my.POLLING.idle_interval = json.polling_idle_interval;
-                }
-            },
+            success: my.handleUpdateResponse,
             error: function () {
                 my.POLLING.increase_interval();
             },
@@ -583,6 +601,31 @@ var COMMENTS = (function (my, $, purgsLoadFilter) {
 		$('#lindicator').fadeOut(200);
     };
 
+    my.waitForCommentLists = function () {
+        if (my.POLLING.current_wait !== null) {
+            return;
+        }
+        my.POLLING.current_wait = $.ajax({
+            url: my.WAIT_URL,
+            data: {revisions: my.getRevisions()},
+            type: 'POST',
+            dataType: 'json',
+            success: my.handleUpdateResponse,
+            error: function () {
+                my.POLLING.long_polling = false;
+                my.POLLING.increase_interval();
+            },
+            complete: function () {
+                my.POLLING.current_wait = null;
+                my.POLLING.resetTimer();
+            },
+            beforeSend: function (xhr) {
+                var csrftoken = my.getCsrfToken();
+                xhr.setRequestHeader("X-CSRFToken", csrftoken);
+            }
+        });
+    };
+
     my.findCommentListByRef = function (ref_id, ref_type) {
         return $('.comment_list').filter('[data-ref_type=' + ref_type + ']')
             .filter('[data-ref_id=' + ref_id + ']');
@@ -649,6 +692,9 @@ var COMMENTS = (function (my, $, purgsLoadFilter) {
     my.stopPolling = function () {
         clearTimeout(my.POLLING.current_timeout);
         my.POLLING.stopped = true;
+        if (my.POLLING.current_wait !== null) {
+            my.POLLING.current_wait.abort();
+        }
     };
 
     my.startPolling = function () {
@@ -1,7 +1,7 @@
 from django import template
 from django.contrib.contenttypes.models import ContentType
 from Comments.models import Comment, CommentList
-from Comments.views import CommentForm, ReplyForm
+from Comments.views import CommentForm, ReplyForm, render_comment_list_fragment
 from django.template.loader import render_to_string
 from AuroraUser.models import AuroraUser
 
@@ -25,7 +25,6 @@ class CommentListNode(template.Node):
 
             user = context['user']
 
-            queryset = Comment.query_top_level_sorted(ref_object.id, ref_type.id, user, newest_last=self.newest_last)
             revision = CommentList.get_or_create(ref_object).revision
 
             form = CommentForm()
@@ -39,14 +38,17 @@ class CommentListNode(template.Node):
             reply_form.fields['visibility'].initial = Comment.PUBLIC
 
             id_suffix = "_" + str(ref_object.id) + "_" + str(ref_type.id)
-            context.update({'comment_list': queryset,
-                            'form': form,
+            context.update({'form': form,
                             'reply_form': reply_form,
                             'ref_type': ref_type.id,
                             'ref_id': ref_object.id,
                             'id_suffix': id_suffix,
                             'requester': user,
                             'revision': revision})
+            context['comment_list_html'] = render_comment_list_fragment(
+                context['request'], user, ref_object.id, ref_type.id, revision, 'Comments/comment_list.html', context,
+                newest_last=self.newest_last
+            )
 
             return render_to_string(self.template, context)
         except template.VariableDoesNotExist:
@@ -1,5 +1,19 @@
-from django.test import TestCase
-from Comments.models import Comment, CommentReferenceObject
+import html
+from io import StringIO
+import re
+import threading
+import time
+
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.contrib.contenttypes.models import ContentType
+from django.db import connections
+from django.test import TestCase, TransactionTestCase
+from django.test.client import Client, RequestFactory
+import json
+from Comments.models import Comment, CommentReferenceObject, CommentList, CommentListFragments, CommentListNotifier, \
+    CommentsConfig, Vote
+from AuroraProject.test_utils import run_concurrently
 from AuroraUser.models import AuroraUser
 from django.utils import timezone
 import Comments.views as views
@@ -104,6 +118,7 @@ def dummy_user_generator():
 
 class ModelMethodTests(TestCase):
     def setUp(self):
+        CommentListFragments.invalidate()
         self.user_generator = dummy_user_generator()
         self.u1 = next(self.user_generator)
         self.u1.save()
@@ -178,6 +193,256 @@ class ModelMethodTests(TestCase):
         self.assertEquals(objects[0].text, c11.text)
 
 
+    def test_set_flags(self):
+        Vote.objects.create(comment=self.c1, voter=self.u1, direction=Vote.UP)
+        Vote.objects.create(comment=self.c6, voter=self.u1, direction=Vote.DOWN)
+        Vote.objects.create(comment=self.c3, voter=self.u2, direction=Vote.UP)
+        self.c3.bookmarked_by.add(self.u1)
+        comment_list = CommentList.get_or_create(self.ref_object1)
+        comment_list.uri = '/ref_object1'
+        comment_list.save()
+
+        comments = Comment.objects.filter(parent=None).order_by('id')
+        Comment.set_flags(comments, self.u1)
+        assert CommentList.objects.count() == 4
+        comments = Comment.objects.filter(parent=None).order_by('id')
+        # comments, bookmarks, votes and comment lists
+        with self.assertNumQueries(4):
+            Comment.set_flags(comments, self.u1)
+        flags = dict((comment.id, (comment.voted, comment.bookmarked, comment.uri)) for comment in comments)
+        assert flags[self.c1.id] == ('upvoted', False, '/ref_object1')
+        assert flags[self.c3.id] == ('', True, '/ref_object1')
+        assert flags[self.c6.id] == ('downvoted', False, None)
+
+        comment = comments[2]
+        assert comment.id == self.c3.id
+        with self.assertNumQueries(4):
+            responses = comment.responses()
+            assert len(comment.responses()) == len(responses) == 2
+        assert all(response.requester == self.u1 for response in responses)
+
+    def test_vote_counts(self):
+        stale_comment = Comment.objects.get(id=self.c1.id)
+        views.vote_up_on(self.c1, self.u2)
+        views.vote_up_on(self.c1, self.u3)
+        views.vote_down_on(self.c1, self.s1)
+        comment = Comment.objects.get(id=self.c1.id)
+        assert (comment.up_votes, comment.down_votes, comment.score) == (2, 1, 1)
+
+        # voting against an own vote takes it back
+        views.vote_down_on(self.c1, self.u2)
+        comment = Comment.objects.get(id=self.c1.id)
+        assert (comment.up_votes, comment.down_votes, comment.score) == (1, 1, 0)
+
+        # editing a stale copy keeps the counters
+        stale_comment.text = "edited"
+        stale_comment.save()
+        comment = Comment.objects.get(id=self.c1.id)
+        assert comment.text == "edited" and comment.up_votes == 1
+
+        views.vote_up_on(self.c3, self.u1)
+        ranked = Comment.query_top_level_sorted(self.ref_object1.id, self.c1.content_type_id, self.u1, by_score=True)
+        assert ranked[0].id == self.c3.id
+
+        call_command('rebuild_vote_counts', verify=True, stdout=StringIO())
+        Comment.objects.filter(id=self.c1.id).update(score=5)
+        with self.assertRaises(CommandError):
+            call_command('rebuild_vote_counts', verify=True, stdout=StringIO())
+        call_command('rebuild_vote_counts', stdout=StringIO())
+        assert Comment.objects.get(id=self.c1.id).score == 0
+        call_command('rebuild_vote_counts', verify=True, stdout=StringIO())
+
+    def test_query_tree(self):
+        for comment in [self.c2, self.c3, self.c7, self.r8]:
+            comment.deleter = self.s1
+            comment.delete_date = timezone.now()
+            comment.save()
+        create_comment("private note", self.u1, self.ref_object3, parent=self.c6, visibility=Comment.PRIVATE)
+        ref_type_id = self.c1.content_type_id
+
+        for requester in [self.u1, self.u2, self.s1]:
+            for ref_object in [self.ref_object1, self.ref_object3]:
+                for newest_last in [False, True]:
+                    expected = Comment.query_top_level_sorted(ref_object.id, ref_type_id, requester, newest_last)
+                    expected = [(comment.id, [response.id for response in comment.responses()])
+                                for comment in expected]
+                    tree = Comment.query_tree(ref_object.id, ref_type_id, requester, newest_last)
+                    assert [(comment.id, [response.id for response in comment.responses()])
+                            for comment in tree] == expected
+
+        tree = Comment.query_tree(self.ref_object1.id, ref_type_id, self.u1)
+        assert self.c2.id not in [comment.id for comment in tree]
+        assert self.c3.id in [comment.id for comment in tree]
+        # comments, bookmarks, votes and comment lists
+        with self.assertNumQueries(4):
+            tree = Comment.query_tree(self.ref_object3.id, ref_type_id, self.u2)
+            for comment in tree:
+                (comment.author.display_name, comment.voted, comment.uri)
+                for response in comment.responses():
+                    (response.author.display_name, response.voted, response.uri)
+        assert [comment.id for comment in tree] == [self.c8.id, self.c6.id]
+
+    def test_update_comments(self):
+        CommentsConfig.setup()
+        self.u1.set_password('p')
+        self.u1.save()
+        AuroraUser.objects.update(avatar='avatar/default.png')
+        client = Client()
+        assert client.login(username=self.u1.username, password='p')
+        ref_type_id = self.c1.content_type_id
+        CommentList.get_or_create(self.ref_object1).increment()
+        data = {
+            'revisions[0][number]': 1, 'revisions[0][ref_id]': self.ref_object1.id,
+            'revisions[0][ref_type]': ref_type_id,
+            'revisions[1][number]': 0, 'revisions[1][ref_id]': self.ref_object2.id,
+            'revisions[1][ref_type]': ref_type_id,
+        }
+        response = json.loads(client.post('/comment/update/', data).content.decode('utf-8'))
+        assert response['comment_list_updates'] == []
+        assert response['polling_active_interval'] == 5000
+        assert not CommentList.objects.filter(object_id=self.ref_object2.id).exists()
+
+        # session, user and one query for all revisions
+        with self.assertNumQueries(3):
+            client.post('/comment/update/', data)
+
+        CommentList.get_or_create(self.ref_object1).increment()
+        response = json.loads(client.post('/comment/update/', data).content.decode('utf-8'))
+        assert [update['ref_id'] for update in response['comment_list_updates']] == [str(self.ref_object1.id)]
+
+        CommentsConfig.objects.filter(key='polling_active').update(value='7')
+        CommentsConfig.objects.get(key='polling_idle').save()
+        response = json.loads(client.post('/comment/update/', data).content.decode('utf-8'))
+        assert response['polling_active_interval'] == 7000
+
+    def test_wait_comments(self):
+        CommentsConfig.setup()
+        CommentsConfig.objects.create(key='long_polling_timeout', value='5')
+        self.u1.set_password('p')
+        self.u1.save()
+        AuroraUser.objects.update(avatar='avatar/default.png')
+        client = Client()
+        assert client.login(username=self.u1.username, password='p')
+        comment_list = CommentList.get_or_create(self.ref_object1)
+        data = {
+            'revisions[0][number]': comment_list.revision, 'revisions[0][ref_id]': self.ref_object1.id,
+            'revisions[0][ref_type]': self.c1.content_type_id,
+        }
+
+        # the waiting request only touches the database again when it is woken, so the thread may share it
+        shared_connection = connections['default']
+        shared_connection.allow_thread_sharing = True
+
+        def increment():
+            connections[shared_connection.alias] = shared_connection
+            comment_list.increment()
+
+        timer = threading.Timer(0.5, increment)
+        timer.start()
+        start = time.time()
+        response = json.loads(client.post('/comment/wait/', data).content.decode('utf-8'))
+        timer.join()
+        shared_connection.allow_thread_sharing = False
+        assert time.time() - start < 4
+        assert response['long_polling']
+        assert [update['ref_id'] for update in response['comment_list_updates']] == [str(self.ref_object1.id)]
+
+        # an outdated client is answered right away
+        data['revisions[0][number]'] = 0
+        response = json.loads(client.post('/comment/wait/', data).content.decode('utf-8'))
+        assert len(response['comment_list_updates']) == 1
+
+    def test_notifier_wait(self):
+        generation = CommentListNotifier.generation
+        assert CommentListNotifier.wait(generation, 0.01) == generation
+        CommentList.get_or_create(self.ref_object1).increment()
+        assert CommentListNotifier.wait(generation, 10) != generation
+
+    def test_comment_list_fragments(self):
+        u4 = next(self.user_generator)
+        AuroraUser.objects.update(avatar='avatar/default.png')
+        Vote(voter=self.u1, comment=self.c9, direction=Vote.UP).save()
+        Vote(voter=self.u1, comment=self.r10, direction=Vote.DOWN).save()
+        ref_id, ref_type = self.ref_object4.id, self.c9.content_type_id
+        request = RequestFactory().post('/comment/update/')
+
+        def render(user, revision=CommentList.get_or_create(self.ref_object4).revision):
+            context = {'ref_type': ref_type, 'ref_id': ref_id, 'id_suffix': '', 'requester': user,
+                       'revision': revision, 'request': request}
+            return views.render_comment_list_fragment(request, user, ref_id, ref_type, revision,
+                                                      'Comments/comment_list.html', context)
+
+        def votes(rendered):
+            return json.loads(html.unescape(re.search(r'data-votes="([^"]*)"', rendered).group(1)))
+
+        rendered = render(self.u1)
+        assert votes(rendered) == {str(self.c9.id): 'upvoted', str(self.r10.id): 'downvoted'}
+        assert 'comment_score upvoted' not in rendered and 'comment_score downvoted' not in rendered
+
+        # another student only loads their votes
+        with self.assertNumQueries(1):
+            rendered = render(u4)
+        assert self.t9 in rendered and self.rt10 in rendered
+        assert votes(rendered) == {} and 'upvoted' not in rendered and 'downvoted' not in rendered
+        assert 'edit_link' not in rendered and 'comment_promote' not in rendered
+
+        # the render does not depend on the url the list is shown on
+        request = RequestFactory().get('/gsi/challenge?id=%s' % ref_id)
+        with self.assertNumQueries(1):
+            render(u4)
+
+        # staff and authors get renders of their own
+        assert 'comment_promote' in render(self.s1)
+        assert 'edit_link' in render(self.u2)
+
+        create_comment("text10", u4, self.ref_object4)
+        comment_list = CommentList.get_or_create(self.ref_object4)
+        comment_list.increment()
+        rendered = render(self.u1, comment_list.revision)
+        assert "text10" in rendered and votes(rendered)[str(self.c9.id)] == 'upvoted'
+
+    def test_comment_list_fragments_limit(self):
+        max_entries = CommentListFragments.max_entries
+        CommentListFragments.max_entries = 5
+        try:
+            for ref_id in range(1, 21):
+                CommentListFragments.get_entry(ref_id, 1, 0)
+            assert len(CommentListFragments.entries) <= 5
+            # the newest list is kept, the first ones made room
+            assert (20, 1) in CommentListFragments.entries and (1, 1) not in CommentListFragments.entries
+        finally:
+            CommentListFragments.max_entries = max_entries
+
+    def test_update_state(self):
+        lists = [CommentList.get_or_create(ref_object) for ref_object in
+                 (self.ref_object1, self.ref_object2, self.ref_object3)]
+        self.c5.seen = True
+        self.c5.save()
+        comment_ids = [self.c1.id, self.r1.id, self.c3.id, self.c5.id]
+        # the changed lists, the update of the comments and the update of the lists, in a savepoint
+        with self.assertNumQueries(5):
+            assert Comment.update_state(comment_ids, seen=True) == 3
+        assert set(Comment.objects.filter(seen=True).values_list('id', flat=True)) == set(comment_ids)
+        # once per list with a changed comment
+        assert [CommentList.objects.get(id=comment_list.id).revision for comment_list in lists] == [1, 0, 0]
+
+        assert Comment.update_state(comment_ids, seen=True) == 0
+        assert Comment.update_state([self.c5.id], promoted=True, seen=True) == 1
+        assert Comment.objects.get(id=self.c5.id).promoted
+        with self.assertRaises(ValueError):
+            Comment.update_state(comment_ids, text="")
+
+    def test_save_skips_unchanged_tags(self):
+        comment = Comment.objects.get(id=self.c1.id)
+        comment.text = "text1 #exam"
+        comment.save()
+        assert list(comment.tags.names()) == ['#exam']
+        comment = Comment.objects.get(id=self.c1.id)
+        comment.seen = True
+        with self.assertNumQueries(1):
+            comment.save()
+
+
 class TemplateTagTests(TestCase):
     def setUp(self):
         user_generator = dummy_user_generator()
@@ -227,6 +492,36 @@ class TemplateTagTests(TestCase):
     #     self.assertTrue(text_a2 in rendered)
 
 
+class CommentListRevisionTest(TransactionTestCase):
+    def setUp(self):
+        user_generator = dummy_user_generator()
+        self.users = [next(user_generator) for _ in range(20)]
+        self.ref_object = CommentReferenceObject.objects.create(name='ref_object')
+
+    def test_concurrent_comments(self):
+        ref_type = ContentType.objects.get_for_model(self.ref_object).id
+
+        # every commenter loads the list before the barrier lets all of them write
+        def post_comment(user, comment_list):
+            create_comment("text", user, self.ref_object)
+            comment_list.increment()
+            return comment_list.revision
+
+        revisions = run_concurrently(post_comment, self.users,
+                                     prepare=lambda user: CommentList.get_by_ref_numbers(self.ref_object.id, ref_type))
+
+        # every comment moved the revision forward
+        assert sorted(revisions) == list(range(1, len(self.users) + 1))
+        assert CommentList.objects.get(object_id=self.ref_object.id, content_type=ref_type).revision == len(self.users)
+        assert CommentList.objects.filter(object_id=self.ref_object.id, content_type=ref_type).count() == 1
+
+    def test_create_or_get(self):
+        comment_list = CommentList.get_or_create(self.ref_object)
+        # what a request that lost the race to create the list gets
+        assert CommentList.create_or_get(self.ref_object).id == comment_list.id
+        assert CommentList.objects.count() == 1
+
+
 class PersistentTestData:
     """
     for playing around in the shell
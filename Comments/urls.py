@@ -13,6 +13,7 @@ urlpatterns = patterns(
     url(r'^reply/$', views.post_reply, name='reply'),
     url(r'^vote/$', views.vote_on_comment, name='vote'),
     url(r'^update/$', views.update_comments, name='update'),
+    url(r'^wait/$', views.wait_comments, name='wait'),
     url(r'^list_page/$', views.comment_list_page, name='list_page'),
     url(r'^mark_seen/$', views.mark_seen, name='mark_seen'),
     url(r'^lecturer_post/$', views.lecturer_post, name='lecturer_post'),
@@ -9,12 +9,17 @@ from django.views.decorators.http import require_POST, require_GET
 from django.contrib.auth.decorators import login_required
 from django import forms
 from django.utils import timezone
+from django.utils.safestring import mark_safe
 from django.http import HttpResponseRedirect, HttpResponse, HttpResponseForbidden, HttpResponseBadRequest
 from django.contrib.contenttypes.models import ContentType
+from django.db import transaction
+from endless_pagination.utils import get_page_number_from_request
 import json
+import time
 from AuroraUser.models import AuroraUser
 
-from Comments.models import Comment, CommentsConfig, CommentList, Vote, CommentReferenceObject
+from Comments.models import Comment, CommentsConfig, CommentList, CommentListNotifier, CommentListFragments, Vote, \
+    CommentReferenceObject
 from Course.models import Course
 from Notification.models import Notification
 from Slides.models import Slide
@@ -167,7 +172,7 @@ def create_comment(form, request):
 
     if comment_list.uri is None or 'evaluation' in comment_list.uri:
         comment_list.uri = form.cleaned_data['uri']
-        comment_list.save()
+        comment_list.save(update_fields=['uri'])
 
     comment_list.increment()
 
@@ -232,30 +237,33 @@ def vote_on_comment(request):
 
 
 def vote_up_on(comment, voter):
-    try:
-        vote = comment.votes.get(voter=voter)
-        if vote.direction == Vote.DOWN:
-            vote.delete()
+    # Vote.save and the Vote post_delete handler keep the vote counters of the comment up to date
+    with transaction.atomic():
+        try:
+            vote = comment.votes.get(voter=voter)
+            if vote.direction == Vote.DOWN:
+                vote.delete()
+                CommentList.get_by_comment(comment).increment()
+
+            return
+        except Vote.DoesNotExist:
+            Vote.objects.create(direction=Vote.UP, voter=voter, comment=comment)
             CommentList.get_by_comment(comment).increment()
 
-        return
-    except Vote.DoesNotExist:
-        Vote.objects.create(direction=Vote.UP, voter=voter, comment=comment)
-        CommentList.get_by_comment(comment).increment()
-
 
 def vote_down_on(comment, voter):
-    try:
-        vote = comment.votes.get(voter=voter)
-        if vote.direction == Vote.UP:
-            vote.delete()
+    with transaction.atomic():
+        try:
+            vote = comment.votes.get(voter=voter)
+            if vote.direction == Vote.UP:
+                vote.delete()
+                CommentList.get_by_comment(comment).increment()
+
+            return
+        except Vote.DoesNotExist:
+            Vote.objects.create(direction=Vote.DOWN, voter=voter, comment=comment)
             CommentList.get_by_comment(comment).increment()
 
-        return
-    except Vote.DoesNotExist:
-        Vote.objects.create(direction=Vote.DOWN, voter=voter, comment=comment)
-        CommentList.get_by_comment(comment).increment()
-
 
 @require_POST
 @login_required
@@ -293,13 +301,7 @@ def mark_seen(request):
     if not key == "comment_ids[]":
         return HttpResponseBadRequest('No comment ids provided')
 
-    for comment_id in comment_ids:
-        try:
-            comment = Comment.objects.get(id=comment_id)
-            comment.seen = True
-            comment.save()
-        except Comment.DoesNotExist:
-            continue
+    Comment.update_state(comment_ids, seen=True)
 
     return HttpResponse('')
 
@@ -313,14 +315,7 @@ def promote_comment(request):
     if not requester.is_staff:
         return HttpResponseForbidden('You shall not promote!')
 
-    try:
-        comment = Comment.objects.get(id=data['comment_id'])
-    except Comment.DoesNotExist:
-        return HttpResponse('')
-
-    comment.promoted = True if data['value'] == 'true' else False
-    comment.save()
-    CommentList.get_by_comment(comment).increment()
+    Comment.update_state([data['comment_id']], promoted=data['value'] == 'true')
 
     return HttpResponse('')
 
@@ -328,20 +323,56 @@ def promote_comment(request):
 @require_POST
 @login_required
 def update_comments(request):
-    polling_active, polling_idle = CommentsConfig.get_polling_interval()
+    client_revisions = unpack_revisions(request.POST)
+    return comment_updates_response(get_comment_list_updates(request, client_revisions))
 
-    response_data = {'polling_active_interval': polling_active,
-                     'polling_idle_interval': polling_idle}
 
+@require_POST
+@login_required
+def wait_comments(request):
+    """
+    Long polling variant of update_comments: answers as soon as one of the client's comment lists
+    changed or after the long polling timeout, the client then waits again right away.
+    """
+    timeout = CommentsConfig.get_long_polling_timeout()
     client_revisions = unpack_revisions(request.POST)
+    deadline = time.time() + timeout
+    # the notifier only sees changes of this process, so the database is read again every active interval
+    recheck_interval = CommentsConfig.get_polling_interval()[0] / CommentsConfig.factor
+
+    # read before the revisions so a change in between is not missed
+    generation = CommentListNotifier.generation
+    comment_lists = get_comment_list_updates(request, client_revisions)
+    while not comment_lists and time.time() < deadline:
+        generation = CommentListNotifier.wait(generation, min(recheck_interval, deadline - time.time()))
+        comment_lists = get_comment_list_updates(request, client_revisions)
+    return comment_updates_response(comment_lists)
+
+
+def get_comment_list_updates(request, client_revisions):
+    revisions = CommentList.get_revisions(set(
+        (int(client_revision['ref_id']), int(client_revision['ref_type'])) for client_revision in client_revisions
+    ))
 
     comment_lists = []
     for client_revision in client_revisions:
-        comment_list = get_comment_list_update(request, client_revision)
+        revision = revisions[(int(client_revision['ref_id']), int(client_revision['ref_type']))]
+        # the common case: nothing changed, no rendering at all
+        if revision <= int(client_revision['number']):
+            continue
+        comment_list = get_comment_list_update(request, client_revision, revision=revision)
         if comment_list is not None:
             comment_lists.append(comment_list)
+    return comment_lists
+
+
+def comment_updates_response(comment_lists):
+    polling_active, polling_idle = CommentsConfig.get_polling_interval()
 
-    response_data.update({'comment_list_updates': comment_lists})
+    response_data = {'polling_active_interval': polling_active,
+                     'polling_idle_interval': polling_idle,
+                     'long_polling': CommentsConfig.get_long_polling_timeout() > 0,
+                     'comment_list_updates': comment_lists}
     template_response = json.dumps(response_data)
     return HttpResponse(template_response, content_type="application/json")
 
@@ -360,19 +391,18 @@ def comment_list_page(request):
     return HttpResponse(rendered_response)
 
 
-def get_comment_list_update(request, client_revision, template='Comments/comment_list.html'):
+def get_comment_list_update(request, client_revision, template='Comments/comment_list.html', revision=None):
     ref_type = client_revision['ref_type']
     ref_id = client_revision['ref_id']
     user = RequestContext(request)['user']
 
-    revision = CommentList.get_by_ref_numbers(ref_id, ref_type).revision
+    if revision is None:
+        revision = CommentList.get_by_ref_numbers(ref_id, ref_type).revision
 
     if revision > int(client_revision['number']):
-        comment_list = Comment.query_top_level_sorted(ref_id, ref_type, user)
         id_suffix = "_" + str(ref_id) + "_" + str(ref_type)
 
-        context = {'comment_list': comment_list,
-                   'ref_type': ref_type,
+        context = {'ref_type': ref_type,
                    'ref_id': ref_id,
                    'id_suffix': id_suffix,
                    'requester': user,
@@ -382,11 +412,43 @@ def get_comment_list_update(request, client_revision, template='Comments/comment
         return {
             'ref_id': ref_id,
             'ref_type': ref_type,
-            'comment_list': render_to_string(template, context)
+            'comment_list': render_comment_list_fragment(request, user, ref_id, ref_type, revision, template, context)
         }
     return None
 
 
+def render_comment_list_fragment(request, user, ref_id, ref_type, revision, template, context, newest_last=False):
+    """
+    Renders template with the page of the comment list at revision added to context. The page is shared with
+    the other viewers of the same class (see CommentListFragments), the user's votes are passed next to it in
+    a comment_votes element, which comments.js applies to the vote links.
+    """
+    entry = CommentListFragments.get_entry(ref_id, ref_type, revision)
+    # besides the viewer the html only depends on the shown page and the course of the author links
+    course = context.get('course')
+    key = (CommentListFragments.get_viewer_class(entry, user), newest_last, get_page_number_from_request(request),
+           course.id if course else None)
+    page = entry['fragments'].get(key)
+    if page is None:
+        comment_list = Comment.query_tree(ref_id, ref_type, user, newest_last=newest_last)
+        for comment in comment_list:
+            comment.voted = ''
+            for response in comment.flagged_responses:
+                response.voted = ''
+        context.update({'comment_list': comment_list})
+        page = render_to_string('Comments/comment_list_page.html', context)
+        entry['fragments'][key] = page
+
+    votes = Vote.objects.filter(voter=user, comment__object_id=ref_id,
+                                comment__content_type_id=ref_type).values_list('comment_id', 'direction')
+    votes = dict((comment_id, 'upvoted' if direction == Vote.UP else 'downvoted') for comment_id, direction in votes)
+    page = mark_safe(page + render_to_string('Comments/comment_votes.html', {'votes': json.dumps(votes)}))
+    if template == 'Comments/comment_list_page.html':
+        return page
+    context.update({'comment_list_page_html': page})
+    return mark_safe(render_to_string(template, context))
+
+
 def unpack_revisions(revisions):
     keys = revisions.keys()
     revisions_array = []
@@ -0,0 +1,82 @@
+from itertools import combinations
+from multiprocessing import Pool, cpu_count
+from optparse import make_option
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from Challenge.models import Challenge
+from Elaboration.models import Elaboration, SimilarityBucket, SimilarityPair, similarity_ratio
+
+
+class Command(BaseCommand):
+    args = '[challenge_id ...]'
+    help = 'Indexes the submitted elaborations of the given challenges (default: all) that are not indexed yet, ' \
+           'compares all of them pairwise and stores the similar pairs'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--processes',
+                    type='int',
+                    dest='processes',
+                    default=cpu_count(),
+                    help='Number of worker processes (default: number of cpus)'),
+        make_option('--threshold',
+                    type='float',
+                    dest='threshold',
+                    default=SimilarityPair.THRESHOLD,
+                    help='Only pairs with a higher ratio are stored (default: %s)' % SimilarityPair.THRESHOLD),
+    )
+
+    def handle(self, *args, **options):
+        if args:
+            challenges = Challenge.objects.filter(id__in=args)
+            if len(challenges) != len(set(args)):
+                raise CommandError("unknown challenge id in %s" % ', '.join(args))
+        else:
+            challenges = Challenge.objects.all()
+
+        for challenge in challenges.order_by('id'):
+            start = time.time()
+            indexed = SimilarityBucket.index_challenge(challenge)
+            elaborations, matches = compute_challenge_similarities(challenge, options['processes'],
+                                                                   options['threshold'])
+            self.stdout.write("challenge %s: %s elaborations, %s newly indexed, %s similar pairs (%.1fs)" % (
+                challenge.id, elaborations, indexed, matches, time.time() - start
+            ))
+
+
+def compute_challenge_similarities(challenge, processes, threshold):
+    texts = dict(
+        Elaboration.objects
+        .filter(challenge=challenge, submission_time__isnull=False)
+        .exclude(elaboration_text='')
+        .values_list('id', 'elaboration_text')
+    )
+    pairs = combinations(sorted(texts), 2)
+    # the workers get the texts once and only receive id pairs afterwards
+    pool = Pool(processes, initializer=init_worker, initargs=(texts, threshold))
+    try:
+        ratios = [ratio for ratio in pool.imap_unordered(compare, pairs, chunksize=100) if ratio is not None]
+    finally:
+        pool.close()
+        pool.join()
+    SimilarityPair.replace_challenge_pairs(challenge.id, ratios)
+    return len(texts), len(ratios)
+
+
+worker_texts = {}
+worker_threshold = SimilarityPair.THRESHOLD
+
+
+def init_worker(texts, threshold):
+    global worker_texts, worker_threshold
+    worker_texts = texts
+    worker_threshold = threshold
+
+
+def compare(pair):
+    elaboration_id, other_id = pair
+    ratio = similarity_ratio(worker_texts[elaboration_id], worker_texts[other_id], worker_threshold)
+    if ratio is None:
+        return None
+    return elaboration_id, other_id, ratio
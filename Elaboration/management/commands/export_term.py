@@ -0,0 +1,298 @@
+from collections import OrderedDict
+from multiprocessing import Pool, cpu_count
+from optparse import make_option
+import gzip
+import json
+import os
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+
+from AuroraUser.models import AuroraUser
+from Challenge.models import Challenge
+from Elaboration.models import Elaboration
+from Evaluation.models import Evaluation
+from Review.models import Review
+
+
+class Command(BaseCommand):
+    args = '[export ...]'
+    help = 'Writes the end of term result files users, elabs_final, elabs_nonfinal and reviews (default: all) ' \
+           'as gzipped TSV. An interrupted export continues where it stopped unless --restart is given.'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--output-dir',
+                    dest='output_dir',
+                    default='.',
+                    help='Directory the result files and the checkpoint file are written to (default: .)'),
+        make_option('--processes',
+                    type='int',
+                    dest='processes',
+                    default=cpu_count(),
+                    help='Number of worker processes (default: number of cpus)'),
+        make_option('--chunk-size',
+                    type='int',
+                    dest='chunk_size',
+                    default=1000,
+                    help='Number of rows a worker formats at once (default: 1000)'),
+        make_option('--restart',
+                    action='store_true',
+                    dest='restart',
+                    default=False,
+                    help='Ignore the checkpoints and export everything again'),
+    )
+
+    def handle(self, *args, **options):
+        unknown = set(args) - set(EXPORTS)
+        if unknown:
+            raise CommandError("unknown export %s, choose from %s" % (', '.join(unknown), ', '.join(EXPORTS)))
+        names = [name for name in EXPORTS if name in args] or list(EXPORTS)
+
+        output_dir = options['output_dir']
+        checkpoints = {} if options['restart'] else read_checkpoints(os.path.join(output_dir, CHECKPOINT_FILE))
+        final_challenge_ids = Challenge.get_final_challenge_ids()
+
+        for name in names:
+            start = time.time()
+            if not os.path.exists(os.path.join(output_dir, get_file_name(name))):
+                # the file was deleted or moved away since, export it again
+                checkpoints.pop(name, None)
+            checkpoint = checkpoints.get(name)
+            if checkpoint and checkpoint['done']:
+                self.stdout.write("%s: already exported, %s rows" % (get_file_name(name), checkpoint['rows']))
+                continue
+            resumed_rows = checkpoint['rows'] if checkpoint else 0
+            rows = export(name, output_dir, checkpoints, final_challenge_ids, options['processes'],
+                          options['chunk_size'])
+            self.stdout.write("%s: %s rows%s (%.1fs)" % (
+                get_file_name(name), rows, ", resumed after %s rows" % resumed_rows if resumed_rows else "",
+                time.time() - start
+            ))
+
+
+CHECKPOINT_FILE = 'export_term.checkpoint.json'
+
+
+def get_file_name(name):
+    return '%s.tsv.gz' % name
+
+
+def read_checkpoints(path):
+    if not os.path.exists(path):
+        return {}
+    with open(path) as checkpoint_file:
+        return json.load(checkpoint_file)
+
+
+def write_checkpoints(path, checkpoints):
+    with open(path + '.tmp', 'w') as checkpoint_file:
+        json.dump(checkpoints, checkpoint_file)
+    os.replace(path + '.tmp', path)
+
+
+def export(name, output_dir, checkpoints, final_challenge_ids, processes, chunk_size):
+    # every chunk is compressed to its own gzip member and a file of concatenated members is a valid gzip
+    # file, so an interrupted file is cut back to the last finished chunk and continued from there
+    path = os.path.join(output_dir, get_file_name(name))
+    checkpoint = checkpoints.get(name)
+    if checkpoint is None or not os.path.exists(path):
+        checkpoint = {'last_id': 0, 'size': 0, 'rows': 0, 'done': False}
+    checkpoint_path = os.path.join(output_dir, CHECKPOINT_FILE)
+
+    def save_checkpoint(**values):
+        checkpoint.update(values)
+        checkpoints[name] = checkpoint
+        write_checkpoints(checkpoint_path, checkpoints)
+
+    chunks = get_chunks(EXPORTS[name][0](final_challenge_ids), chunk_size, checkpoint['last_id'])
+    tasks = [(name, first_id, last_id) for first_id, last_id in chunks]
+    with open(path, 'r+b' if checkpoint['size'] else 'wb') as output:
+        output.truncate(checkpoint['size'])
+        output.seek(checkpoint['size'])
+        for last_id, rows, data in map_chunks(tasks, final_challenge_ids, processes):
+            output.write(data)
+            output.flush()
+            os.fsync(output.fileno())
+            save_checkpoint(last_id=last_id, size=output.tell(), rows=checkpoint['rows'] + rows)
+    save_checkpoint(done=True)
+    return checkpoint['rows']
+
+
+def get_chunks(queryset, chunk_size, after_id):
+    # keyset pagination, every chunk is an id range of at most chunk_size rows
+    while True:
+        ids = list(queryset.filter(pk__gt=after_id).order_by('pk').values_list('pk', flat=True)[:chunk_size])
+        if not ids:
+            return
+        yield ids[0], ids[-1]
+        after_id = ids[-1]
+
+
+def map_chunks(tasks, final_challenge_ids, processes):
+    if processes == 1:
+        init_worker(final_challenge_ids)
+        for task in tasks:
+            yield export_chunk(task)
+        return
+
+    # the workers must not share the database connection of this process
+    for connection in connections.all():
+        connection.close()
+    pool = Pool(processes, initializer=init_worker, initargs=(final_challenge_ids,))
+    try:
+        for result in pool.imap(export_chunk, tasks):
+            yield result
+    finally:
+        pool.close()
+        pool.join()
+
+
+worker_final_challenge_ids = ()
+
+
+def init_worker(final_challenge_ids):
+    global worker_final_challenge_ids
+    worker_final_challenge_ids = final_challenge_ids
+
+
+def export_chunk(task):
+    name, first_id, last_id = task
+    lines = list(EXPORTS[name][1](first_id, last_id))
+    data = gzip.compress(''.join(lines).encode('utf-8'))
+    return last_id, len(lines), data
+
+
+def tsv_line(*values):
+    return "\t".join(str(value) for value in values) + "\n"
+
+
+def get_users(final_challenge_ids):
+    return AuroraUser.objects.filter(is_staff=False)
+
+
+def get_user_lines(first_id, last_id):
+    users = get_users(worker_final_challenge_ids).filter(pk__gte=first_id, pk__lte=last_id).order_by('pk')
+    for user in users:
+        yield tsv_line(user.matriculation_number,
+                       user.nickname,
+                       user.first_name,
+                       user.last_name,
+                       user.study_code,
+                       str(user.last_activity),
+                       user.statement)
+
+
+def get_final_evaluations(final_challenge_ids):
+    return Evaluation.objects.all()
+
+
+def get_final_evaluation_lines(first_id, last_id):
+    """
+    username(mnr) TAB elabID TAB challenge-title TAB challenge-ID TAB creation time TAB submission time TAB
+    evaluationID TAB tutor TAB evaluation-creationdate TAB evaluation-submissiontime TAB evaluation-points
+    """
+    evaluations = (
+        get_final_evaluations(worker_final_challenge_ids)
+        .filter(pk__gte=first_id, pk__lte=last_id)
+        .select_related('submission__user', 'submission__challenge', 'tutor')
+        .order_by('pk')
+    )
+    for evaluation in evaluations:
+        elab = evaluation.submission
+        yield tsv_line(
+            elab.user.username + " (" + str(elab.user.matriculation_number) + ")",
+            str(elab.id),
+            elab.challenge.title,
+            str(elab.challenge.id),
+            str(elab.creation_time),
+            str(elab.submission_time),
+            evaluation.id,
+            evaluation.tutor.display_name,
+            str(evaluation.creation_date),
+            str(evaluation.submission_time),
+            str(evaluation.evaluation_points)
+        )
+
+
+def get_nonfinal_elaborations(final_challenge_ids):
+    return Elaboration.objects.exclude(challenge__id__in=final_challenge_ids)
+
+
+def get_nonfinal_elaboration_lines(first_id, last_id):
+    """
+    username (mnr) TAB elabID TAB challenge-title TAB challenge-ID TAB creation time TAB submission time TAB
+    reviewID 1 TAB review-verdict 1 TAB review-creation-date 1 TAB review-submission-date 1 TAB reviewID 2 TAB
+    review-verdict 2 TAB review-creation-date 2 TAB review-submission-date 2 TAB usw.
+    """
+    reviews = {}
+    chunk_reviews = (
+        Review.objects
+        .filter(elaboration_id__gte=first_id, elaboration_id__lte=last_id)
+        .order_by('id')
+        .values_list('elaboration_id', 'id', 'appraisal', 'creation_time', 'submission_time')
+    )
+    for elaboration_id, review_id, appraisal, creation_time, submission_time in chunk_reviews:
+        reviews.setdefault(elaboration_id, []).extend(
+            [str(review_id), str(appraisal), str(creation_time), str(submission_time)]
+        )
+
+    elabs = (
+        get_nonfinal_elaborations(worker_final_challenge_ids)
+        .filter(pk__gte=first_id, pk__lte=last_id)
+        .select_related('user', 'challenge')
+        .order_by('pk')
+    )
+    for elab in elabs:
+        yield tsv_line(
+            elab.user.username + " (" + str(elab.user.matriculation_number) + ")",
+            str(elab.id),
+            elab.challenge.title,
+            str(elab.challenge.id),
+            str(elab.creation_time),
+            str(elab.submission_time),
+            *reviews.get(elab.id, [])
+        )
+
+
+def get_reviews(final_challenge_ids):
+    return Review.objects.all()
+
+
+def get_review_lines(first_id, last_id):
+    """
+    review-autor (MNr) TAB
+    reviewed-elab-autor (MNr) TAB
+    reviewed-elab-challenge-ID TAB
+    review-creation-date TAB
+    review-submission-date TAB
+    länge des reviews (number of chars of all fields summiert)
+    """
+    from AuroraProject.views import time_to_unix_string
+
+    reviews = (
+        get_reviews(worker_final_challenge_ids)
+        .filter(pk__gte=first_id, pk__lte=last_id)
+        .with_answer_length()
+        .order_by('pk')
+        .values_list('reviewer__username', 'elaboration__user__username', 'elaboration__challenge_id',
+                     'creation_time', 'submission_time', 'answer_length')
+    )
+    for reviewer, author, challenge_id, creation_time, submission_time, answer_length in reviews:
+        yield tsv_line(
+            reviewer,
+            author,
+            challenge_id,
+            time_to_unix_string(creation_time),
+            time_to_unix_string(submission_time),
+            str(answer_length)
+        )
+
+
+# name: (rows to export, lines of a chunk of those rows)
+EXPORTS = OrderedDict([
+    ('users', (get_users, get_user_lines)),
+    ('elabs_final', (get_final_evaluations, get_final_evaluation_lines)),
+    ('elabs_nonfinal', (get_nonfinal_elaborations, get_nonfinal_elaboration_lines)),
+    ('reviews', (get_reviews, get_review_lines)),
+])
@@ -0,0 +1,65 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.db.models import Count
+
+from Elaboration.models import Elaboration
+from Review.models import Review
+
+
+class Command(BaseCommand):
+    help = 'Rebuilds the review counters of all elaborations from the reviews'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--verify',
+                    action='store_true',
+                    dest='verify',
+                    default=False,
+                    help='Only report elaborations with wrong counters, do not change anything'),
+    )
+
+    def handle(self, *args, **options):
+        with transaction.atomic():
+            mismatches = rebuild_review_counts(fix=not options['verify'])
+
+        for elaboration_id, stored, expected in mismatches:
+            self.stdout.write("elaboration %s: stored %s, expected %s" % (elaboration_id, stored, expected))
+
+        if options['verify']:
+            if mismatches:
+                raise CommandError("%s elaborations have wrong review counters" % len(mismatches))
+            self.stdout.write("all review counters are correct")
+        else:
+            self.stdout.write("fixed review counters of %s elaborations" % len(mismatches))
+
+
+def rebuild_review_counts(fix=True):
+    fields = Elaboration.review_count_fields
+
+    expected_counts = {}
+    submitted_reviews = (
+        Review.objects
+        .filter(submission_time__isnull=False, appraisal__in=fields.keys())
+        .values('elaboration_id', 'appraisal')
+        .annotate(count=Count('id'))
+    )
+    for row in submitted_reviews:
+        expected_counts.setdefault(row['elaboration_id'], {})[fields[row['appraisal']]] = row['count']
+
+    all_reviews = Review.objects.values('elaboration_id').annotate(count=Count('id'))
+    for row in all_reviews:
+        expected_counts.setdefault(row['elaboration_id'], {})['review_count'] = row['count']
+
+    mismatches = []
+    counter_fields = Elaboration.counter_fields
+    stored_counts = Elaboration.objects.values_list('id', *counter_fields).iterator()
+    for row in stored_counts:
+        elaboration_id = row[0]
+        stored = dict(zip(counter_fields, row[1:]))
+        expected = dict((field, expected_counts.get(elaboration_id, {}).get(field, 0)) for field in counter_fields)
+        if stored != expected:
+            mismatches.append((elaboration_id, stored, expected))
+            if fix:
+                Elaboration.objects.filter(id=elaboration_id).update(**expected)
+    return mismatches
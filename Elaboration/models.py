@@ -1,17 +1,64 @@
 from datetime import datetime, timedelta
+from difflib import SequenceMatcher
+from random import Random
+from zlib import crc32
 from django.contrib.contenttypes.fields import GenericRelation
-from django.db import models
-from django.db.models import Count, Min
+from django.db import models, transaction
+from django.db.models import Count, Min, Max, F, Q
 
 from Comments.models import Comment
 from Evaluation.models import Evaluation
 from Review.models import Review
 from FileUpload.models import UploadFile
 from ReviewAnswer.models import ReviewAnswer
-from collections import Counter
+from collections import Counter, OrderedDict
 from taggit.managers import TaggableManager
 
 
+class ElaborationQuerySet(models.QuerySet):
+    def with_overview_stats(self):
+        """
+        Adds everything the evaluation overview table shows per row as annotations:
+        last_post_date, visible_comments_count, invisible_comments_count and lva_team_notes.
+        """
+        from django.contrib.contenttypes.models import ContentType
+        from django.db import connection
+        from ReviewQuestion.models import ReviewQuestion
+
+        qn = connection.ops.quote_name
+        elaboration_id = '%s.%s' % (qn(Elaboration._meta.db_table), qn('id'))
+        comments = 'FROM %s WHERE %s = %%s AND %s = %s' % (
+            qn(Comment._meta.db_table), qn('content_type_id'), qn('object_id'), elaboration_id
+        )
+        lva_team_notes = (
+            'SELECT 1 FROM {answer} INNER JOIN {review} ON {answer}.{review_id} = {review}.{id} '
+            'INNER JOIN {question} ON {answer}.{question_id} = {question}.{id} '
+            'WHERE {review}.{elaboration_id} = {elaboration} AND {review}.{submission_time} IS NOT NULL '
+            'AND {question}.{visible_to_author} = %s AND {answer}.{text} <> %s'
+        ).format(
+            answer=qn(ReviewAnswer._meta.db_table), review=qn(Review._meta.db_table),
+            question=qn(ReviewQuestion._meta.db_table), id=qn('id'), review_id=qn('review_id'),
+            question_id=qn('review_question_id'), elaboration_id=qn('elaboration_id'), elaboration=elaboration_id,
+            submission_time=qn('submission_time'), visible_to_author=qn('visible_to_author'), text=qn('text'),
+        )
+        content_type_id = ContentType.objects.get_for_model(Elaboration).id
+
+        select = OrderedDict()
+        select_params = []
+        select['visible_comments_count'] = 'SELECT COUNT(*) %s AND %s = %%s' % (comments, qn('visibility'))
+        select_params += [content_type_id, Comment.PUBLIC]
+        select['invisible_comments_count'] = 'SELECT COUNT(*) %s AND %s = %%s' % (comments, qn('visibility'))
+        select_params += [content_type_id, Comment.STAFF]
+        select['lva_team_notes'] = 'CASE WHEN EXISTS (%s) THEN 1 ELSE 0 END' % lva_team_notes
+        select_params += [False, '']
+
+        return (
+            self.select_related('user', 'challenge')
+            .annotate(last_post_date=Max('comments__post_date'))
+            .extra(select=select, select_params=select_params)
+        )
+
+
 class Elaboration(models.Model):
     challenge = models.ForeignKey('Challenge.Challenge')
     user = models.ForeignKey('AuroraUser.AuroraUser')
@@ -21,9 +68,60 @@ class Elaboration(models.Model):
     tags = TaggableManager()
     comments = GenericRelation(Comment)
 
+    objects = ElaborationQuerySet.as_manager()
+
+    # number of submitted reviews per appraisal, maintained by Review.save
+    nothing_review_count = models.IntegerField(default=0)
+    fail_review_count = models.IntegerField(default=0)
+    success_review_count = models.IntegerField(default=0)
+    awesome_review_count = models.IntegerField(default=0)
+
+    # number of all reviews including open ones, the review candidate with the lowest count is picked first
+    review_count = models.IntegerField(default=0)
+
+    review_count_fields = {
+        Review.NOTHING: 'nothing_review_count',
+        Review.FAIL: 'fail_review_count',
+        Review.SUCCESS: 'success_review_count',
+        Review.AWESOME: 'awesome_review_count',
+    }
+    counter_fields = list(review_count_fields.values()) + ['review_count']
+
+    # comma separated MinHash signature of the submitted text, maintained by SimilarityBucket.index_elaboration
+    similarity_signature = models.TextField(default='')
+
+    maintained_fields = counter_fields + ['similarity_signature']
+
+    class Meta:
+        index_together = [('challenge', 'review_count')]
+
     def __unicode__(self):
         return str(self.id)
 
+    def save(self, *args, **kwargs):
+        # the review counters and the similarity signature are only written with update() calls,
+        # saving a stale in-memory copy of an existing elaboration must not overwrite them
+        if not self._state.adding and kwargs.get('update_fields') is None and not kwargs.get('force_insert'):
+            kwargs['update_fields'] = [
+                field.name for field in self._meta.concrete_fields
+                if not field.primary_key and field.name not in Elaboration.maintained_fields
+            ]
+        super(Elaboration, self).save(*args, **kwargs)
+
+    @staticmethod
+    def update_review_count(elaboration_id, appraisal, delta):
+        field = Elaboration.review_count_fields.get(appraisal)
+        if field is None:
+            return
+        Elaboration.objects.filter(id=elaboration_id).update(**{field: F(field) + delta})
+
+    @staticmethod
+    def update_total_review_count(elaboration_id, delta):
+        Elaboration.objects.filter(id=elaboration_id).update(review_count=F('review_count') + delta)
+
+    def get_submitted_review_count(self):
+        return sum(getattr(self, field) for field in Elaboration.review_count_fields.values())
+
     def is_started(self):
         if self.elaboration_text:
             return True
@@ -50,7 +148,7 @@ class Elaboration(models.Model):
         return None
 
     def is_reviewed_2times(self):
-        if Review.objects.filter(elaboration=self, submission_time__isnull=False).count() < 2:
+        if self.get_submitted_review_count() < 2:
             return False
         return True
 
@@ -220,35 +318,35 @@ class Elaboration(models.Model):
             )
         return Elaboration.objects.filter(id__in=include_elaboration_ids).filter(id__in=non_adequate_elaborations)
 
-    # offset is the number of hours needed to pass until elaboration is applicable as candidate
+    # offset is the number of hours needed to pass until elaboration is applicable as candidate,
+    # random_ties breaks ties of the lowest review_count at random so concurrent reviewers pick different ones
     @staticmethod
-    def get_review_candidate(challenge, user, offset=0):
+    def get_review_candidate(challenge, user, offset=0, random_ties=False):
         already_submitted_reviews_ids = (
             Review.objects
             .filter(reviewer=user, elaboration__challenge=challenge)
             .values_list('elaboration__id', flat=True)
         )
         threshold = datetime.now() - timedelta(hours=offset)
+        tie_order = '?' if random_ties else 'id'
         candidates = (
             Elaboration.objects
             .filter(challenge=challenge, submission_time__lt=threshold, user__is_staff=False)
             .exclude(user=user)
-            .annotate(num_reviews=Count('review'))
             .exclude(id__in=already_submitted_reviews_ids)
-        ).order_by('num_reviews')
+        ).order_by('review_count', tie_order)
 
-        if candidates.exists():
-            return candidates[0]
+        for candidate in candidates[:1]:
+            return candidate
 
         candidates = (
             Elaboration.objects
             .filter(challenge=challenge, submission_time__isnull=False, user__is_staff=True)
-            .annotate(num_reviews=Count('review'))
             .exclude(id__in=already_submitted_reviews_ids)
-        ).order_by('num_reviews')
+        ).order_by('review_count', tie_order)
 
-        if candidates.exists():
-            return candidates[0]
+        for candidate in candidates[:1]:
+            return candidate
         print("Error! No dummy elaborations created.")
         return None
 
@@ -279,7 +377,7 @@ class Elaboration(models.Model):
         return False
 
     def is_passing_peer_review(self):
-        return not self.get_nothing_reviews().exists()
+        return self.nothing_review_count == 0
 
     @staticmethod
     def get_complaints(course):
@@ -344,3 +442,198 @@ class Elaboration(models.Model):
     def get_last_post_date(self):
         comment = self.comments.latest('post_date')
         return comment.post_date
+
+    def get_similar_elaborations(self, threshold=0.5, candidates=None):
+        # the expensive SequenceMatcher only runs on the candidates sharing an LSH bucket
+        similar_elaborations = []
+        if not self.elaboration_text:
+            return similar_elaborations
+        if candidates is None:
+            candidates = SimilarityBucket.get_candidates(self)
+        for candidate in candidates:
+            ratio = similarity_ratio(self.elaboration_text, candidate.elaboration_text, threshold)
+            if ratio is not None:
+                similar_elaborations.append((candidate, ratio))
+        return similar_elaborations
+
+
+def similarity_ratio(text, other_text, threshold):
+    # returns the SequenceMatcher ratio if it is above the threshold, None otherwise
+    matcher = SequenceMatcher(lambda x: x == " ", text, other_text)
+    # quick ratios are upper bounds of ratio, cheap to check first
+    if matcher.real_quick_ratio() > threshold and matcher.quick_ratio() > threshold:
+        ratio = matcher.ratio()
+        if ratio > threshold:
+            return ratio
+    return None
+
+
+def minhash_permutations(count, prime):
+    # fixed seed, the signatures are stored and have to stay comparable
+    random = Random(0)
+    return [(random.randint(1, prime - 1), random.randint(0, prime - 1)) for permutation in range(count)]
+
+
+class SimilarityBucket(models.Model):
+    """
+    Locality sensitive hashing bucket of a submitted elaboration. The MinHash signature over the word shingles
+    of the text is split into bands, elaborations of a challenge sharing a band bucket are similarity candidates.
+    """
+    challenge = models.ForeignKey('Challenge.Challenge')
+    elaboration = models.ForeignKey('Elaboration')
+    band = models.IntegerField()
+    bucket = models.BigIntegerField()
+
+    class Meta:
+        index_together = [('challenge', 'band', 'bucket')]
+
+    SHINGLE_SIZE = 3
+    BANDS = 32
+    ROWS = 2
+    PRIME = 4294967311  # first prime above 2 ** 32
+    PERMUTATIONS = minhash_permutations(BANDS * ROWS, PRIME)
+    # similarity_signature of a text without words, which has no buckets but counts as indexed
+    EMPTY_SIGNATURE = '-'
+
+    @staticmethod
+    def get_shingles(text):
+        words = text.lower().split()
+        size = SimilarityBucket.SHINGLE_SIZE
+        if len(words) < size:
+            return {' '.join(words)} if words else set()
+        return {' '.join(words[i:i + size]) for i in range(len(words) - size + 1)}
+
+    @staticmethod
+    def get_signature(text):
+        hashes = [crc32(shingle.encode('utf-8')) for shingle in SimilarityBucket.get_shingles(text)]
+        if not hashes:
+            return []
+        prime = SimilarityBucket.PRIME
+        return [min((a * value + b) % prime for value in hashes) for a, b in SimilarityBucket.PERMUTATIONS]
+
+    @staticmethod
+    def get_buckets(signature):
+        rows = SimilarityBucket.ROWS
+        buckets = []
+        for band in range(SimilarityBucket.BANDS):
+            values = ','.join(str(value) for value in signature[band * rows:(band + 1) * rows])
+            buckets.append((band, crc32(values.encode('utf-8'))))
+        return buckets
+
+    @staticmethod
+    def index_elaboration(elaboration, update_pairs=True):
+        signature = SimilarityBucket.get_signature(elaboration.elaboration_text)
+        elaboration.similarity_signature = ','.join(str(value) for value in signature) or \
+            SimilarityBucket.EMPTY_SIGNATURE
+        with transaction.atomic():
+            Elaboration.objects.filter(id=elaboration.id).update(similarity_signature=elaboration.similarity_signature)
+            SimilarityBucket.objects.filter(elaboration=elaboration).delete()
+            if signature:
+                SimilarityBucket.objects.bulk_create([
+                    SimilarityBucket(challenge_id=elaboration.challenge_id, elaboration=elaboration, band=band,
+                                     bucket=bucket)
+                    for band, bucket in SimilarityBucket.get_buckets(signature)
+                ])
+            if update_pairs:
+                SimilarityPair.update_elaboration(elaboration)
+
+    @staticmethod
+    def index_challenge(challenge):
+        # indexes the submissions from before the index existed, run by the compute_similarities command
+        # which compares the whole challenge afterwards, so the pairs are not updated one by one
+        not_indexed = Elaboration.objects.filter(challenge=challenge, submission_time__isnull=False,
+                                                 similarity_signature='')
+        count = 0
+        for elaboration in not_indexed:
+            SimilarityBucket.index_elaboration(elaboration, update_pairs=False)
+            count += 1
+        return count
+
+    @staticmethod
+    def get_candidates(elaboration):
+        if elaboration.similarity_signature == SimilarityBucket.EMPTY_SIGNATURE:
+            return Elaboration.objects.none()
+        signature = [int(value) for value in elaboration.similarity_signature.split(',') if value]
+        if not signature:
+            signature = SimilarityBucket.get_signature(elaboration.elaboration_text)
+        if not signature:
+            return Elaboration.objects.none()
+
+        buckets = Q()
+        for band, bucket in SimilarityBucket.get_buckets(signature):
+            buckets |= Q(band=band, bucket=bucket)
+        candidate_ids = (
+            SimilarityBucket.objects
+            .filter(buckets, challenge_id=elaboration.challenge_id)
+            .exclude(elaboration_id=elaboration.id)
+            .values('elaboration_id')
+        )
+        return (
+            Elaboration.objects
+            .filter(id__in=candidate_ids, submission_time__isnull=False)
+            .exclude(elaboration_text='')
+            .select_related('user')
+        )
+
+
+class SimilarityPair(models.Model):
+    """
+    Precomputed similarity of two submitted elaborations of a challenge, only pairs above the threshold are stored.
+    Each pair is stored once with the lower elaboration id first.
+
+    The compute_similarities command compares every pair of a challenge. A (re)submission only replaces the pairs
+    of its elaboration with those of its LSH candidates, so until the command runs again the pairs of a resubmitted
+    elaboration have the recall of the index: very similar texts share a bucket almost surely, pairs close to the
+    threshold may be missing. This is intended, comparing the whole challenge would be back in the submit request.
+    """
+    challenge = models.ForeignKey('Challenge.Challenge')
+    elaboration = models.ForeignKey('Elaboration', related_name='+')
+    other = models.ForeignKey('Elaboration', related_name='+')
+    ratio = models.FloatField()
+    creation_time = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        unique_together = ('elaboration', 'other')
+
+    THRESHOLD = 0.5
+
+    @staticmethod
+    def create_pair(challenge_id, elaboration_id, other_id, ratio):
+        elaboration_id, other_id = sorted([elaboration_id, other_id])
+        return SimilarityPair(challenge_id=challenge_id, elaboration_id=elaboration_id, other_id=other_id, ratio=ratio)
+
+    @staticmethod
+    def update_elaboration(elaboration):
+        # compares a (re)submitted elaboration with its LSH candidates, called by SimilarityBucket.index_elaboration;
+        # its pairs from compute_similarities belong to the old text and are replaced as well, see the class docstring
+        candidates = SimilarityBucket.get_candidates(elaboration)
+        similar_elaborations = elaboration.get_similar_elaborations(SimilarityPair.THRESHOLD, candidates)
+        with transaction.atomic():
+            SimilarityPair.objects.filter(Q(elaboration=elaboration) | Q(other=elaboration)).delete()
+            SimilarityPair.objects.bulk_create([
+                SimilarityPair.create_pair(elaboration.challenge_id, elaboration.id, other.id, ratio)
+                for other, ratio in similar_elaborations
+            ])
+
+    @staticmethod
+    def replace_challenge_pairs(challenge_id, ratios):
+        # ratios are (elaboration id, other elaboration id, ratio) tuples of the whole challenge
+        with transaction.atomic():
+            SimilarityPair.objects.filter(challenge_id=challenge_id).delete()
+            SimilarityPair.objects.bulk_create([
+                SimilarityPair.create_pair(challenge_id, elaboration_id, other_id, ratio)
+                for elaboration_id, other_id, ratio in ratios
+            ], batch_size=500)
+
+    @staticmethod
+    def get_similarities(elaboration):
+        pairs = (
+            SimilarityPair.objects
+            .filter(Q(elaboration=elaboration) | Q(other=elaboration))
+            .select_related('elaboration__user', 'other__user')
+            .order_by('-ratio')
+        )
+        return [(pair, pair.get_other(elaboration)) for pair in pairs]
+
+    def get_other(self, elaboration):
+        return self.other if self.elaboration_id == elaboration.id else self.elaboration
@@ -3,9 +3,20 @@ Elaboration model method tests
 """
 
 from datetime import datetime, timedelta
+from difflib import SequenceMatcher
+from io import StringIO
+import gzip
+import os
+import shutil
+import tempfile
+from random import Random
+from string import ascii_lowercase
 import django
 
 from django.test import TestCase
+from django.test.client import Client
+from django.core.management import call_command
+from django.core.management.base import CommandError
 
 from AuroraUser.models import AuroraUser
 from Course.models import Course, CourseUserRelation
@@ -13,7 +24,7 @@ from Stack.models import Stack, StackChallengeRelation
 from Challenge.models import Challenge
 from Review.models import Review
 from ReviewQuestion.models import ReviewQuestion
-from Elaboration.models import Elaboration
+from Elaboration.models import Elaboration, SimilarityBucket, SimilarityPair
 from Evaluation.models import Evaluation
 
 
@@ -1160,4 +1171,225 @@ class ElaborationTest(TestCase):
         assert elaboration3 in Elaboration.get_evaluated_non_adequate_work(self.course)  # non adequate
         assert elaboration4 not in Elaboration.get_evaluated_non_adequate_work(self.course)  # final challenge
         assert elaboration5 in Elaboration.get_evaluated_non_adequate_work(self.course)  # non adequate
-        assert elaboration6 not in Elaboration.get_evaluated_non_adequate_work(self.course)  # final challenge
\ No newline at end of file
+        assert elaboration6 not in Elaboration.get_evaluated_non_adequate_work(self.course)  # final challenge
+
+    def test_review_counts(self):
+        user1 = self.users[0]
+        user2 = self.users[1]
+        user3 = self.users[2]
+        elaboration = Elaboration(challenge=self.challenge, user=user1, elaboration_text="test",
+                                  submission_time=datetime.now())
+        elaboration.save()
+        review1 = Review(elaboration=elaboration, reviewer=user2, appraisal=Review.SUCCESS)
+        review1.save()
+        assert Elaboration.objects.get(pk=elaboration.id).success_review_count == 0
+        review1.submission_time = datetime.now()
+        review1.save()
+        Review(elaboration=elaboration, submission_time=datetime.now(), reviewer=user3,
+               appraisal=Review.AWESOME).save()
+        elaboration = Elaboration.objects.get(pk=elaboration.id)
+        assert elaboration.success_review_count == 1
+        assert elaboration.awesome_review_count == 1
+        assert elaboration.review_count == 2
+        assert elaboration.is_reviewed_2times()
+        assert elaboration.is_passing_peer_review()
+        review1 = Review.objects.get(pk=review1.id)
+        review1.appraisal = Review.NOTHING
+        review1.save()
+        elaboration.elaboration_text = "stale copy"
+        elaboration.save()
+        elaboration = Elaboration.objects.get(pk=elaboration.id)
+        assert elaboration.success_review_count == 0
+        assert elaboration.nothing_review_count == 1
+        assert not elaboration.is_passing_peer_review()
+        review1.delete()
+        elaboration = Elaboration.objects.get(pk=elaboration.id)
+        assert elaboration.nothing_review_count == 0
+        assert elaboration.review_count == 1
+        assert not elaboration.is_reviewed_2times()
+
+    def test_rebuild_review_counts(self):
+        user1 = self.users[0]
+        user2 = self.users[1]
+        elaboration = Elaboration(challenge=self.challenge, user=user1, elaboration_text="test",
+                                  submission_time=datetime.now())
+        elaboration.save()
+        Review(elaboration=elaboration, submission_time=datetime.now(), reviewer=user2,
+               appraisal=Review.FAIL).save()
+        call_command('rebuild_review_counts', verify=True, stdout=StringIO())
+        Elaboration.objects.filter(pk=elaboration.id).update(fail_review_count=5, awesome_review_count=1,
+                                                             review_count=0)
+        with self.assertRaises(CommandError):
+            call_command('rebuild_review_counts', verify=True, stdout=StringIO())
+        call_command('rebuild_review_counts', stdout=StringIO())
+        elaboration = Elaboration.objects.get(pk=elaboration.id)
+        assert elaboration.fail_review_count == 1
+        assert elaboration.awesome_review_count == 0
+        assert elaboration.review_count == 1
+        call_command('rebuild_review_counts', verify=True, stdout=StringIO())
+
+    def test_similar_elaborations(self):
+        random = Random(1)
+        vocabulary = [''.join(random.choice(ascii_lowercase) for j in range(random.randint(3, 9))) for i in range(500)]
+        original_words = [random.choice(vocabulary) for i in range(150)]
+        original = Elaboration(challenge=self.challenge, user=self.users[0], elaboration_text=" ".join(original_words),
+                               submission_time=datetime.now())
+        original.save()
+        SimilarityBucket.index_elaboration(original)
+        others = []
+        for i, changed_words in enumerate([0, 1, 2, 3, 10, 150]):
+            words = list(original_words)
+            for position in random.sample(range(len(words)), changed_words):
+                words[position] = random.choice(vocabulary)
+            user = self.create_test_user("similar%s" % i)
+            elaboration = Elaboration(challenge=self.challenge, user=user, elaboration_text=" ".join(words),
+                                      submission_time=datetime.now())
+            elaboration.save()
+            others.append(elaboration)
+        # submissions from before the index existed are indexed by the compute_similarities command, so is text
+        # without words, only once
+        blank = Elaboration(challenge=self.challenge, user=self.create_test_user("blank"), elaboration_text=" \n ",
+                            submission_time=datetime.now())
+        blank.save()
+        assert SimilarityBucket.index_challenge(self.challenge) == len(others) + 1
+        assert SimilarityBucket.index_challenge(self.challenge) == 0
+        blank = Elaboration.objects.get(pk=blank.id)
+        assert blank.similarity_signature == SimilarityBucket.EMPTY_SIGNATURE
+        assert not blank.get_similar_elaborations() and not SimilarityBucket.get_candidates(blank).exists()
+        similar = dict((elaboration.id, ratio) for elaboration, ratio in original.get_similar_elaborations())
+        expected = set(
+            elaboration.id for elaboration in others
+            if SequenceMatcher(lambda x: x == " ", original.elaboration_text, elaboration.elaboration_text).ratio() > 0.5
+        )
+        assert set(similar) == expected
+        assert similar[others[0].id] == 1.0
+        assert others[-1].id not in similar
+        assert SimilarityBucket.objects.filter(elaboration=others[-1]).count() == SimilarityBucket.BANDS
+        assert others[-1].id not in [elaboration.id for elaboration in SimilarityBucket.get_candidates(original)]
+
+    def test_similarity_pairs(self):
+        random = Random(2)
+        vocabulary = [''.join(random.choice(ascii_lowercase) for j in range(random.randint(3, 9))) for i in range(500)]
+        original_words = [random.choice(vocabulary) for i in range(100)]
+        texts = [
+            " ".join(original_words),
+            " ".join(original_words),
+            " ".join(original_words[:99] + ["changed"]),
+            " ".join(random.choice(vocabulary) for i in range(100)),
+        ]
+        elaborations = []
+        for i, text in enumerate(texts):
+            elaboration = Elaboration(challenge=self.challenge, user=self.users[i], elaboration_text=text,
+                                      submission_time=datetime.now())
+            elaboration.save()
+            SimilarityBucket.index_elaboration(elaboration)
+            elaborations.append(elaboration)
+
+        def stored_pairs():
+            return set(SimilarityPair.objects.values_list('elaboration_id', 'other_id'))
+
+        first, second, third, unrelated = [elaboration.id for elaboration in elaborations]
+        expected = {(first, second), (first, third), (second, third)}
+        assert stored_pairs() == expected
+        similarities = SimilarityPair.get_similarities(elaborations[1])
+        assert set(other.id for pair, other in similarities) == {first, third}
+        assert similarities[0][0].ratio == 1.0
+
+        self.create_dummy_user('staff')
+        client = Client()
+        assert client.login(username='staff', password='staff')
+        session = client.session
+        session['elaboration_id'] = first
+        session.save()
+        pair = SimilarityPair.objects.get(elaboration_id=first, other_id=third)
+        response = client.get('/gsi/evaluation/similarity_diff/', {'pair_id': pair.id})
+        assert response.status_code == 200 and b'changed' in response.content
+        unrelated_pair = SimilarityPair.objects.get(elaboration_id=second, other_id=third)
+        for pair_id in [unrelated_pair.id, 'abc', '', pair.id + unrelated_pair.id]:
+            assert client.get('/gsi/evaluation/similarity_diff/', {'pair_id': pair_id}).status_code == 404
+
+        # a resubmission replaces the pairs of its elaboration only
+        elaborations[2].elaboration_text = texts[3]
+        elaborations[2].save()
+        SimilarityBucket.index_elaboration(elaborations[2])
+        assert stored_pairs() == {(first, second), (third, unrelated)}
+        elaborations[2].elaboration_text = texts[2]
+        elaborations[2].save()
+        SimilarityBucket.index_elaboration(elaborations[2])
+        assert stored_pairs() == expected
+
+        SimilarityPair.objects.all().delete()
+        SimilarityBucket.objects.all().delete()
+        Elaboration.objects.update(similarity_signature='')
+        call_command('compute_similarities', str(self.challenge.id), processes=2, stdout=StringIO())
+        assert stored_pairs() == expected
+        assert SimilarityBucket.objects.count() == len(elaborations) * SimilarityBucket.BANDS
+
+    def test_export_term(self):
+        from Elaboration.management.commands import export_term
+
+        final_challenge = Challenge(course=self.course, prerequisite=self.challenge)
+        final_challenge.save()
+        for i, user in enumerate(self.users):
+            elaboration = Elaboration(challenge=self.challenge, user=user, elaboration_text="test_text",
+                                      submission_time=datetime.now())
+            elaboration.save()
+            Review(elaboration=elaboration, reviewer=self.users[(i + 1) % 5], appraisal=Review.SUCCESS,
+                   submission_time=datetime.now()).save()
+        final_elaboration = Elaboration(challenge=final_challenge, user=self.users[0], elaboration_text="final",
+                                        submission_time=datetime.now())
+        final_elaboration.save()
+        Evaluation(submission=final_elaboration, tutor=self.users[1], evaluation_points=10,
+                   submission_time=datetime.now()).save()
+
+        def read_export(output_dir, name):
+            with gzip.open(os.path.join(output_dir, export_term.get_file_name(name))) as export_file:
+                return export_file.read().decode('utf-8').splitlines()
+
+        output_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, output_dir)
+        call_command('export_term', output_dir=output_dir, processes=1, chunk_size=2, stdout=StringIO())
+        users = read_export(output_dir, 'users')
+        assert len(users) == AuroraUser.objects.filter(is_staff=False).count()
+        elabs_nonfinal = read_export(output_dir, 'elabs_nonfinal')
+        assert len(elabs_nonfinal) == 5
+        assert all(len(line.split("\t")) == 10 for line in elabs_nonfinal)
+        assert len(read_export(output_dir, 'elabs_final')) == 1
+        assert len(read_export(output_dir, 'reviews')) == 5
+
+        # a worker dies after the first chunk, the second run continues from the checkpoint
+        resume_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, resume_dir)
+        export_chunk = export_term.export_chunk
+
+        exported_chunks = []
+
+        def failing_export_chunk(task):
+            if exported_chunks:
+                raise RuntimeError("worker died")
+            exported_chunks.append(task)
+            return export_chunk(task)
+
+        export_term.export_chunk = failing_export_chunk
+        try:
+            with self.assertRaises(RuntimeError):
+                call_command('export_term', 'reviews', output_dir=resume_dir, processes=1, chunk_size=2,
+                             stdout=StringIO())
+        finally:
+            export_term.export_chunk = export_chunk
+        with open(os.path.join(resume_dir, export_term.get_file_name('reviews')), 'ab') as export_file:
+            export_file.write(b"half written chunk")
+        output = StringIO()
+        call_command('export_term', 'reviews', output_dir=resume_dir, processes=1, chunk_size=2, stdout=output)
+        assert "resumed after 2 rows" in output.getvalue()
+        assert read_export(resume_dir, 'reviews') == read_export(output_dir, 'reviews')
+        output = StringIO()
+        call_command('export_term', 'reviews', output_dir=resume_dir, processes=1, stdout=output)
+        assert "already exported" in output.getvalue()
+
+        # a finished file that went missing is exported again
+        os.remove(os.path.join(resume_dir, export_term.get_file_name('reviews')))
+        output = StringIO()
+        call_command('export_term', 'reviews', output_dir=resume_dir, processes=1, stdout=output)
+        assert "already exported" not in output.getvalue() and "resumed" not in output.getvalue()
+        assert read_export(resume_dir, 'reviews') == read_export(output_dir, 'reviews')
@@ -6,7 +6,7 @@ from django.template import RequestContext
 from django.contrib.auth.decorators import login_required
 from django.views.decorators.csrf import csrf_exempt
 from Challenge.models import Challenge
-from Elaboration.models import Elaboration
+from Elaboration.models import Elaboration, SimilarityBucket
 from AuroraUser.models import AuroraUser
 from Course.models import Course
 from django.http import Http404
@@ -52,4 +52,5 @@ def submit_elaboration(request, course_short_title):
     if elaboration.elaboration_text or UploadFile.objects.filter(elaboration=elaboration).exists():
         elaboration.submission_time = datetime.now()
         elaboration.save()
+        SimilarityBucket.index_elaboration(elaboration)
         return HttpResponse()
@@ -1,9 +1,13 @@
 from datetime import timedelta, datetime
+from uuid import uuid4
 from django.db import models
+from django.db.models import Max, Q
+from django.db.models.query import QuerySet
 
 
 class Evaluation(models.Model):
-    submission = models.ForeignKey('Elaboration.Elaboration')
+    # one evaluation per elaboration, concurrent get_or_create calls end up with the same row
+    submission = models.ForeignKey('Elaboration.Elaboration', unique=True)
     tutor = models.ForeignKey('AuroraUser.AuroraUser')
     creation_date = models.DateTimeField(auto_now_add=True)
     evaluation_text = models.TextField()
@@ -11,9 +15,155 @@ class Evaluation(models.Model):
     submission_time = models.DateTimeField(null=True)
     lock_time = models.DateTimeField(null=True)
 
+    LOCK_DURATION = timedelta(minutes=15)
+
+    INIT = 'init'
+    OPEN = 'open'
+    LOCKED = 'locked'
+
     def is_older_15min(self):
         if not self.lock_time:
             return False
-        if self.lock_time + timedelta(minutes=15) < datetime.now():
+        if self.lock_time + Evaluation.LOCK_DURATION < datetime.now():
             return True
-        return False
\ No newline at end of file
+        return False
+
+    def is_locked_for(self, tutor):
+        return self.tutor_id != tutor.id and not self.is_older_15min()
+
+    @staticmethod
+    def get_lock(elaboration, tutor):
+        # returns the evaluation of the elaboration (or None) and whether another tutor holds its lock
+        evaluation = Evaluation.objects.filter(submission=elaboration).select_related('tutor').first()
+        if evaluation is None:
+            return None, False
+        return evaluation, evaluation.is_locked_for(tutor)
+
+    @staticmethod
+    def acquire_lock(elaboration, tutor):
+        """
+        Creates the evaluation of the elaboration or takes over its lock with a compare-and-set update.
+        Returns the state (INIT, OPEN or LOCKED) and the evaluation.
+        """
+        now = datetime.now()
+        evaluation, created = Evaluation.objects.get_or_create(
+            submission=elaboration, defaults={'tutor': tutor, 'lock_time': now}
+        )
+        if created:
+            return Evaluation.INIT, evaluation
+
+        # the lock is taken if it is held by the tutor already or has expired, otherwise no row is updated
+        acquired = (
+            Evaluation.objects
+            .filter(id=evaluation.id)
+            .filter(Q(tutor=tutor) | Q(lock_time__lt=now - Evaluation.LOCK_DURATION))
+            .update(tutor=tutor, lock_time=now)
+        )
+        evaluation = Evaluation.objects.select_related('tutor').get(id=evaluation.id)
+        return (Evaluation.OPEN if acquired else Evaluation.LOCKED), evaluation
+
+class TriageResultSet(models.Model):
+    """
+    Ordered elaboration ids of a triage selection (missing reviews, top-level tasks, search, ...).
+    Only the token is kept in the session, the elaborations are loaded page by page.
+    """
+    token = models.CharField(max_length=32, unique=True)
+    user = models.ForeignKey('AuroraUser.AuroraUser')
+    elaboration_ids = models.TextField(default='')
+    creation_time = models.DateTimeField(auto_now_add=True)
+
+    TTL = timedelta(days=1)
+    # sqlite does not allow more variables in a single query
+    CHUNK_SIZE = 500
+
+    @staticmethod
+    def create(user, elaborations):
+        TriageResultSet.objects.filter(creation_time__lt=datetime.now() - TriageResultSet.TTL).delete()
+        result_set = TriageResultSet(token=uuid4().hex, user=user)
+        result_set.set_ids(TriageResultSet.get_elaboration_ids(elaborations))
+        result_set.save()
+        return result_set
+
+    @staticmethod
+    def get(token, user):
+        if not token:
+            return None
+        try:
+            return TriageResultSet.objects.get(token=token, user=user,
+                                               creation_time__gte=datetime.now() - TriageResultSet.TTL)
+        except TriageResultSet.DoesNotExist:
+            return None
+
+    @staticmethod
+    def get_elaboration_ids(elaborations):
+        if isinstance(elaborations, QuerySet):
+            return list(elaborations.values_list('id', flat=True))
+        return [elaboration.id for elaboration in elaborations]
+
+    def get_ids(self):
+        if not hasattr(self, '_ids'):
+            self._ids = [int(elaboration_id) for elaboration_id in self.elaboration_ids.split(',') if elaboration_id]
+        return self._ids
+
+    def set_ids(self, ids):
+        self._ids = list(ids)
+        self.elaboration_ids = ','.join(str(elaboration_id) for elaboration_id in self._ids)
+
+    def get_elaborations(self):
+        return ResultSetElaborations(self.get_ids())
+
+    def get_neighbours(self, elaboration_id):
+        ids = self.get_ids()
+        if elaboration_id not in ids:
+            return None, None
+        index = ids.index(elaboration_id)
+        prev = ids[index - 1] if index > 0 else None
+        next = ids[index + 1] if index + 1 < len(ids) else None
+        return prev, next
+
+    def get_values(self, field):
+        from Elaboration.models import Elaboration
+
+        ids = list(set(self.get_ids()))
+        values = {}
+        for start in range(0, len(ids), TriageResultSet.CHUNK_SIZE):
+            elaborations = Elaboration.objects.filter(id__in=ids[start:start + TriageResultSet.CHUNK_SIZE])
+            if field == 'last_post_date':
+                elaborations = elaborations.annotate(last_post_date=Max('comments__post_date'))
+            values.update(elaborations.values_list('id', field))
+        return values
+
+    def sort(self, field, reverse=False):
+        values = self.get_values(field)
+
+        def key(elaboration_id):
+            # elaborations without a value (e.g. no comments) go first
+            value = values.get(elaboration_id)
+            return value is not None, value
+
+        self.set_ids(sorted(self.get_ids(), key=key, reverse=reverse))
+        self.save()
+
+
+class ResultSetElaborations(object):
+    # list like view of a result set for the paginator, only the sliced elaborations are loaded
+    def __init__(self, ids):
+        self.ids = ids
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __iter__(self):
+        return iter(self[:])
+
+    def __getitem__(self, key):
+        from Elaboration.models import Elaboration
+
+        if not isinstance(key, slice):
+            return Elaboration.objects.with_overview_stats().get(pk=self.ids[key])
+        ids = self.ids[key]
+        elaborations = {}
+        for start in range(0, len(ids), TriageResultSet.CHUNK_SIZE):
+            chunk = ids[start:start + TriageResultSet.CHUNK_SIZE]
+            elaborations.update(Elaboration.objects.with_overview_stats().in_bulk(chunk))
+        return [elaborations[elaboration_id] for elaboration_id in ids if elaboration_id in elaborations]
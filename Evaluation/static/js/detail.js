@@ -60,6 +60,21 @@ $(function() {
    });
 });
 
+$(function() {
+   $(document).on('click', '.show_diff', function(event) {
+       var pair_id = $(event.target).closest('.show_diff').attr('id');
+       var diff_area = $('#diff_' + pair_id);
+       if (diff_area.children().length > 0) {
+           diff_area.toggle();
+           return;
+       }
+       var url = './similarity_diff/?pair_id=' + pair_id;
+       $.get(url, function (data) {
+           diff_area.html(data);
+       });
+   });
+});
+
 $(function() {
     $(".paginator").click(function(event) {
         var url = './detail?elaboration_id=' + $(event.target).attr('id');
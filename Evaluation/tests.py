@@ -0,0 +1,204 @@
+from datetime import datetime, timedelta
+
+from django.db import transaction, IntegrityError
+from django.test import TestCase, TransactionTestCase
+
+from AuroraProject.test_utils import run_concurrently
+from AuroraUser.models import AuroraUser
+from Course.models import Course, CourseUserRelation
+from Challenge.models import Challenge
+from Elaboration.models import Elaboration
+from Evaluation.models import Evaluation, TriageResultSet
+from Comments.models import Comment
+from Review.models import Review
+from ReviewQuestion.models import ReviewQuestion
+from ReviewAnswer.models import ReviewAnswer
+
+
+class TriageResultSetTest(TestCase):
+    def setUp(self):
+        self.create_test_users(4)
+        self.create_course()
+        self.create_challenge()
+        self.create_elaborations()
+        self.tutor = self.create_test_user('tutor')
+
+    def create_test_user(self, username):
+        user = AuroraUser(username=username)
+        user.email = '%s@student.tuwien.ac.at.' % username
+        user.first_name = 'Firstname_%s' % username
+        user.last_name = 'Lastname_%s' % username
+        user.nickname = 'Nickname_%s' % username
+        user.is_staff = False
+        user.is_superuser = False
+        password = username
+        user.set_password(password)
+        user.save()
+        return user
+
+    def create_test_users(self, amount):
+        self.users = []
+        for i in range(amount):
+            self.users.append(self.create_test_user("s%s" % i))
+
+    def create_course(self):
+        self.course = Course(
+            title='test_title',
+            short_title='test_short_title',
+            description='test_description',
+            course_number='test_course_number',
+        )
+        self.course.save()
+        for user in self.users:
+            CourseUserRelation(course=self.course, user=user).save()
+
+    def create_challenge(self):
+        self.challenge = Challenge(
+            title='test_title',
+            subtitle='test_subtitle',
+            description='test_description',
+            course=self.course,
+        )
+        self.challenge.save()
+
+    def create_elaborations(self):
+        self.elaborations = []
+        for i, user in enumerate(self.users):
+            elaboration = Elaboration(challenge=self.challenge, user=user, elaboration_text="test_text",
+                                      submission_time=datetime.now() - timedelta(hours=i))
+            elaboration.save()
+            self.elaborations.append(elaboration)
+
+    def test_create_and_get(self):
+        result_set = TriageResultSet.create(self.tutor, Elaboration.objects.order_by('-id'))
+        ids = [elaboration.id for elaboration in reversed(self.elaborations)]
+        result_set = TriageResultSet.get(result_set.token, self.tutor)
+        assert result_set.get_ids() == ids
+        assert TriageResultSet.get(result_set.token, self.users[0]) is None
+        assert TriageResultSet.get('', self.tutor) is None
+
+    def test_expired_result_set(self):
+        result_set = TriageResultSet.create(self.tutor, self.elaborations)
+        TriageResultSet.objects.filter(pk=result_set.pk).update(
+            creation_time=datetime.now() - TriageResultSet.TTL - timedelta(minutes=1)
+        )
+        # saving, e.g. when sorting, does not extend the lifetime
+        TriageResultSet.objects.get(pk=result_set.pk).sort('submission_time')
+        assert TriageResultSet.get(result_set.token, self.tutor) is None
+        TriageResultSet.create(self.tutor, self.elaborations)
+        assert not TriageResultSet.objects.filter(pk=result_set.pk).exists()
+
+    def test_neighbours(self):
+        result_set = TriageResultSet.create(self.tutor, self.elaborations)
+        first, second, third, fourth = [elaboration.id for elaboration in self.elaborations]
+        assert result_set.get_neighbours(first) == (None, second)
+        assert result_set.get_neighbours(third) == (second, fourth)
+        assert result_set.get_neighbours(fourth) == (third, None)
+        assert result_set.get_neighbours(-1) == (None, None)
+
+    def test_pagination_loads_page_only(self):
+        result_set = TriageResultSet.create(self.tutor, self.elaborations)
+        elaborations = result_set.get_elaborations()
+        assert len(elaborations) == 4
+        with self.assertNumQueries(1):
+            page = elaborations[1:3]
+            assert [elaboration.user.username for elaboration in page] == ['s1', 's2']
+
+    def test_sort(self):
+        result_set = TriageResultSet.create(self.tutor, self.elaborations)
+        result_set.sort('submission_time')
+        ids = [elaboration.id for elaboration in reversed(self.elaborations)]
+        assert TriageResultSet.get(result_set.token, self.tutor).get_ids() == ids
+        result_set.sort('last_post_date', reverse=True)
+        assert len(result_set.get_ids()) == 4
+
+    def create_comment(self, elaboration, visibility, post_date):
+        Comment(text="test", author=self.tutor, post_date=post_date, content_object=elaboration,
+                visibility=visibility).save()
+
+    def test_overview_stats(self):
+        elaboration = self.elaborations[0]
+        last_post_date = datetime(2015, 3, 2, 12, 0)
+        self.create_comment(elaboration, Comment.PUBLIC, datetime(2015, 3, 1, 12, 0))
+        self.create_comment(elaboration, Comment.PUBLIC, last_post_date)
+        self.create_comment(elaboration, Comment.STAFF, datetime(2015, 2, 1, 12, 0))
+        hidden_question = ReviewQuestion(challenge=self.challenge, order=1, text="note", visible_to_author=False)
+        hidden_question.save()
+        review = Review(elaboration=elaboration, reviewer=self.users[1], appraisal=Review.SUCCESS,
+                        submission_time=datetime.now())
+        review.save()
+        ReviewAnswer(review=review, review_question=hidden_question, text="lva team note").save()
+
+        elaboration = Elaboration.objects.with_overview_stats().get(pk=elaboration.id)
+        assert elaboration.visible_comments_count == elaboration.get_visible_comments_count() == 2
+        assert elaboration.invisible_comments_count == elaboration.get_invisible_comments_count() == 1
+        assert elaboration.lva_team_notes and elaboration.get_lva_team_notes()
+        assert elaboration.last_post_date == last_post_date
+        other = Elaboration.objects.with_overview_stats().get(pk=self.elaborations[1].id)
+        assert other.visible_comments_count == 0
+        assert not other.lva_team_notes
+        assert other.last_post_date is None
+
+    def test_overview_page_query_count(self):
+        for elaboration in self.elaborations:
+            self.create_comment(elaboration, Comment.PUBLIC, datetime.now())
+        result_set = TriageResultSet.create(self.tutor, self.elaborations)
+        Elaboration.objects.with_overview_stats()  # warms the content type cache
+        with self.assertNumQueries(1):
+            for elaboration in result_set.get_elaborations()[0:20]:
+                (elaboration.user.nickname, elaboration.challenge.title, elaboration.last_post_date,
+                 elaboration.visible_comments_count, elaboration.invisible_comments_count,
+                 elaboration.lva_team_notes, elaboration.awesome_review_count, elaboration.nothing_review_count)
+
+
+class EvaluationLockTest(TransactionTestCase):
+    def setUp(self):
+        course = Course(title='test_title', short_title='test_short_title', description='test_description',
+                        course_number='test_course_number')
+        course.save()
+        challenge = Challenge(title='test_title', subtitle='test_subtitle', description='test_description',
+                              course=course)
+        challenge.save()
+        author = AuroraUser(username="author")
+        author.save()
+        self.elaboration = Elaboration(challenge=challenge, user=author, elaboration_text="test_text",
+                                       submission_time=datetime.now())
+        self.elaboration.save()
+        self.tutors = []
+        for i in range(20):
+            tutor = AuroraUser(username="tutor%s" % i, is_staff=True)
+            tutor.save()
+            self.tutors.append(tutor)
+
+    def acquire_concurrently(self, tutors):
+        states = run_concurrently(lambda tutor, prepared: Evaluation.acquire_lock(self.elaboration, tutor)[0], tutors)
+        return dict((tutor.id, state) for tutor, state in zip(tutors, states))
+
+    def test_concurrent_start_evaluation(self):
+        states = self.acquire_concurrently(self.tutors)
+        assert Evaluation.objects.filter(submission=self.elaboration).count() == 1
+        assert list(states.values()).count(Evaluation.INIT) == 1
+        assert list(states.values()).count(Evaluation.LOCKED) == len(self.tutors) - 1
+        evaluation = Evaluation.objects.get(submission=self.elaboration)
+        assert states[evaluation.tutor_id] == Evaluation.INIT
+
+        # the lock holder keeps the lock, everybody else is locked out
+        assert Evaluation.acquire_lock(self.elaboration, evaluation.tutor)[0] == Evaluation.OPEN
+        other_tutor = [tutor for tutor in self.tutors if tutor.id != evaluation.tutor_id][0]
+        assert Evaluation.get_lock(self.elaboration, other_tutor)[1]
+        assert not Evaluation.get_lock(self.elaboration, evaluation.tutor)[1]
+        assert Evaluation.acquire_lock(self.elaboration, other_tutor)[0] == Evaluation.LOCKED
+
+        # an expired lock is taken over by exactly one tutor
+        Evaluation.objects.update(lock_time=datetime.now() - Evaluation.LOCK_DURATION - timedelta(minutes=1))
+        states = self.acquire_concurrently(self.tutors)
+        assert Evaluation.objects.filter(submission=self.elaboration).count() == 1
+        assert list(states.values()).count(Evaluation.OPEN) == 1
+        evaluation = Evaluation.objects.get(submission=self.elaboration)
+        assert states[evaluation.tutor_id] == Evaluation.OPEN
+
+    def test_unique_submission(self):
+        Evaluation(submission=self.elaboration, tutor=self.tutors[0]).save()
+        with self.assertRaises(IntegrityError):
+            with transaction.atomic():
+                Evaluation(submission=self.elaboration, tutor=self.tutors[1]).save()
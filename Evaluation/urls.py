@@ -10,6 +10,7 @@ urlpatterns = patterns('',
     url(r'^others/$', Evaluation.views.others, name='others'),
     url(r'^challenge_txt/$', Evaluation.views.challenge_txt, name='task_description'),
     url(r'^similarities/$', Evaluation.views.similarities, name='similarities'),
+    url(r'^similarity_diff/$', Evaluation.views.similarity_diff, name='similarity_diff'),
     url(r'^reviewlist/$', Evaluation.views.reviewlist, name='reviews'),
     url(r'^missing_reviews$', Evaluation.views.missing_reviews, name='missing_reviews'),
     url(r'^non_adequate_work$', Evaluation.views.non_adequate_work, name='non_adequate_work'),
@@ -1,34 +1,43 @@
 from datetime import datetime
-from difflib import SequenceMatcher
 import difflib
 import json
 from django.contrib.contenttypes.models import ContentType
 from django.core import serializers
 from django.core.urlresolvers import reverse
-from django.http import HttpResponse
-from django.shortcuts import render_to_response
+from django.http import HttpResponse, Http404
+from django.shortcuts import render_to_response, get_object_or_404
 from django.template import RequestContext
 from django.contrib.auth.decorators import login_required
 from django.contrib.admin.views.decorators import staff_member_required
 from django.template.loader import render_to_string
 from django.views.decorators.csrf import csrf_exempt
+from django.db import transaction
 from django.db.models import Q
 from taggit.models import TaggedItem
 from django.views.decorators.http import require_POST
 from django.http import HttpResponseForbidden
 
-from Challenge.models import Challenge
+from Challenge.models import Challenge, Gradebook
 from Course.models import Course, CourseUserRelation
-from Elaboration.models import Elaboration
-from Evaluation.models import Evaluation
+from Elaboration.models import Elaboration, SimilarityPair
+from Evaluation.models import Evaluation, TriageResultSet
 from AuroraUser.models import AuroraUser
 from Review.models import Review, ReviewEvaluation
 from ReviewAnswer.models import ReviewAnswer
 from ReviewQuestion.models import ReviewQuestion
-from Stack.models import Stack
 from Notification.models import Notification
 
 
+def store_result_set(request, elaborations):
+    result_set = TriageResultSet.create(RequestContext(request)['user'], elaborations)
+    request.session['result_set'] = result_set.token
+    return result_set
+
+
+def get_result_set(request):
+    return TriageResultSet.get(request.session.get('result_set'), RequestContext(request)['user'])
+
+
 @login_required()
 @staff_member_required
 def evaluation(request, course_short_title=None):
@@ -38,8 +47,9 @@ def evaluation(request, course_short_title=None):
     count = 0
     selection = request.session.get('selection', 'error')
     if selection not in ('error', 'questions'):
-        for serialized_elaboration in serializers.deserialize('json', request.session.get('elaborations', {})):
-            elaborations.append(serialized_elaboration.object)
+        result_set = get_result_set(request)
+        if result_set:
+            elaborations = result_set.get_elaborations()
         if selection == 'search':
             if 'id' in request.GET:
                 points = get_points(request, AuroraUser.objects.get(pk=request.GET['id']), course)
@@ -91,10 +101,11 @@ def missing_reviews(request, course_short_title=None):
     else:
         elaborations = elaborations.order_by('submission_time')
 
-    # store selected elaborations in session
-    request.session['elaborations'] = serializers.serialize('json', elaborations)
+    # store selected elaborations in a result set
+    result_set = store_result_set(request, elaborations)
+    elaborations = result_set.get_elaborations()
     request.session['selection'] = 'missing_reviews'
-    request.session['count'] = len(elaborations)
+    request.session['count'] = len(result_set.get_ids())
 
     return render_to_response('evaluation.html',
                               {'overview': render_to_string('overview.html', {'elaborations': elaborations, 'course': course},
@@ -119,10 +130,11 @@ def non_adequate_work(request, course_short_title=None):
     else:
         elaborations = elaborations.order_by('submission_time')
 
-    # store selected elaborations in session
-    request.session['elaborations'] = serializers.serialize('json', elaborations)
+    # store selected elaborations in a result set
+    result_set = store_result_set(request, elaborations)
+    elaborations = result_set.get_elaborations()
     request.session['selection'] = 'non_adequate_work'
-    request.session['count'] = len(elaborations)
+    request.session['count'] = len(result_set.get_ids())
 
     return render_to_response('evaluation.html',
                               {'overview': render_to_string('overview.html', {'elaborations': elaborations, 'course': course},
@@ -147,10 +159,11 @@ def top_level_tasks(request, course_short_title=None):
     else:
         elaborations = elaborations.order_by('submission_time')
 
-    # store selected elaborations in session
-    request.session['elaborations'] = serializers.serialize('json', elaborations)
+    # store selected elaborations in a result set
+    result_set = store_result_set(request, elaborations)
+    elaborations = result_set.get_elaborations()
     request.session['selection'] = 'top_level_tasks'
-    request.session['count'] = len(elaborations)
+    request.session['count'] = len(result_set.get_ids())
 
     return render_to_response('evaluation.html',
                               {'overview': render_to_string('overview.html', {'elaborations': elaborations, 'course': course},
@@ -175,10 +188,11 @@ def complaints(request, course_short_title=None):
     else:
         elaborations = elaborations.order_by('-comments__post_date')
 
-    # store selected elaborations in session
-    request.session['elaborations'] = serializers.serialize('json', elaborations)
+    # store selected elaborations in a result set
+    result_set = store_result_set(request, elaborations)
+    elaborations = result_set.get_elaborations()
     request.session['selection'] = 'complaints'
-    request.session['count'] = len(elaborations)
+    request.session['count'] = len(result_set.get_ids())
 
     return render_to_response('evaluation.html',
                               {'overview': render_to_string('overview.html', {'elaborations': elaborations, 'course': course, 'complaints': 'true'},
@@ -208,11 +222,12 @@ def awesome(request, course_short_title=None):
     else:
         elaborations = elaborations.order_by('submission_time')
 
-    # store selected elaborations in session
-    request.session['elaborations'] = serializers.serialize('json', elaborations)
+    # store selected elaborations in a result set
+    result_set = store_result_set(request, elaborations)
+    elaborations = result_set.get_elaborations()
     request.session['selection'] = 'awesome'
     request.session['selected_challenge'] = ''
-    request.session['count'] = len(elaborations)
+    request.session['count'] = len(result_set.get_ids())
 
     return render_to_response('evaluation.html',
                               {'overview': render_to_string('overview.html', {'elaborations': elaborations, 'course': course},
@@ -235,9 +250,7 @@ def questions(request, course_short_title=None):
     # store selected challenges in session
     request.session['challenges'] = serializers.serialize('json', challenges)
 
-    # store selected elaborations in session
-    elaborations = []
-    request.session['elaborations'] = elaborations
+    request.session['result_set'] = None
     request.session['selection'] = 'questions'
     request.session['count'] = len(challenges)
 
@@ -259,11 +272,7 @@ def detail(request, course_short_title=None):
 
     course = Course.get_or_raise_404(short_title=course_short_title)
 
-    # get selected elaborations from session
-    elaborations = []
     params = {}
-    for serialized_elaboration in serializers.deserialize('json', request.session.get('elaborations', {})):
-        elaborations.append(serialized_elaboration.object)
     selection = request.session.get('selection', 'error')
 
     if not 'elaboration_id' in request.GET:
@@ -277,25 +286,13 @@ def detail(request, course_short_title=None):
         questions = ReviewQuestion.objects.filter(challenge=elaboration.challenge).order_by("order")
         params = {'questions': questions, 'selection': 'missing reviews'}
     if selection == "top_level_tasks":
-        evaluation = None
-        user = RequestContext(request)['user']
-        lock = False
-        if Evaluation.objects.filter(submission=elaboration):
-            evaluation = Evaluation.objects.get(submission=elaboration)
-            if evaluation.tutor != user and not evaluation.is_older_15min():
-                lock = True
+        evaluation, lock = Evaluation.get_lock(elaboration, RequestContext(request)['user'])
         params = {'evaluation': evaluation, 'lock': lock, 'selection': 'top-level tasks'}
     if selection == "non_adequate_work":
         params = {'selection': 'non-adequate work'}
     if selection == "complaints":
         if elaboration.challenge.is_final_challenge():
-            evaluation = None
-            user = RequestContext(request)['user']
-            lock = False
-            if Evaluation.objects.filter(submission=elaboration):
-                evaluation = Evaluation.objects.get(submission=elaboration)
-                if evaluation.tutor != user and not evaluation.is_older_15min():
-                    lock = True
+            evaluation, lock = Evaluation.get_lock(elaboration, RequestContext(request)['user'])
             params = {'evaluation': evaluation, 'lock': lock, 'selection': 'complaints'}
         else:
             params = {'selection': 'complaints'}
@@ -304,13 +301,7 @@ def detail(request, course_short_title=None):
     if selection == "evaluated_non_adequate_work":
         params = {'selection': 'evaluated non-adequate work'}
     if selection == "search":
-        evaluation = None
-        user = RequestContext(request)['user']
-        lock = False
-        if Evaluation.objects.filter(submission=elaboration):
-            evaluation = Evaluation.objects.get(submission=elaboration)
-            if evaluation.tutor != user and not evaluation.is_older_15min():
-                lock = True
+        evaluation, lock = Evaluation.get_lock(elaboration, RequestContext(request)['user'])
         if elaboration.challenge.is_final_challenge():
             params = {'evaluation': evaluation, 'lock': lock, 'selection': 'top-level tasks'}
         else:
@@ -323,11 +314,9 @@ def detail(request, course_short_title=None):
     reviews = Review.objects.filter(elaboration=elaboration, submission_time__isnull=False)
 
     next = prev = None
-    index = elaborations.index(elaboration)
-    if index + 1 < len(elaborations):
-        next = elaborations[index + 1].id
-    if not index == 0:
-        prev = elaborations[index - 1].id
+    result_set = get_result_set(request)
+    if result_set:
+        prev, next = result_set.get_neighbours(elaboration.id)
 
     stack_elaborations = elaboration.user.get_stack_elaborations(elaboration.challenge.get_stack())
     # sort stack_elaborations by submission time
@@ -360,25 +349,10 @@ def start_evaluation(request, course_short_title=None):
     elaboration = Elaboration.objects.get(pk=request.GET.get('elaboration_id', ''))
 
     # set evaluation lock
-    state = 'open'
     user = RequestContext(request)['user']
-    if Evaluation.objects.filter(submission=elaboration):
-        evaluation = Evaluation.objects.get(submission=elaboration)
-        if evaluation.tutor == user:
-            evaluation.lock_time = datetime.now()
-            evaluation.save()
-        else:
-            if evaluation.is_older_15min():
-                evaluation.lock_time = datetime.now()
-                evaluation.tutor = user
-                evaluation.save()
-            else:
-                state = 'locked by ' + evaluation.tutor.username
-    else:
-        evaluation = Evaluation.objects.create(submission=elaboration, tutor=user)
-        evaluation.lock_time = datetime.now()
-        evaluation.save()
-        state = 'init'
+    state, evaluation = Evaluation.acquire_lock(elaboration, user)
+    if state == Evaluation.LOCKED:
+        state = 'locked by ' + evaluation.tutor.username
 
     return HttpResponse(state)
 
@@ -438,27 +412,30 @@ def challenge_txt(request, course_short_title=None):
 @staff_member_required
 def similarities(request, course_short_title=None):
     elaboration = Elaboration.objects.get(pk=request.session.get('elaboration_id', ''))
-    challenge_elaborations = Elaboration.objects.filter(challenge=elaboration.challenge,
-                                                        submission_time__isnull=False).exclude(pk=elaboration.id)
-
     similarities = []
-    if elaboration.elaboration_text:
-        for challenge_elaboration in challenge_elaborations:
-            if challenge_elaboration.elaboration_text:
-                similarity = {}
-                s = SequenceMatcher(lambda x: x == " ",
-                                    elaboration.elaboration_text,
-                                    challenge_elaboration.elaboration_text)
-
-                if (s.ratio() > 0.5):
-                    similarity['elaboration'] = challenge_elaboration
-                    similarity['table'] = difflib.HtmlDiff().make_table(elaboration.elaboration_text.splitlines(),
-                                                                        challenge_elaboration.elaboration_text.splitlines())
-                    similarities.append(similarity)
+    for pair, similar_elaboration in SimilarityPair.get_similarities(elaboration):
+        similarities.append({'pair': pair, 'elaboration': similar_elaboration})
 
     return render_to_response('similarities.html', {'similarities': similarities}, RequestContext(request))
 
 
+@login_required()
+@staff_member_required
+def similarity_diff(request, course_short_title=None):
+    elaboration = Elaboration.objects.get(pk=request.session.get('elaboration_id', ''))
+    pair_id = request.GET.get('pair_id', '')
+    if not pair_id.isdigit():
+        raise Http404
+    pair = get_object_or_404(SimilarityPair.objects.select_related('elaboration', 'other'), pk=pair_id)
+    # get_other would silently pick a side of a pair that does not involve the elaboration
+    if elaboration.id not in (pair.elaboration_id, pair.other_id):
+        raise Http404
+    similar_elaboration = pair.get_other(elaboration)
+    table = difflib.HtmlDiff().make_table(elaboration.elaboration_text.splitlines(),
+                                          similar_elaboration.elaboration_text.splitlines())
+    return HttpResponse(table)
+
+
 @csrf_exempt
 @staff_member_required
 def save_evaluation(request, course_short_title=None):
@@ -489,12 +466,11 @@ def submit_evaluation(request, course_short_title=None):
     user = RequestContext(request)['user']
     course = elaboration.challenge.course
 
-    if Evaluation.objects.filter(submission=elaboration):
-        evaluation = Evaluation.objects.get(submission=elaboration)
-    else:
-        evaluation = Evaluation.objects.create(submission=elaboration)
+    # only the tutor holding the lock may submit
+    state, evaluation = Evaluation.acquire_lock(elaboration, user)
+    if state == Evaluation.LOCKED:
+        return HttpResponseForbidden('locked by ' + evaluation.tutor.username)
 
-    evaluation.user = user = user
     evaluation.evaluation_text = evaluation_text
     evaluation.evaluation_points = evaluation_points
     evaluation.submission_time = datetime.now()
@@ -543,9 +519,10 @@ def set_appraisal(request, course_short_title=None):
     review_id = request.POST['review_id']
     appraisal = request.POST['appraisal']
 
-    review = Review.objects.get(pk=review_id)
-    review.appraisal = appraisal
-    review.save()
+    with transaction.atomic():
+        review = Review.objects.select_for_update().get(pk=review_id)
+        review.appraisal = appraisal
+        review.save()
     if review.appraisal == review.NOTHING:
         Notification.bad_review(review)
     else:
@@ -587,17 +564,12 @@ def search(request, course_short_title=None):
         tagged_user = AuroraUser.objects.filter(id__in=tagged_user_ids)
         user = user & tagged_user
 
-    elaborations = []
-    if Elaboration.search(challenges, user):
-        elaborations = list(Elaboration.search(challenges, user))
-
-    html = render_to_response('overview.html', {'elaborations': elaborations, 'search': True, 'course': course}, RequestContext(request))
-
-    # store selected elaborations in session
-    request.session['elaborations'] = serializers.serialize('json', elaborations)
+    # store selected elaborations in a result set
+    elaborations = store_result_set(request, Elaboration.search(challenges, user)).get_elaborations()
     request.session['selection'] = 'search'
     request.session['selected_challenge'] = selected_challenge
-    return html
+
+    return render_to_response('overview.html', {'elaborations': elaborations, 'search': True, 'course': course}, RequestContext(request))
 
 
 @csrf_exempt
@@ -611,8 +583,12 @@ def select_user(request, course_short_title=None):
     user = AuroraUser.objects.get(username=selected_user)
     elaborations = user.get_course_elaborations(course)
 
+    # store selected elaborations in a result set
+    elaborations = store_result_set(request, elaborations).get_elaborations()
+    request.session['selection'] = 'search'
+
     points = get_points(request, user, course)
-    html = render_to_response('overview.html',
+    return render_to_response('overview.html',
                               {
 
                                   'elaborations': elaborations,
@@ -623,11 +599,6 @@ def select_user(request, course_short_title=None):
                                   'course': course
                               }, RequestContext(request))
 
-    # store selected elaborations in session
-    request.session['elaborations'] = serializers.serialize('json', elaborations)
-    request.session['selection'] = 'search'
-    return html
-
 
 @login_required()
 @staff_member_required
@@ -692,16 +663,17 @@ def review_answer(request, course_short_title=None):
     user = RequestContext(request)['user']
     answers = data['answers']
 
-    review = Review.objects.create(elaboration_id=request.session.get('elaboration_id', ''), reviewer_id=user.id)
-
-    review.appraisal = data['appraisal']
-    review.submission_time = datetime.now()
-    review.save()
-    for answer in answers:
-        question_id = answer['question_id']
-        text = answer['answer']
-        review_question = ReviewQuestion.objects.get(pk=question_id)
-        ReviewAnswer(review=review, review_question=review_question, text=text).save()
+    # answers and the review counters of the elaboration are stored together
+    with transaction.atomic():
+        review = Review(elaboration_id=request.session.get('elaboration_id', ''), reviewer_id=user.id)
+        review.appraisal = data['appraisal']
+        review.submission_time = datetime.now()
+        review.save()
+        for answer in answers:
+            question_id = answer['question_id']
+            text = answer['answer']
+            review_question = ReviewQuestion.objects.get(pk=question_id)
+            ReviewAnswer(review=review, review_question=review_question, text=text).save()
     if review.appraisal == review.NOTHING:
         Notification.bad_review(review)
     else:
@@ -712,7 +684,7 @@ def review_answer(request, course_short_title=None):
         elaborations.sort(key=lambda elaboration: elaboration.submission_time)
     else:
         elaborations = elaborations.order_by('submission_time')
-    request.session['elaborations'] = serializers.serialize('json', elaborations)
+    store_result_set(request, elaborations)
 
     if review.elaboration.is_reviewed_2times():
         evaluation_url = reverse('Evaluation:home', args=[course_short_title])
@@ -749,7 +721,7 @@ def back(request, course_short_title=None):
         elaborations.sort(key=lambda elaboration: elaboration.submission_time)
     else:
         elaborations = elaborations.order_by('submission_time')
-    request.session['elaborations'] = serializers.serialize('json', elaborations)
+    store_result_set(request, elaborations)
 
     return evaluation(request, course_short_title)
 
@@ -778,8 +750,8 @@ def search_user(request, course_short_title=None):
         else:
             elaborations = elaborations.order_by('submission_time')
 
-        # store selected elaborations in session
-        request.session['elaborations'] = serializers.serialize('json', elaborations)
+        # store selected elaborations in a result set
+        store_result_set(request, elaborations)
         request.session['selection'] = 'search'
 
     return evaluation(request, course_short_title)
@@ -790,25 +762,21 @@ def search_user(request, course_short_title=None):
 def sort(request, course_short_title=None):
     course = Course.get_or_raise_404(short_title=course_short_title)
 
-    elaborations = []
-    for serialized_elaboration in serializers.deserialize('json', request.session.get('elaborations', {})):
-        elaborations.append(serialized_elaboration.object)
-
-    if request.GET.get('data', '') == "date_asc":
-        elaborations.sort(key=lambda elaboration: elaboration.submission_time)
-    if request.GET.get('data', '') == "date_desc":
-        elaborations.sort(key=lambda elaboration: elaboration.submission_time, reverse=True)
-    if request.GET.get('data', '') == "elab_asc":
-        elaborations.sort(key=lambda elaboration: elaboration.challenge.title)
-    if request.GET.get('data', '') == "elab_desc":
-        elaborations.sort(key=lambda elaboration: elaboration.challenge.title, reverse=True)
-    if request.GET.get('data', '') == "post_asc":
-        elaborations.sort(key=lambda elaboration: elaboration.get_last_post_date())
-    if request.GET.get('data', '') == "post_desc":
-        elaborations.sort(key=lambda elaboration: elaboration.get_last_post_date(), reverse=True)
+    sort_fields = {
+        'date_asc': ('submission_time', False),
+        'date_desc': ('submission_time', True),
+        'elab_asc': ('challenge__title', False),
+        'elab_desc': ('challenge__title', True),
+        'post_asc': ('last_post_date', False),
+        'post_desc': ('last_post_date', True),
+    }
 
-    # store selected elaborations in session
-    request.session['elaborations'] = serializers.serialize('json', elaborations)
+    elaborations = []
+    result_set = get_result_set(request)
+    if result_set:
+        if request.GET.get('data', '') in sort_fields:
+            result_set.sort(*sort_fields[request.GET['data']])
+        elaborations = result_set.get_elaborations()
     request.session['count'] = len(elaborations)
 
     data = {
@@ -843,48 +811,11 @@ def get_points(request, user, course):
     data['stacks'] = []
     for course in courses:
         stack_data = {}
-        course_stacks = Stack.objects.all().filter(course=course)
+        stack_data.update(Gradebook.get_user_points(course, user))
         stack_data['course_title'] = course.title
-        stack_data['course_stacks'] = []
-        evaluated_points_earned_total = 0
-        evaluated_points_available_total = 0
-        submitted_points_available_total = 0
-        started_points_available_total = 0
-        for stack in course_stacks:
-            is_submitted = stack.get_final_challenge().submitted_by_user(user)
-            is_evaluated = stack.is_evaluated(user)
-            is_started = stack.get_first_challenge().is_started(user)
-            is_blocked = stack.is_blocked(user)
-            points_available = stack.get_points_available()
-            points_earned = stack.get_points_earned(user)
-            stack_data['course_stacks'].append({
-                'stack': stack,
-                'is_started': is_started,
-                'is_submitted': is_submitted,
-                'is_evaluated': is_evaluated,
-                'is_blocked': is_blocked,
-                'points_earned': points_earned,
-                'points_available': points_available,
-                'status': stack.get_status_text(user),
-            })
-            if is_evaluated:
-                # skip adding available points to totals for evaluations with 0 points
-                if points_earned == 0:
-                    continue
-                evaluated_points_earned_total += points_earned
-                evaluated_points_available_total += points_available
-                continue
-            if is_submitted:
-                submitted_points_available_total += points_available
-                continue
-            if is_started and not is_blocked:
-                started_points_available_total += points_available
-
-        stack_data['evaluated_points_earned_total'] = evaluated_points_earned_total
-        stack_data['evaluated_points_available_total'] = evaluated_points_available_total
-        stack_data['submitted_points_available_total'] = submitted_points_available_total
-        stack_data['started_points_available_total'] = started_points_available_total
-        stack_data['lock_period'] = stack.get_final_challenge().is_in_lock_period(user, course)
+        last_stack = stack_data['course_stacks'][-1]['stack'] if stack_data['course_stacks'] else None
+        final_challenge = last_stack.get_final_challenge() if last_stack else None
+        stack_data['lock_period'] = final_challenge.is_in_lock_period(user, course) if final_challenge else False
         data['stacks'].append(stack_data)
 
     return data
@@ -1,4 +1,28 @@
-from django.db import models
+from django.db import models, transaction
+from django.db.models import F
+from django.db.models.signals import post_delete
+from django.dispatch import receiver
+
+
+class ReviewQuerySet(models.QuerySet):
+    def with_answer_length(self):
+        """
+        Adds answer_length, the number of characters of all answers of the review, computed by the database.
+        """
+        from django.db import connection
+        from ReviewAnswer.models import ReviewAnswer
+
+        qn = connection.ops.quote_name
+        # LENGTH counts bytes on mysql
+        length = 'CHAR_LENGTH' if connection.vendor == 'mysql' else 'LENGTH'
+        answer_length = (
+            'SELECT COALESCE(SUM({length}({text})), 0) FROM {answer} '
+            'WHERE {answer}.{review_id} = {review}.{id}'
+        ).format(
+            length=length, text=qn('text'), answer=qn(ReviewAnswer._meta.db_table), review_id=qn('review_id'),
+            review=qn(Review._meta.db_table), id=qn('id'),
+        )
+        return self.extra(select={'answer_length': answer_length})
 
 
 class Review(models.Model):
@@ -7,6 +31,8 @@ class Review(models.Model):
     submission_time = models.DateTimeField(null=True)
     reviewer = models.ForeignKey('AuroraUser.AuroraUser')
 
+    objects = ReviewQuerySet.as_manager()
+
     NOTHING = 'N'
     FAIL = 'F'
     SUCCESS = 'S'
@@ -19,9 +45,86 @@ class Review(models.Model):
     )
     appraisal = models.CharField(max_length=1, choices=APPRAISAL_CHOICES, null=True)
 
+    def __init__(self, *args, **kwargs):
+        super(Review, self).__init__(*args, **kwargs)
+        self.counted_appraisal = self.get_counted_appraisal()
+
     def __unicode__(self):
         return str(self.id)
 
+    def get_counted_appraisal(self):
+        # only submitted reviews are counted on the elaboration
+        if self.submission_time is None:
+            return None
+        return self.appraisal
+
+    def save(self, *args, **kwargs):
+        from Elaboration.models import Elaboration
+
+        # reserve_review already counted the review on the elaboration
+        review_count_reserved = kwargs.pop('review_count_reserved', False)
+        adding = self._state.adding
+        previous_appraisal = None if adding else self.counted_appraisal
+        with transaction.atomic():
+            super(Review, self).save(*args, **kwargs)
+            if adding and not review_count_reserved:
+                Elaboration.update_total_review_count(self.elaboration_id, 1)
+                self.update_cached_elaboration_field('review_count', 1)
+            appraisal = self.get_counted_appraisal()
+            if appraisal != previous_appraisal:
+                Elaboration.update_review_count(self.elaboration_id, previous_appraisal, -1)
+                Elaboration.update_review_count(self.elaboration_id, appraisal, 1)
+                self.update_cached_elaboration(previous_appraisal, -1)
+                self.update_cached_elaboration(appraisal, 1)
+        self.counted_appraisal = appraisal
+
+    def update_cached_elaboration(self, appraisal, delta):
+        from Elaboration.models import Elaboration
+
+        field = Elaboration.review_count_fields.get(appraisal)
+        if field is not None:
+            self.update_cached_elaboration_field(field, delta)
+
+    def update_cached_elaboration_field(self, field, delta):
+        # keep an already loaded elaboration instance in sync with the database
+        elaboration = getattr(self, Review._meta.get_field('elaboration').get_cache_name(), None)
+        if elaboration is not None:
+            setattr(elaboration, field, getattr(elaboration, field) + delta)
+
+    RESERVATION_ATTEMPTS = 10
+
+    @staticmethod
+    def reserve_review(elaboration, user):
+        # compare and increment: of all requests that saw the same review_count only one wins the elaboration
+        from Elaboration.models import Elaboration
+
+        with transaction.atomic():
+            reserved = (
+                Elaboration.objects
+                .filter(id=elaboration.id, review_count=elaboration.review_count)
+                .update(review_count=F('review_count') + 1)
+            )
+            if not reserved:
+                return None
+            review = Review(elaboration=elaboration, reviewer=user)
+            review.save(review_count_reserved=True)
+            elaboration.review_count += 1
+        return review
+
+    @staticmethod
+    def create_reserved_review(challenge, user, offset=0):
+        from Elaboration.models import Elaboration
+
+        for attempt in range(Review.RESERVATION_ATTEMPTS):
+            candidate = Elaboration.get_review_candidate(challenge, user, offset, random_ties=True)
+            if candidate is None:
+                return None
+            review = Review.reserve_review(candidate, user)
+            if review:
+                return review
+        # every attempt lost against other reviewers, rather no review than one that unbalances the counts
+        return None
+
     @staticmethod
     def get_open_review(challenge, user):
         open_reviews = Review.objects.filter(elaboration__challenge=challenge, submission_time__isnull=True,
@@ -32,6 +135,17 @@ class Review(models.Model):
             return None
 
 
+@receiver(post_delete, sender=Review)
+def review_post_delete_handler(sender, **kwargs):
+    from Elaboration.models import Elaboration
+
+    review = kwargs['instance']
+    Elaboration.update_review_count(review.elaboration_id, review.counted_appraisal, -1)
+    Elaboration.update_total_review_count(review.elaboration_id, -1)
+    review.update_cached_elaboration(review.counted_appraisal, -1)
+    review.update_cached_elaboration_field('review_count', -1)
+
+
 class ReviewEvaluation(models.Model):
     review = models.ForeignKey('Review.Review')
     creation_time = models.DateTimeField(auto_now_add=True)
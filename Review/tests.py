@@ -1,11 +1,16 @@
-from datetime import datetime
-from django.test import TestCase
+from datetime import datetime, timedelta
+import json
 
+from django.test import TestCase, TransactionTestCase
+from django.test.client import Client
+
+from AuroraProject.test_utils import run_concurrently
 from AuroraUser.models import AuroraUser
 from Course.models import Course, CourseUserRelation
 from Challenge.models import Challenge
 from Review.models import Review, ReviewConfig
 from ReviewQuestion.models import ReviewQuestion
+from ReviewAnswer.models import ReviewAnswer
 from Elaboration.models import Elaboration
 from Stack.models import Stack, StackChallengeRelation
 
@@ -112,6 +117,38 @@ class SimpleTest(TestCase):
         assert review2.reviewer == user2
         assert review1.elaboration == elaboration and review2.elaboration == elaboration
 
+    def test_result_reviews(self):
+        from AuroraProject.views import get_result_reviews
+        from ReviewAnswer.models import ReviewAnswer
+
+        review = Review(elaboration=self.elaborations[0], reviewer=self.users[1], submission_time=datetime.now(),
+                        appraisal='S')
+        review.save()
+        ReviewAnswer(review=review, review_question=self.review_question, text="abc").save()
+        ReviewAnswer(review=review, review_question=self.review_question, text="d\u00e9fg").save()
+        self.create_review_without_submission_date(self.elaborations[1], self.users[2])
+        assert Review.objects.with_answer_length().get(id=review.id).answer_length == 7
+        with self.assertNumQueries(1):
+            lines = list(get_result_reviews())
+        assert len(lines) == 2
+        assert lines[0].rstrip("\n").split("\t")[:3] == ['s1', 's0', str(self.challenge.id)]
+        assert lines[0].rstrip("\n").split("\t")[5] == '7'
+        assert lines[1].rstrip("\n").split("\t")[4:] == ['None', '0']
+
+    def test_result_elabs_nonfinal(self):
+        from AuroraProject.views import get_result_elabs_nonfinal
+
+        final_challenge = Challenge(course=self.course, prerequisite=self.challenge)
+        final_challenge.save()
+        Elaboration(challenge=final_challenge, user=self.users[0], elaboration_text="final").save()
+        for elaboration in [self.elaborations[2], self.elaborations[0], self.elaborations[2]]:
+            self.create_review(elaboration, self.users[3])
+        # final challenge ids, elaborations and reviews
+        with self.assertNumQueries(3):
+            lines = [line.rstrip("\n").split("\t") for line in get_result_elabs_nonfinal()]
+        assert [line[1] for line in lines] == [str(elaboration.id) for elaboration in self.elaborations]
+        assert [(len(line) - 6) // 4 for line in lines] == [1, 0, 2, 0]
+
     def test_review_config_offset(self):
         assert ReviewConfig.get_candidate_offset_min() == 0
         assert ReviewConfig.get_candidate_offset_max() == 0
@@ -146,4 +183,78 @@ class SimpleTest(TestCase):
         assert stack.has_enough_peer_reviews(self.users[0]) is False
         Review(elaboration=elab1, reviewer=self.users[1], appraisal='S', submission_time=datetime.now()).save()
         Review(elaboration=elab1, reviewer=self.users[2], appraisal='S', submission_time=datetime.now()).save()
-        assert stack.has_enough_peer_reviews(self.users[0]) is True
\ No newline at end of file
+        assert stack.has_enough_peer_reviews(self.users[0]) is True
+
+class ReviewReservationTest(TransactionTestCase):
+    def setUp(self):
+        self.course = Course(title='test_title', short_title='test_short_title', description='test_description',
+                             course_number='test_course_number')
+        self.course.save()
+        self.challenge = Challenge(title='test_title', subtitle='test_subtitle', description='test_description',
+                                   course=self.course)
+        self.challenge.save()
+        self.elaborations = []
+        for i in range(20):
+            author = AuroraUser(username="author%s" % i)
+            author.save()
+            elaboration = Elaboration(challenge=self.challenge, user=author, elaboration_text="test_text",
+                                      submission_time=datetime.now() - timedelta(hours=1))
+            elaboration.save()
+            self.elaborations.append(elaboration)
+        self.reviewers = []
+        for i in range(200):
+            reviewer = AuroraUser(username="reviewer%s" % i)
+            reviewer.save()
+            self.reviewers.append(reviewer)
+
+    def review_concurrently(self, reviewers):
+        # every reviewer picks its candidate before anyone reserves, then all of them reserve at once
+        def pick(reviewer):
+            return Elaboration.get_review_candidate(self.challenge, reviewer, random_ties=True)
+
+        def review(reviewer, candidate):
+            return Review.reserve_review(candidate, reviewer) or Review.create_reserved_review(self.challenge,
+                                                                                                reviewer)
+
+        return run_concurrently(review, reviewers, prepare=pick)
+
+    def test_concurrent_reviewers_are_balanced(self):
+        reviews = self.review_concurrently(self.reviewers)
+        assert None not in reviews
+        assert Review.objects.count() == 200
+        review_counts = [Review.objects.filter(elaboration=elaboration).count() for elaboration in self.elaborations]
+        assert max(review_counts) - min(review_counts) <= 1
+        for elaboration in self.elaborations:
+            elaboration = Elaboration.objects.get(pk=elaboration.id)
+            assert elaboration.review_count == Review.objects.filter(elaboration=elaboration).count()
+
+    def test_double_submit(self):
+        reviewer = self.reviewers[0]
+        reviewer.set_password('p')
+        reviewer.save()
+        CourseUserRelation(course=self.course, user=reviewer).save()
+        question = ReviewQuestion(challenge=self.challenge, order=1, text="question")
+        question.save()
+        elaboration = self.elaborations[0]
+        review = Review(elaboration=elaboration, reviewer=reviewer)
+        review.save()
+        data = json.dumps({'review_id': review.id, 'appraisal': Review.SUCCESS,
+                           'answers': [{'question_id': question.id, 'answer': "answer"}]})
+
+        def login(reviewer):
+            client = Client()
+            assert client.login(username=reviewer.username, password='p')
+            return client
+
+        def submit(reviewer, client):
+            # review.js posts the json as form data
+            return client.post('/gsi/review/review_answer', data,
+                               content_type='application/x-www-form-urlencoded').status_code
+
+        # both requests pass the open review check before either of them submits
+        status_codes = run_concurrently(submit, [reviewer, reviewer], prepare=login)
+        assert sorted(status_codes) == [200, 404]
+        elaboration = Elaboration.objects.get(pk=elaboration.id)
+        assert elaboration.success_review_count == 1
+        assert elaboration.review_count == 1
+        assert ReviewAnswer.objects.filter(review=review).count() == 1
@@ -5,10 +5,10 @@ from django.shortcuts import render_to_response
 from django.template import RequestContext
 from django.contrib.auth.decorators import login_required
 from django.http import HttpResponse, Http404
+from django.db import transaction
 
 from Course.models import Course
 from Review.models import Review, ReviewEvaluation
-from Elaboration.models import Elaboration
 from Challenge.models import Challenge
 from ReviewQuestion.models import ReviewQuestion
 from ReviewAnswer.models import ReviewAnswer
@@ -31,11 +31,8 @@ def create_context_review(request):
         if not review:
             # number of hours needed to pass until elaboration is applicable as candidate
             offset = randint(ReviewConfig.get_candidate_offset_min(), ReviewConfig.get_candidate_offset_max())
-            review_candidate = Elaboration.get_review_candidate(challenge, user, offset)
-            if review_candidate:
-                review = Review(elaboration=review_candidate, reviewer=user)
-                review.save()
-            else:
+            review = Review.create_reserved_review(challenge, user, offset)
+            if not review:
                 return data
         data['review'] = review
         data['stack_id'] = challenge.get_stack().id
@@ -70,14 +67,22 @@ def review_answer(request, course_short_title):
             raise Http404
         review.appraisal = data['appraisal']
 
-        for answer in answers:
-            question_id = answer['question_id']
-            text = answer['answer']
-            review_question = ReviewQuestion.objects.get(pk=question_id)
-            ReviewAnswer(review=review, review_question=review_question, text=text).save()
-            # send notifications
-        review.submission_time = datetime.now()
-        review.save()
+        # answers and the review counters of the elaboration are stored together
+        with transaction.atomic():
+            # a double click or retry submits the review twice, only the request that marks it submitted
+            # stores answers and counts it, the open review check above may have passed for both
+            submission_time = datetime.now()
+            if not Review.objects.filter(pk=review.id, submission_time__isnull=True) \
+                    .update(submission_time=submission_time):
+                raise Http404
+            for answer in answers:
+                question_id = answer['question_id']
+                text = answer['answer']
+                review_question = ReviewQuestion.objects.get(pk=question_id)
+                ReviewAnswer(review=review, review_question=review_question, text=text).save()
+            review.submission_time = submission_time
+            review.save()
+        # send notifications
         try:
             if review.appraisal == review.NOTHING:
                 Notification.bad_review(review)
@@ -7,14 +7,12 @@ class Stack(models.Model):
     course = models.ForeignKey('Course.Course')
 
     def get_first_challenge(self):
-        for relation in StackChallengeRelation.objects.filter(stack=self):
-            return relation.challenge.get_first_challenge()
-        return None
+        from Challenge.models import ChallengeChainIndex
+        return ChallengeChainIndex.for_course(self.course_id).get_stack_first_challenge(self)
 
     def get_final_challenge(self):
-        for relation in StackChallengeRelation.objects.filter(stack=self):
-            return relation.challenge.get_final_challenge()
-        return None
+        from Challenge.models import ChallengeChainIndex
+        return ChallengeChainIndex.for_course(self.course_id).get_stack_final_challenge(self)
 
     def get_challenges(self):
         challenges = []
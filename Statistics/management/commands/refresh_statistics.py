@@ -0,0 +1,28 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from Course.models import Course
+from Statistics.models import CourseStatisticsSnapshot
+
+
+class Command(BaseCommand):
+    args = '[course_short_title ...]'
+    help = 'Recomputes the statistics snapshots of the given courses (default: all)'
+
+    def handle(self, *args, **options):
+        if args:
+            courses = Course.objects.filter(short_title__in=args)
+            if len(courses) != len(set(args)):
+                raise CommandError("unknown course in %s" % ', '.join(args))
+        else:
+            courses = Course.objects.all()
+
+        for course in courses.order_by('id'):
+            start = time.time()
+            snapshot, created = CourseStatisticsSnapshot.objects.get_or_create(course=course)
+            if snapshot.refresh():
+                self.stdout.write("course %s: statistics refreshed (%.1fs)" % (course.short_title,
+                                                                              time.time() - start))
+            else:
+                self.stdout.write("course %s: skipped, another refresh is running" % course.short_title)
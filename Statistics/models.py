@@ -0,0 +1,104 @@
+from datetime import datetime, timedelta
+import json
+import threading
+import time
+
+from django.db import models, connection
+from django.db.models import Q
+
+
+class CourseStatisticsSnapshot(models.Model):
+    """
+    The course statistics shown on the home and statistics pages, computed at creation_time.
+
+    Requests read the stored snapshot. Once it is older than TTL the first request claims the
+    refresh and recomputes it in a background thread while everybody keeps reading the old
+    snapshot, so page latency does not depend on the course size. The refresh_statistics
+    command recomputes the snapshots synchronously, e.g. from cron. Every refresh claims
+    refresh_time first, so only one runs at a time whichever process started it.
+    """
+
+    TTL = timedelta(minutes=15)
+    # a claimed refresh that did not finish within this time is given up and claimed again
+    REFRESH_TIMEOUT = timedelta(minutes=10)
+    # seconds between the checks of a request waiting for the first snapshot of a course
+    REFRESH_WAIT = 0.5
+
+    course = models.ForeignKey('Course.Course', unique=True)
+    data = models.TextField(default='{}')
+    creation_time = models.DateTimeField(null=True)
+    refresh_time = models.DateTimeField(null=True)
+
+    @staticmethod
+    def get_data(course, background=True):
+        snapshot, created = CourseStatisticsSnapshot.objects.get_or_create(course=course)
+        if snapshot.creation_time is None:
+            # nothing to show yet, one request computes the snapshot and the others wait for it
+            if not snapshot.refresh():
+                snapshot = snapshot.wait_for_refresh()
+        elif snapshot.is_stale():
+            if background:
+                snapshot.refresh_in_background()
+            else:
+                snapshot.refresh()
+        return snapshot.get_statistics()
+
+    def get_statistics(self):
+        statistics = json.loads(self.data)
+        statistics['statistics_time'] = self.creation_time
+        return statistics
+
+    def is_stale(self):
+        return self.creation_time is None or self.creation_time < datetime.now() - CourseStatisticsSnapshot.TTL
+
+    def claim_refresh(self):
+        now = datetime.now()
+        claimed = (
+            CourseStatisticsSnapshot.objects
+            .filter(id=self.id)
+            .filter(Q(refresh_time__isnull=True) | Q(refresh_time__lt=now - CourseStatisticsSnapshot.REFRESH_TIMEOUT))
+            .update(refresh_time=now)
+        )
+        return claimed == 1
+
+    def refresh(self):
+        # recomputes the snapshot unless another refresh is running, returns whether it did
+        if not self.claim_refresh():
+            return False
+        self.update_data()
+        return True
+
+    def refresh_in_background(self):
+        if not self.claim_refresh():
+            return False
+
+        def refresh():
+            try:
+                self.update_data()
+            finally:
+                connection.close()
+
+        thread = threading.Thread(target=refresh)
+        thread.daemon = True
+        thread.start()
+        return True
+
+    def update_data(self):
+        # the claimed refresh, the claim is released when it is done or failed
+        from Statistics.views import compute_statistics
+        try:
+            self.data = json.dumps(compute_statistics(self.course))
+        except Exception:
+            CourseStatisticsSnapshot.objects.filter(id=self.id).update(refresh_time=None)
+            raise
+        self.creation_time = datetime.now()
+        self.refresh_time = None
+        self.save()
+
+    def wait_for_refresh(self):
+        while True:
+            time.sleep(CourseStatisticsSnapshot.REFRESH_WAIT)
+            snapshot = CourseStatisticsSnapshot.objects.get(id=self.id)
+            # the refresh is done, or it failed or timed out and this request takes it over
+            if snapshot.creation_time is not None or snapshot.refresh():
+                return snapshot
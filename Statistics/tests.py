@@ -0,0 +1,187 @@
+from datetime import datetime, timedelta
+import time
+
+from django.test import TestCase, TransactionTestCase
+
+from AuroraProject.test_utils import run_concurrently
+from AuroraUser.models import AuroraUser
+from Course.models import Course, CourseUserRelation
+from Challenge.models import Challenge
+from Elaboration.models import Elaboration
+from Evaluation.models import Evaluation
+from Statistics.models import CourseStatisticsSnapshot
+import Statistics.views as views
+from Statistics.views import student_points_totals, points_cumulative, points_histogram, tutor_statistics, \
+    review_evaluating_students_top_x
+from Review.models import Review, ReviewEvaluation
+from Comments.models import Comment
+
+
+class CourseStatisticsSnapshotTest(TestCase):
+    def setUp(self):
+        self.course = Course(
+            title='test_title',
+            short_title='test_short_title',
+            description='test_description',
+            course_number='test_course_number',
+        )
+        self.course.save()
+        self.challenge = Challenge(
+            title='test_title',
+            subtitle='test_subtitle',
+            description='test_description',
+            course=self.course,
+        )
+        self.challenge.save()
+        self.users = []
+        for i in range(3):
+            user = AuroraUser(username="s%s" % i, nickname="s%s" % i)
+            user.save()
+            CourseUserRelation(course=self.course, user=user).save()
+            self.users.append(user)
+
+    def create_elaboration(self, user):
+        Elaboration(challenge=self.challenge, user=user, elaboration_text="test_text",
+                    submission_time=datetime.now()).save()
+
+    def make_stale(self):
+        CourseStatisticsSnapshot.objects.update(
+            creation_time=datetime.now() - CourseStatisticsSnapshot.TTL - timedelta(minutes=1)
+        )
+
+    def test_snapshot(self):
+        self.create_elaboration(self.users[0])
+        data = CourseStatisticsSnapshot.get_data(self.course)
+        assert data['elaborations'] == 1
+        assert data['students_with_at_least_one_submission'] == 1
+        assert data['review_evaluations_positive_ratio'] == 0
+        assert data['statistics_time'] is not None
+
+        # a fresh snapshot is read with a single query whatever the course size
+        self.create_elaboration(self.users[1])
+        with self.assertNumQueries(1):
+            data = CourseStatisticsSnapshot.get_data(self.course)
+        assert data['elaborations'] == 1
+
+        self.make_stale()
+        data = CourseStatisticsSnapshot.get_data(self.course, background=False)
+        assert data['elaborations'] == 2
+        assert not CourseStatisticsSnapshot.objects.get(course=self.course).is_stale()
+
+    def test_claim_refresh(self):
+        CourseStatisticsSnapshot.get_data(self.course)
+        self.make_stale()
+        snapshot = CourseStatisticsSnapshot.objects.get(course=self.course)
+        assert snapshot.claim_refresh()
+        assert not snapshot.claim_refresh()
+        assert not snapshot.refresh() and not snapshot.refresh_in_background()
+
+        # while the refresh is running everybody else reads the stale snapshot
+        self.create_elaboration(self.users[0])
+        with self.assertNumQueries(2):
+            data = CourseStatisticsSnapshot.get_data(self.course)
+        assert data['elaborations'] == 0
+
+        # a refresh that died is given up after REFRESH_TIMEOUT
+        CourseStatisticsSnapshot.objects.update(
+            refresh_time=datetime.now() - CourseStatisticsSnapshot.REFRESH_TIMEOUT - timedelta(minutes=1)
+        )
+        assert snapshot.claim_refresh()
+
+    def create_evaluation(self, user, points, submitted=True):
+        challenge = Challenge(title='test_title', subtitle='test_subtitle', description='test_description',
+                              course=self.course)
+        challenge.save()
+        elaboration = Elaboration(challenge=challenge, user=user, elaboration_text="test_text",
+                                  submission_time=datetime.now())
+        elaboration.save()
+        Evaluation(submission=elaboration, tutor=self.users[0], evaluation_points=points,
+                   submission_time=datetime.now() if submitted else None).save()
+
+    def test_points_distribution(self):
+        self.create_evaluation(self.users[0], 20)
+        self.create_evaluation(self.users[0], 12)
+        self.create_evaluation(self.users[1], 31)
+        self.create_evaluation(self.users[1], 10, submitted=False)
+        self.create_evaluation(self.users[2], 8)
+        with self.assertNumQueries(1):
+            totals = student_points_totals(self.course)
+        assert totals == [8, 31, 32]
+        assert points_cumulative(totals, [0, 30, 32, 33]) == [(0, 3), (30, 2), (32, 1), (33, 0)]
+        assert points_histogram(totals, 10) == [
+            {'points': 0, 'count': 1},
+            {'points': 10, 'count': 0},
+            {'points': 20, 'count': 0},
+            {'points': 30, 'count': 2},
+        ]
+        assert points_histogram([], 10) == []
+
+    def test_tutor_statistics(self):
+        tutors = []
+        for i in range(2):
+            tutor = AuroraUser(username="tutor%s" % i, nickname="tutor%s" % i, is_staff=True)
+            tutor.save()
+            tutors.append(tutor)
+        day = datetime(2015, 3, 2, 10, 0)
+        for i, minutes in enumerate([10, 20, 60]):
+            elaboration = Elaboration(challenge=self.challenge, user=self.users[i], elaboration_text="test_text",
+                                      submission_time=day)
+            elaboration.save()
+            submission_time = day + timedelta(days=i // 2, hours=i)
+            Evaluation(submission=elaboration, tutor=tutors[0], evaluation_points=10,
+                       lock_time=submission_time - timedelta(minutes=minutes), submission_time=submission_time).save()
+            review = Review(elaboration=elaboration, reviewer=tutors[1], appraisal=Review.SUCCESS,
+                            submission_time=day)
+            review.save()
+            if i < 2:
+                ReviewEvaluation(review=review, user=self.users[i], appraisal=ReviewEvaluation.POSITIVE).save()
+        Comment(text="test", author=tutors[1], post_date=day, content_object=elaboration).save()
+
+        with self.assertNumQueries(4):
+            statistics = dict((tutor['id'], tutor) for tutor in tutor_statistics(self.course))
+        first, second = statistics[tutors[0].id], statistics[tutors[1].id]
+        assert (first['evaluations'], first['reviews'], first['comments']) == (3, 0, 0)
+        assert (second['evaluations'], second['reviews'], second['comments']) == (0, 3, 1)
+        assert first['evaluations_per_day'] == 1.5
+        assert first['median_evaluation_minutes'] == 20
+        assert second['evaluations_per_day'] == 0
+        assert second['median_evaluation_minutes'] is None
+
+        with self.assertNumQueries(2):
+            students = review_evaluating_students_top_x(self.course, 10)
+        assert sorted((student['nickname'], student['count'], student['percent']) for student in students) == [
+            ('s0', 1, 100), ('s1', 1, 100)
+        ]
+
+
+class CourseStatisticsRefreshTest(TransactionTestCase):
+    def setUp(self):
+        self.course = Course(title='test_title', short_title='test_short_title', description='test_description',
+                             course_number='test_course_number')
+        self.course.save()
+        challenge = Challenge(title='test_title', subtitle='test_subtitle', description='test_description',
+                              course=self.course)
+        challenge.save()
+        user = AuroraUser(username="s0", nickname="s0")
+        user.save()
+        Elaboration(challenge=challenge, user=user, elaboration_text="test_text", submission_time=datetime.now()).save()
+
+    def test_concurrent_first_requests(self):
+        compute_statistics = views.compute_statistics
+        computed = []
+
+        def slow_compute_statistics(course):
+            computed.append(course.id)
+            time.sleep(1)
+            return compute_statistics(course)
+
+        # all requests find no snapshot, one computes it and the others wait for it
+        views.compute_statistics = slow_compute_statistics
+        try:
+            elaborations = run_concurrently(
+                lambda request, prepared: CourseStatisticsSnapshot.get_data(self.course)['elaborations'], range(5)
+            )
+        finally:
+            views.compute_statistics = compute_statistics
+        assert computed == [self.course.id]
+        assert elaborations == [1] * 5
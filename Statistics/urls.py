@@ -4,4 +4,6 @@ import Statistics.views
 
 urlpatterns = patterns('',
                        url(r'^$', Statistics.views.statistics, name='home'),
+                       url(r'^points_distribution$', Statistics.views.points_distribution,
+                           name='points_distribution'),
                        )
\ No newline at end of file
@@ -1,4 +1,9 @@
+from bisect import bisect_left
+from collections import Counter
+import json
+
 from django.shortcuts import render_to_response
+from django.http import HttpResponse, HttpResponseBadRequest
 from django.template import RequestContext
 from django.contrib.admin.views.decorators import staff_member_required
 from django.db.models import Q, Sum, Count
@@ -10,37 +15,42 @@ from AuroraUser.models import AuroraUser
 from Evaluation.models import Evaluation
 from Review.models import Review, ReviewEvaluation
 from Comments.models import Comment
+from Statistics.models import CourseStatisticsSnapshot
 
 
 @staff_member_required
 def statistics(request, course_short_title=None):
     data = {}
     course = Course.get_or_raise_404(course_short_title)
+    if 'refresh' in request.GET:
+        CourseStatisticsSnapshot.objects.get_or_create(course=course)[0].refresh()
     data = create_stat_data(course,data)
     return render_to_response('statistics.html', data, context_instance=RequestContext(request))
 
 def create_stat_data(course, data):
     data['course'] = course
+    data.update(CourseStatisticsSnapshot.get_data(course))
+    return data
+
+def compute_statistics(course):
+    data = {}
     data['students'] = AuroraUser.objects.filter(is_staff=False, is_superuser=False).count()
     data['students_with_at_least_one_submission'] = students_with_at_least_one_submission(course)
     data['started_challenges'] = started_challenges(course)
     data['elaborations'] = elaborations(course)
-    data['students_with_more_than_30_points'] = students_with_more_than_x_points(course, 30)
-    data['students_with_more_than_35_points'] = students_with_more_than_x_points(course, 35)
-    data['students_with_more_than_40_points'] = students_with_more_than_x_points(course, 40)
-    data['students_with_more_than_45_points'] = students_with_more_than_x_points(course, 45)
-    data['students_with_more_than_50_points'] = students_with_more_than_x_points(course, 50)
-    data['students_with_more_than_55_points'] = students_with_more_than_x_points(course, 55)
-    data['students_with_more_than_60_points'] = students_with_more_than_x_points(course, 60)
+    points_totals = student_points_totals(course)
+    for points, count in points_cumulative(points_totals, range(30, 61, 5)):
+        data['students_with_more_than_%s_points' % points] = count
+    data['points_histogram'] = points_histogram(points_totals, 5)
     data['review_evaluations'] = review_evaluations(course)
     data['review_evaluations_positive'] = review_evaluations_positive(course)
     data['review_evaluations_default'] = review_evaluations_default(course)
     data['review_evaluations_negative'] = review_evaluations_negative(course)
-    data['review_evaluations_positive_ratio'] = data['review_evaluations_positive']/data['review_evaluations']*100
-    data['review_evaluations_default_ratio'] = data['review_evaluations_default']/data['review_evaluations']*100
-    data['review_evaluations_negative_ratio'] = data['review_evaluations_negative']/data['review_evaluations']*100
+    data['review_evaluations_positive_ratio'] = ratio(data['review_evaluations_positive'], data['review_evaluations'])
+    data['review_evaluations_default_ratio'] = ratio(data['review_evaluations_default'], data['review_evaluations'])
+    data['review_evaluations_negative_ratio'] = ratio(data['review_evaluations_negative'], data['review_evaluations'])
     data['reviews'] = reviews(course)
-    data['commenter_top_25'] = commenter_top_x(course, 25)
+    data['commenter_top_25'] = list(commenter_top_x(course, 25))
     data['tutors'] = tutor_statistics(course)
     data['review_evaluating_students_top_10'] = review_evaluating_students_top_x(course, 10)
     data['evaluated_final_tasks'] = evaluated_final_tasks(course)
@@ -48,11 +58,15 @@ def create_stat_data(course, data):
     data['final_tasks'] = final_tasks(course)
     return data
 
+def ratio(count, total):
+    if not total:
+        return 0
+    return count / total * 100
+
 def students_with_at_least_one_submission(course):
-    final_challenge_ids = Challenge.get_final_challenge_ids()
+    final_challenge_ids = Challenge.get_course_final_challenge_ids(course)
     elaborations = (
         Elaboration.objects
-            .filter(challenge__course=course)
             .filter(challenge__id__in=final_challenge_ids)
             .filter(submission_time__isnull=False)
             .values_list('user__id', flat=True)
@@ -79,17 +93,53 @@ def elaborations(course):
     )
 
 
-def students_with_more_than_x_points(course, x):
-    users = (
+def student_points_totals(course):
+    totals = (
         Evaluation.objects
             .filter(submission__challenge__course=course)
             .filter(submission_time__isnull=False)
             .values('submission__user')
             .annotate(total_points=Sum('evaluation_points'))
-            .filter(total_points__gte=x)
-            .count()
+            .values_list('total_points', flat=True)
     )
-    return users
+    return sorted(total for total in totals if total is not None)
+
+
+def points_cumulative(points_totals, thresholds):
+    # number of students with at least the threshold points, points_totals must be sorted
+    return [(threshold, len(points_totals) - bisect_left(points_totals, threshold)) for threshold in thresholds]
+
+
+def points_histogram(points_totals, bucket_size):
+    counts = Counter(total // bucket_size * bucket_size for total in points_totals)
+    if not counts:
+        return []
+    return [
+        {'points': points, 'count': counts[points]}
+        for points in range(min(counts), max(counts) + 1, bucket_size)
+    ]
+
+
+@staff_member_required
+def points_distribution(request, course_short_title=None):
+    course = Course.get_or_raise_404(course_short_title)
+    try:
+        bucket_size = int(request.GET.get('bucket_size', 5))
+        thresholds = [int(threshold) for threshold in request.GET.get('thresholds', '').split(',') if threshold]
+    except ValueError:
+        return HttpResponseBadRequest()
+    if bucket_size < 1:
+        return HttpResponseBadRequest()
+    points_totals = student_points_totals(course)
+    data = {
+        'students': len(points_totals),
+        'histogram': points_histogram(points_totals, bucket_size),
+        'cumulative': [
+            {'points': points, 'count': count}
+            for points, count in points_cumulative(points_totals, thresholds)
+        ],
+    }
+    return HttpResponse(json.dumps(data), content_type='application/json')
 
 
 def review_evaluations(course):
@@ -147,29 +197,66 @@ def commenter_top_x(course, x):
 
 
 def tutor_statistics(course):
-    tutors = AuroraUser.objects.filter(is_staff=True).values('id', 'nickname', 'first_name', 'last_name').order_by('id')
+    tutors = list(
+        AuroraUser.objects.filter(is_staff=True).values('id', 'nickname', 'first_name', 'last_name').order_by('id')
+    )
+    submitted_evaluations = (
+        Evaluation.objects
+            .filter(submission__challenge__course=course)
+            .filter(submission_time__isnull=False)
+            .filter(tutor__is_staff=True)
+            .values_list('tutor_id', 'lock_time', 'submission_time')
+    )
+    evaluation_times = {}
+    for tutor_id, lock_time, submission_time in submitted_evaluations:
+        evaluation_times.setdefault(tutor_id, []).append((lock_time, submission_time))
+    reviews = dict(
+        Review.objects
+            .filter(elaboration__challenge__course=course)
+            .filter(reviewer__is_staff=True)
+            .values('reviewer')
+            .annotate(count=Count('id'))
+            .values_list('reviewer', 'count')
+    )
+    comments = dict(
+        Comment.objects
+            .filter(author__is_staff=True)
+            .values('author')
+            .annotate(count=Count('id'))
+            .values_list('author', 'count')
+    )
     for tutor in tutors:
-        tutor['evaluations'] = (
-            Evaluation.objects
-                .filter(submission__challenge__course=course)
-                .filter(submission_time__isnull=False)
-                .filter(tutor__id=tutor['id'])
-                .count()
-        )
-        tutor['reviews'] = (
-            Review.objects
-                .filter(elaboration__challenge__course=course)
-                .filter(reviewer__id=tutor['id'])
-                .count()
-        )
-        tutor['comments'] = (
-            Comment.objects
-                .filter(author__id=tutor['id'])
-                .count()
-        )
+        times = evaluation_times.get(tutor['id'], [])
+        tutor['evaluations'] = len(times)
+        tutor['reviews'] = reviews.get(tutor['id'], 0)
+        tutor['comments'] = comments.get(tutor['id'], 0)
+        tutor.update(evaluation_throughput(times))
     return tutors
 
 
+def evaluation_throughput(times):
+    # evaluations per day the tutor submitted evaluations on, and the median minutes
+    # from the last opening of an evaluation (lock_time) to its submission
+    days = set(submission_time.date() for lock_time, submission_time in times)
+    durations = [
+        (submission_time - lock_time).total_seconds() / 60
+        for lock_time, submission_time in times
+        if lock_time is not None and lock_time <= submission_time
+    ]
+    return {
+        'evaluations_per_day': round(len(times) / len(days), 1) if days else 0,
+        'median_evaluation_minutes': round(median(durations), 1) if durations else None,
+    }
+
+
+def median(values):
+    values = sorted(values)
+    middle = len(values) // 2
+    if len(values) % 2:
+        return values[middle]
+    return (values[middle - 1] + values[middle]) / 2
+
+
 def review_evaluating_students_top_x(course, x):
     students = (
         ReviewEvaluation.objects
@@ -179,6 +266,15 @@ def review_evaluating_students_top_x(course, x):
             .order_by('-count')
         [:x]
     )
+    students = list(students)
+    totals = dict(
+        Review.objects
+            .filter(elaboration__challenge__course=course)
+            .filter(elaboration__user__id__in=[student['user__id'] for student in students])
+            .values('elaboration__user')
+            .annotate(count=Count('id'))
+            .values_list('elaboration__user', 'count')
+    )
     result = []
     for student in students:
         data = {
@@ -187,13 +283,8 @@ def review_evaluating_students_top_x(course, x):
             'count': student['count']
         }
 
-        total = (
-            Review.objects
-                .filter(elaboration__challenge__course=course)
-                .filter(elaboration__user__id=student['user__id'])
-                .count()
-        )
-        data['percent'] = int((data['count'] / total) * 100)
+        total = totals.get(student['user__id'], 0)
+        data['percent'] = int((data['count'] / total) * 100) if total else 0
         result.append(data)
     return result
 
@@ -213,14 +304,13 @@ def not_evaluated_final_tasks(course):
 
 def final_tasks(course):
     final_task_ids = Challenge.get_course_final_challenge_ids(course)
+    titles = dict(Challenge.objects.filter(id__in=final_task_ids).values_list('id', 'title'))
 
     result = []
     for id in final_task_ids:
         data = {}
         data['id'] = id
-        data['title'] = (
-            Challenge.objects.get(pk=id).title
-        )
+        data['title'] = titles[id]
         data['evaluated'] = (
             Evaluation.objects
                 .filter(submission__challenge__course=course)